@@ -1,6 +1,10 @@
 """
 Python wrapper of the hydrological code MORDOR_TS
 
+The core modules are imported with the package. The other ones are
+imported explicitly when needed (ex.: from pymordor import server):
+checkpoint, server, ensemble, calibration, model, prepcache and threads.
+
 Author(s) : Fabrice Zaoui (EDF R&D LNHE)
 
 Copyright EDF 2016-2018
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+    Calibration of the parameters of MORDOR-TS against gauge series
+
+    The candidates of a population-based optimizer (differential evolution)
+    are evaluated by batches with the ensemble runner: the processes of the
+    pool keep the inputs from one generation to the next. The objectives
+    are computed for all the candidates at once, at the constrained cells
+    (outlets) of the mesh. The population is saved after each generation
+    so that a long calibration can be resumed.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import numpy as np
+from pymordor import ensemble
+from pymordor.litdonneesmodele import litficmeteo
+from pymordor.utils import replace_file
+
+
+def _valides(qsim, qobs):
+    """ Simulated and observed values broadcast, with the mask of the
+    time steps where both are known """
+    qsim = np.asarray(qsim, dtype=float)
+    qobs = np.broadcast_to(np.asarray(qobs, dtype=float), qsim.shape)
+    masque = np.isfinite(qsim) & np.isfinite(qobs)
+    return qsim, qobs, masque
+
+
+def _moyenne(valeurs, masque):
+    """ Mean over the time steps (axis -2) of the valid values """
+    return np.where(masque, valeurs, 0.0).sum(axis=-2) / masque.sum(axis=-2)
+
+
+def nse(qsim, qobs):
+    """
+    Nash-Sutcliffe efficiency
+    :param qsim: array (... x nsteps x nsortie) of simulated discharges
+                 (ex.: nmembers x nsteps x nsortie for an ensemble)
+    :param qobs: array (nsteps x nsortie) of observed discharges (NaN for
+                 the missing values)
+    :return: array (... x nsortie) of efficiencies
+    """
+    qsim, qobs, masque = _valides(qsim, qobs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moy = _moyenne(qobs, masque)
+        num = np.where(masque, (qsim - qobs)**2, 0.0).sum(axis=-2)
+        den = np.where(masque, (qobs - moy[..., np.newaxis, :])**2,
+                       0.0).sum(axis=-2)
+        return 1.0 - num / den
+
+
+def lognse(qsim, qobs, epsilon=None):
+    """
+    Nash-Sutcliffe efficiency of the logarithms of the discharges
+    :param qsim: array (... x nsteps x nsortie) of simulated discharges
+    :param qobs: array (nsteps x nsortie) of observed discharges
+    :param epsilon: value added before the logarithm (default: 1/100 of the
+                    mean observed discharge of each outlet)
+    :return: array (... x nsortie) of efficiencies
+    """
+    qobs = np.asarray(qobs, dtype=float)
+    if epsilon is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            epsilon = np.nanmean(qobs, axis=0) / 100.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return nse(np.log(np.asarray(qsim, dtype=float) + epsilon),
+                   np.log(qobs + epsilon))
+
+
+def kge(qsim, qobs):
+    """
+    Kling-Gupta efficiency
+    :param qsim: array (... x nsteps x nsortie) of simulated discharges
+    :param qobs: array (nsteps x nsortie) of observed discharges
+    :return: array (... x nsortie) of efficiencies
+    """
+    qsim, qobs, masque = _valides(qsim, qobs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        msim = _moyenne(qsim, masque)
+        mobs = _moyenne(qobs, masque)
+        dsim = np.where(masque, qsim - msim[..., np.newaxis, :], 0.0)
+        dobs = np.where(masque, qobs - mobs[..., np.newaxis, :], 0.0)
+        ssim = np.sqrt((dsim**2).sum(axis=-2))
+        sobs = np.sqrt((dobs**2).sum(axis=-2))
+        r = (dsim * dobs).sum(axis=-2) / (ssim * sobs)
+        alpha = ssim / sobs
+        beta = msim / mobs
+        return 1.0 - np.sqrt((r - 1.0)**2 + (alpha - 1.0)**2 +
+                             (beta - 1.0)**2)
+
+
+OBJECTIVES = {'nse': nse, 'kge': kge, 'lognse': lognse}
+
+
+def scores(qsim, qobs, objective='nse', warmup=0):
+    """
+    Score of each member of an ensemble: mean of the objective over the
+    outlets with observations (-inf for the failed members)
+    :param qsim: array (nmembers x nsteps x nsortie) of simulated discharges
+    :param qobs: array (nsteps x nsortie) of observed discharges
+    :param objective: 'nse', 'kge' or 'lognse'
+    :param warmup: number of first time steps left out (spin-up)
+    :return: 1D-array of nmembers scores (to be maximized)
+    """
+    qobs = np.asarray(qobs, dtype=float)[warmup:]
+    qobs = qobs.reshape(qobs.shape[0], -1)
+    # outlets without any observation after the warm-up are left out
+    observees = np.isfinite(qobs).any(axis=0)
+    if not observees.any():
+        raise ValueError('no observed discharge after the warm-up')
+    qsim = np.asarray(qsim)[:, warmup:]
+    qsim = qsim.reshape(qsim.shape[0], qsim.shape[1], -1)
+    valeurs = OBJECTIVES[objective](qsim[:, :, observees],
+                                    qobs[:, observees])
+    res = valeurs.mean(axis=-1)
+    res[~np.isfinite(res)] = -np.inf
+    return res
+
+
+def _sauve(fichier, etat, rng):
+    """ Population and random state written in a temporary file, then
+    renamed """
+    nom, keys, pos, has_gauss, cached = rng.get_state()
+    tmp = fichier + '.' + str(os.getpid()) + '.npz'
+    np.savez(tmp, rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+             rng_cached=cached, **etat)
+    replace_file(tmp, fichier)
+
+
+def _reprend(fichier, rng):
+    """ Population and random state of a previous calibration """
+    with np.load(fichier) as donnees:
+        etat = dict([(cle, donnees[cle]) for cle in donnees.files])
+    rng.set_state(('MT19937', etat.pop('rng_keys'), int(etat.pop('rng_pos')),
+                   int(etat.pop('rng_has_gauss')),
+                   float(etat.pop('rng_cached'))))
+    etat['generation'] = int(etat['generation'])
+    return etat
+
+
+def _verifie(etat, reference, fichier):
+    """ Bounds and objective of a resumed calibration """
+    for cle in sorted(reference):
+        if cle not in etat or \
+                not np.array_equal(etat[cle], reference[cle]):
+            raise ValueError('the calibration saved in ' + fichier +
+                             ' has a different ' + cle)
+
+
+def _matrices(vecteurs, lower, libres):
+    """ Parameter matrices of candidates (vectors of the free parameters) """
+    res = np.repeat(lower[np.newaxis], len(vecteurs), axis=0)
+    res[:, libres] = vecteurs
+    return res
+
+
+def _evalue(matparams, entrees, pool):
+    """ Scores of a batch of candidates """
+    temps, maillage, meteo, etat0, qobs, objective, warmup, tabinj = entrees
+    qsim = ensemble.run(temps, maillage, meteo, etat0, matparams, tabinj,
+                        pool=pool)['qsim']
+    return scores(qsim, qobs, objective, warmup)
+
+
+def calibrate(temps, maillage, meteo, etat0, qobs, lower, upper,
+              objective='nse', popsize=20, generations=100, mutation=0.7,
+              crossover=0.9, warmup=0, nprocs=None, checkpoint=None,
+              seed=None, tabinj=None):
+    """
+    Calibration by differential evolution (DE/rand/1/bin)
+    :param temps: dictionary with info on the computational times
+    :param maillage: dictionary of the hydrological mesh
+    :param meteo: weather arrays or (rep, nom_bv) (see ensemble.run)
+    :param etat0: array of the initial state
+    :param qobs: array (ndates-1 x nsortie) of observed discharges at the
+                 constrained cells, in the order of the cells (NaN for the
+                 missing values)
+    :param lower: array (nsbv x 49) of the lower bounds of the parameters
+    :param upper: array (nsbv x 49) of the upper bounds (a parameter with
+                  equal bounds is not calibrated)
+    :param objective: 'nse', 'kge' or 'lognse'
+    :param popsize: number of candidates of the population (at least 4)
+    :param generations: number of generations
+    :param mutation: differential weight
+    :param crossover: crossover probability
+    :param warmup: number of first time steps left out of the objective
+    :param nprocs: number of worker processes (serial computation if None)
+    :param checkpoint: optional '.npz' file of the population, written after
+                       each generation and read to resume a calibration
+                       (with the same bounds and objective)
+    :param seed: seed of the random numbers
+    :param tabinj: optional injections
+    :return: a dictionary with the best 'matparam', its 'score', the final
+             'population' (popsize x nsbv x 49) and its 'scores'
+    """
+    if popsize < 4:
+        raise ValueError('population of ' + str(popsize) + ' candidates: at '
+                         'least 4 are needed by the mutation')
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    libres = lower != upper
+    bas = lower[libres]
+    haut = upper[libres]
+    rng = np.random.RandomState(seed)
+    pool = None
+    if nprocs is not None and nprocs > 1:
+        pool = ensemble.create_pool(temps, maillage, meteo, etat0, tabinj,
+                                    nprocs)
+    elif isinstance(meteo, tuple):
+        # serial computation: weather files read once for all the generations
+        meteo = litficmeteo(meteo[0], temps, meteo[1])
+    entrees = (temps, maillage, meteo, etat0, qobs, objective, warmup, tabinj)
+    # the checkpoint is only resumed by the same calibration
+    reference = {'lower': lower, 'upper': upper,
+                 'objective': np.array(objective)}
+    try:
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            etat = _reprend(checkpoint, rng)
+            _verifie(etat, reference, checkpoint)
+        else:
+            population = bas + rng.rand(popsize, bas.size) * (haut - bas)
+            etat = {'population': population, 'generation': 0,
+                    'scores': _evalue(_matrices(population, lower, libres),
+                                      entrees, pool)}
+            if checkpoint is not None:
+                etat.update(reference)
+                _sauve(checkpoint, etat, rng)
+        population = etat['population']
+        notes = etat['scores']
+        n = len(population)
+        for generation in range(etat['generation'], generations):
+            # mutation from three other distinct candidates
+            autres = np.array([rng.choice(np.delete(np.arange(n), i), 3,
+                                          replace=False) for i in range(n)])
+            mutants = population[autres[:, 0]] + mutation * \
+                (population[autres[:, 1]] - population[autres[:, 2]])
+            # binomial crossover (at least one parameter of the mutant)
+            croise = rng.rand(n, bas.size) < crossover
+            croise[np.arange(n), rng.randint(bas.size, size=n)] = True
+            essais = np.clip(np.where(croise, mutants, population), bas, haut)
+            # selection
+            nouvelles = _evalue(_matrices(essais, lower, libres), entrees,
+                                pool)
+            meilleurs = nouvelles >= notes
+            population[meilleurs] = essais[meilleurs]
+            notes[meilleurs] = nouvelles[meilleurs]
+            if checkpoint is not None:
+                etat = {'population': population, 'scores': notes,
+                        'generation': generation + 1}
+                etat.update(reference)
+                _sauve(checkpoint, etat, rng)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    best = int(np.argmax(notes))
+    return {'matparam': _matrices(population[best:best+1], lower, libres)[0],
+            'score': notes[best],
+            'population': _matrices(population, lower, libres),
+            'scores': notes}
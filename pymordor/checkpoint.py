@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    Store of the states of the hydrological models (warm starts)
+
+    A checkpoint is the state of a model hm at a given date, saved in a
+    compressed '.npz' file of the folder '<repertoire>/<basin>/<hash>/',
+    where the hash identifies the set of parameters of the model. A model
+    can then be restarted from the nearest checkpoint instead of a whole
+    spin-up from the initial values.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import datetime
+import hashlib
+import numpy as np
+from pymordor.modelehydro import getdimmodele, getetatmodele, getdateetat,\
+    initmodele
+from pymordor.utils import replace_file
+
+FORMAT = '%Y%m%d%H%M%S'
+
+
+def parameter_hash(params):
+    """
+    Hash of a set of parameters
+    :param params: array of the parameters of the model (ex.: forc['matpmt'])
+    :return: a string of 16 hexadecimal characters
+    """
+    params = np.ascontiguousarray(params, dtype=np.float64)
+    empreinte = hashlib.sha1(str(params.shape).encode())
+    empreinte.update(params.tobytes())
+    return empreinte.hexdigest()[0:16]
+
+
+def _dossier(repertoire, bv, params):
+    """ Folder of the checkpoints of a basin and a set of parameters """
+    return os.path.join(repertoire, str(bv), parameter_hash(params))
+
+
+def save(hm, repertoire, bv, params):
+    """
+    Save the current state of the model hm
+    :param hm: id number of the hydrological model
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :return: the name of the file or None if the state is not available
+    """
+    etat = getetatmodele(hm)
+    date = getdateetat(hm)
+    if etat is None or date is None:
+        return None
+    dossier = _dossier(repertoire, bv, params)
+    if not os.path.isdir(dossier):
+        os.makedirs(dossier)
+    fichier = os.path.join(dossier, date.strftime(FORMAT) + '.npz')
+    # written in a temporary file, then renamed
+    tmp = fichier + '.' + str(os.getpid()) + '.npz'
+    np.savez_compressed(tmp, date=np.array(date.timetuple()[0:6]),
+                        etatproduction=etat['etatproduction'],
+                        etattransfert=etat['etattransfert'],
+                        bufferproduction=etat['bufferproduction'],
+                        qmoyen=etat['qmoyen'])
+    replace_file(tmp, fichier)
+    return fichier
+
+
+def dates(repertoire, bv, params):
+    """
+    Dates of the checkpoints of a basin and a set of parameters
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :return: sorted list of dates (datetime format)
+    """
+    dossier = _dossier(repertoire, bv, params)
+    if not os.path.isdir(dossier):
+        return []
+    res = []
+    for nom in os.listdir(dossier):
+        racine, ext = os.path.splitext(nom)
+        if ext != '.npz':
+            continue
+        try:
+            res.append(datetime.datetime.strptime(racine, FORMAT))
+        except ValueError:  # temporary or foreign file
+            continue
+    return sorted(res)
+
+
+def nearest(repertoire, bv, params, date):
+    """
+    Nearest checkpoint on or before a date
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :param date: date of the restart (datetime format)
+    :return: the date of the checkpoint or None if there is no checkpoint
+    """
+    avant = [d for d in dates(repertoire, bv, params) if d <= date]
+    if len(avant) == 0:
+        return None
+    return avant[-1]
+
+
+def load(repertoire, bv, params, date):
+    """
+    Read a checkpoint
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :param date: date of the checkpoint (datetime format)
+    :return: a dictionary of the state and its date
+    """
+    fichier = os.path.join(_dossier(repertoire, bv, params),
+                           date.strftime(FORMAT) + '.npz')
+    with np.load(fichier) as donnees:
+        etat = dict([(cle, donnees[cle]) for cle in donnees.files])
+    etat['date'] = datetime.datetime(*[int(v) for v in etat['date']])
+    return etat
+
+
+def restore(hm, repertoire, bv, params, date):
+    """
+    Initialization of the model hm from the nearest checkpoint on or before
+    a date. The mean discharges ('qmoyen') are saved but cannot be given
+    back to the library: they are computed again by the next run.
+    :param hm: id number of the hydrological model
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :param date: date of the restart (datetime format)
+    :return: the date of the restored state or None if there is no suitable
+             checkpoint (the run goes on from this date, see
+             hm_mordor.run_stream)
+    """
+    debut = nearest(repertoire, bv, params, date)
+    if debut is None:
+        return None
+    etat = load(repertoire, bv, params, debut)
+    # the checkpoint must fit the sizes of the model
+    dim_mod = getdimmodele(hm)
+    if etat['etatproduction'].shape[0] != 8 * dim_mod['nmailles'] or \
+            etat['etattransfert'].shape != (dim_mod['nmailles'],
+                                            dim_mod['nsortietransfert']) or \
+            etat['bufferproduction'].shape != (dim_mod['nbuffer'],
+                                               dim_mod['nmailles']):
+        return None
+    valeur = initmodele(hm, debut, etat['etatproduction'],
+                        etat['etattransfert'], etat['bufferproduction'])
+    if valeur != 0:
+        return None
+    return debut
+
+
+def purge(repertoire, bv, params, garder):
+    """
+    Remove the oldest checkpoints of a basin and a set of parameters
+    :param repertoire: root folder of the checkpoints
+    :param bv: name of the basin
+    :param params: array of the parameters of the model
+    :param garder: number of checkpoints to keep
+    :return: the number of removed checkpoints
+    """
+    anciennes = dates(repertoire, bv, params)
+    anciennes = anciennes[0:max(len(anciennes) - garder, 0)]
+    dossier = _dossier(repertoire, bv, params)
+    for date in anciennes:
+        os.remove(os.path.join(dossier, date.strftime(FORMAT) + '.npz'))
+    return len(anciennes)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    Index of the drainage network of a hydrological mesh
+
+    The index is built once from the topology of the mesh and answers the
+    upstream/downstream queries without scanning the whole mesh. Cells are
+    numbered from 1 as in the mesh files.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import numpy as np
+
+
+def build_index(maillage):
+    """
+    Drainage index of a mesh
+    :param maillage: dictionary of the hydrological mesh
+    :return: a dictionary with the downstream cell of each cell ('aval'),
+             the lists of upstream neighbours in CSR format ('indptr',
+             'fils'), a depth-first order of the cells ('ordre') and the
+             interval of each upstream area in this order ('debut',
+             'taille'), all with 0-based cell indices
+    """
+    nmailles = maillage['nmailles']
+    topo = np.asarray(maillage['topologie'][0:nmailles], dtype=np.intp)
+    aval = topo - 1
+    aval[(topo < 1) | (topo > nmailles)] = -1
+    # upstream neighbours of each cell (CSR, in increasing order)
+    draine = np.nonzero(aval >= 0)[0]
+    fils = draine[np.argsort(aval[draine], kind='mergesort')]
+    indptr = np.zeros(nmailles+1, dtype=np.intp)
+    np.cumsum(np.bincount(aval[draine], minlength=nmailles), out=indptr[1:])
+    # depth-first order from the outlets: the upstream area of a cell is
+    # a contiguous interval of this order
+    ordre = np.zeros(nmailles, dtype=np.intp)
+    debut = np.zeros(nmailles, dtype=np.intp)
+    k = 0
+    pile = list(np.nonzero(aval < 0)[0][::-1])
+    while len(pile) > 0:
+        c = pile.pop()
+        ordre[k] = c
+        debut[c] = k
+        k = k + 1
+        pile.extend(fils[indptr[c]:indptr[c+1]][::-1])
+    if k != nmailles:
+        raise ValueError('the topology of the mesh contains a loop')
+    # size of the upstream areas (cells processed from upstream)
+    taille = np.ones(nmailles, dtype=np.intp)
+    for c in ordre[::-1]:
+        if aval[c] >= 0:
+            taille[aval[c]] += taille[c]
+    return {'nmailles': nmailles, 'aval': aval, 'indptr': indptr,
+            'fils': fils, 'ordre': ordre, 'debut': debut, 'taille': taille}
+
+
+def mesh_index(maillage):
+    """
+    Drainage index of a mesh, kept in the mesh dictionary ('drainage') and
+    built again only if the topology changed
+    :param maillage: dictionary of the hydrological mesh
+    :return: the drainage index (see build_index)
+    """
+    nmailles = maillage['nmailles']
+    topo = np.asarray(maillage['topologie'][0:nmailles])
+    index = maillage.get('drainage')
+    if index is None or index['nmailles'] != nmailles or \
+            not np.array_equal(index['topologie'], topo):
+        index = build_index(maillage)
+        index['topologie'] = topo.copy()
+        maillage['drainage'] = index
+    return index
+
+
+def upstream(index, id_maille):
+    """
+    Upstream area of a cell
+    :param index: drainage index (see build_index)
+    :param id_maille: cell number
+    :return: 1D-array of cell numbers (the cell itself first)
+    """
+    c = id_maille - 1
+    return index['ordre'][index['debut'][c]:
+                          index['debut'][c]+index['taille'][c]] + 1
+
+
+def is_upstream(index, id_amont, id_maille):
+    """
+    Check if a cell is in the upstream area of another one
+    :param index: drainage index (see build_index)
+    :param id_amont: number of the cell to check (scalar or array)
+    :param id_maille: cell number
+    :return: True if id_amont drains into id_maille (or is id_maille)
+    """
+    c = id_maille - 1
+    pos = index['debut'][np.asarray(id_amont) - 1]
+    return (pos >= index['debut'][c]) & \
+        (pos < index['debut'][c] + index['taille'][c])
+
+
+def downstream(index, id_maille):
+    """
+    Path from a cell to its outlet
+    :param index: drainage index (see build_index)
+    :param id_maille: cell number
+    :return: 1D-array of cell numbers (the cell itself first)
+    """
+    chemin = [id_maille - 1]
+    while index['aval'][chemin[-1]] >= 0:
+        chemin.append(index['aval'][chemin[-1]])
+    return np.array(chemin) + 1
+
+
+def upstream_sum(index, valeurs):
+    """
+    Sum of values over the upstream area of every cell
+    (ex.: upstream surfaces from the surface of each cell)
+    :param index: drainage index (see build_index)
+    :param valeurs: 1D-array of one value per cell
+    :return: 1D-array of the sums
+    """
+    cumul = np.zeros(index['nmailles']+1)
+    np.cumsum(np.asarray(valeurs, dtype=float)[index['ordre']],
+              out=cumul[1:])
+    return cumul[index['debut'] + index['taille']] - cumul[index['debut']]
+
+
+def outlets(index, maillage):
+    """
+    Upstream areas of all the constrained cells of a mesh (gauges)
+    :param index: drainage index (see build_index)
+    :param maillage: dictionary of the hydrological mesh
+    :return: a dictionary {cell number: 1D-array of upstream cell numbers}
+    """
+    cellules = np.nonzero(np.asarray(maillage['contraintes']) > 0)[0] + 1
+    return dict([(int(c), upstream(index, c)) for c in cellules])
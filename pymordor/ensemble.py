@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+    Ensemble of runs of one basin over a stack of parameter sets
+
+    The members are distributed over a pool of processes. The inputs shared
+    by all the members (times, mesh, weather) are given to each process
+    once, when it starts, and kept for all its members.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import multiprocessing
+import numpy as np
+from pymordor import hf_mordor, hm_mordor
+from pymordor.litdonneesmodele import litficmeteo
+from pymordor.modelehydro import geterreur
+
+# inputs shared by the members computed by a process
+_CONTEXTE = {}
+
+
+def _initialise(temps, maillage, meteo, etat0, tabinj):
+    """
+    Inputs shared by the members of a process: the weather is either given
+    by its arrays or read by the process from a folder (rep, nom_bv)
+    """
+    if isinstance(meteo, tuple):
+        meteo = litficmeteo(meteo[0], temps, meteo[1])
+    _CONTEXTE.clear()
+    _CONTEXTE.update({'temps': temps, 'maillage': maillage, 'meteo': meteo,
+                      'etat0': etat0, 'tabinj': tabinj})
+
+
+def _membre(args):
+    """ Run of a member: its number, the discharges and an error message """
+    k, matparam = args
+    temps = _CONTEXTE['temps']
+    maillage = _CONTEXTE['maillage']
+    forc = None
+    hm = None
+    try:
+        forc = hf_mordor.create_multi(temps, maillage, _CONTEXTE['meteo'],
+                                      _CONTEXTE['etat0'], matparam,
+                                      _CONTEXTE['tabinj'])
+        if forc is None:
+            return k, None, 'creation of the inputs failed'
+        hm = hm_mordor.create(temps, maillage, forc)
+        if hm is None or hm < 0:
+            return k, None, 'creation of the model failed'
+        if hm_mordor.initialization(hm, temps, forc['matini']) != 0:
+            return k, None, 'initialization failed: ' + str(geterreur())
+        res = hm_mordor.run(hm, temps)
+        if res is None:
+            return k, None, 'run failed: ' + str(geterreur())
+        return k, res['qsim'], None
+    except Exception as err:
+        return k, None, str(err)
+    finally:
+        if hm is not None and hm >= 0:
+            hm_mordor.delete(hm)
+        if forc is not None:
+            hf_mordor.delete(forc['hf'])
+
+
+def create_pool(temps, maillage, meteo, etat0, tabinj=None, nprocs=None):
+    """
+    Pool of processes keeping the shared inputs, for several ensembles
+    (ex.: the generations of a calibration)
+    :param nprocs: number of worker processes (default: number of CPUs)
+    :return: the pool (to be closed by the caller)
+    """
+    return multiprocessing.Pool(nprocs, _initialise,
+                                (temps, maillage, meteo, etat0, tabinj))
+
+
+def run(temps, maillage, meteo, etat0, matparams, tabinj=None, nprocs=None,
+        pool=None):
+    """
+    Run the model for each set of parameters
+    :param temps: dictionary with info on the computational times
+    :param maillage: dictionary of the hydrological mesh
+    :param meteo: dictionary of the rain and temperature arrays, or a tuple
+                  (rep, nom_bv) of the weather files read by each process
+                  (see litficmeteo)
+    :param etat0: array of the initial state
+    :param matparams: array (nmembers x nsbv x 49) of parameters, one
+                      'matparam' of create_multi per member
+    :param tabinj: optional injections
+    :param nprocs: number of worker processes (serial computation if None)
+    :param pool: optional pool given by create_pool with the same inputs
+                 (nprocs is then ignored)
+    :return: a dictionary with the discharges 'qsim' (array of nmembers x
+             ndates-1 x nsortietransfert values, NaN for the failed members),
+             the list of the 'failed' members and their 'errors' (dictionary
+             of messages)
+    """
+    nmembres = len(matparams)
+    nsortie = int(np.count_nonzero(maillage['contraintes']))
+    qsim = np.full((nmembres, temps['ndates'] - 1, nsortie), np.nan)
+    erreurs = {}
+    taches = ((k, np.asarray(matparams[k])) for k in range(nmembres))
+    temporaire = None
+    if pool is None and nprocs is not None and nprocs > 1:
+        pool = temporaire = create_pool(temps, maillage, meteo, etat0, tabinj,
+                                        nprocs)
+    try:
+        if pool is None:
+            _initialise(temps, maillage, meteo, etat0, tabinj)
+            resultats = (_membre(tache) for tache in taches)
+        else:
+            resultats = pool.imap_unordered(_membre, taches)
+        # the discharges of each member are stored as soon as they arrive
+        for k, q, erreur in resultats:
+            if erreur is None:
+                qsim[k] = q
+            else:
+                erreurs[k] = erreur
+    finally:
+        if pool is None:
+            # inputs of the serial run released
+            _CONTEXTE.clear()
+        if temporaire is not None:
+            temporaire.close()
+            temporaire.join()
+    return {'qsim': qsim, 'failed': sorted(erreurs), 'errors': erreurs}
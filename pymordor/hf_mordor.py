@@ -7,44 +7,20 @@
     Copyright EDF 2016-2018
 
 """
-import sys
-import os
-from ctypes import *
+import datetime
 import numpy as np
 from pymordor.modelehydro import creerbaseforcage, detruireforcage,\
         remplirsiteforcage
-from pymordor.mordorglobal import prepparam, initialisation
-from pymordor.utils import calcidjour
-
-LIBMORDOR = os.environ.get('LIBMORDOR')
-
-if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'/libRunMordorTS.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.so. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'/libWrapperModeleHydro.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.so. Check the environmental variable LIBMORDOR.')
-elif sys.platform.startswith('win'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'\\libRunMordorTS.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.dll. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'\\libWrapperModeleHydro.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.dll. Check the environmental variable LIBMORDOR.')
-else:
-    raise Exception(u'unsupported OS')
-
-
-def create(temps, maillage, meteo, etat0, param, tabinj=None):
+from pymordor.mordorglobal import creertampons, prepbatch, NPMT, NSTOCK,\
+    TMAX
+from pymordor.utils import timeaxis
+
+# number of days recomputed before a new window of inputs (TPN)
+OVERLAP = 366
+
+
+def create(temps, maillage, meteo, etat0, param, tabinj=None, nprocs=None,
+           fortran=False, capacite=None, cache=None, pool=None):
     """
     Instantiation of new inputs
     :param temps: dictionary with info on the computational times
@@ -52,95 +28,26 @@ def create(temps, maillage, meteo, etat0, param, tabinj=None):
     :param meteo: array for rain and temperature values
     :param etat0: array of the initial state
     :param param: array of hydrological parameters
+    :param nprocs: number of processes for the preparation of the cells
+                   (serial preparation if None)
+    :param pool: optional pool of processes of the caller for the
+                 preparation of the cells (see mordorglobal.prepbatch)
+    :param fortran: if True, matpmt and matini are stored in column-major
+                    order, the layout used by the library (no copy when
+                    creating and initializing the model)
+    :param capacite: total number of time steps of the inputs, including
+                     the ones appended later with update (default: ndates)
+    :param cache: optional cache of the preparation of the cells (see
+                  prepcache.PrepCache)
     """
-    carameteo = np.zeros((maillage['nmailles'], 4))
-    carameteo[:, 0:3] = maillage['descripteurs'][:, 0:3]
-    hf = creerbaseforcage('forcage', maillage['nmailles'], carameteo,
-                          maillage['nmailles'], carameteo, maillage['nqinj'],
-                          temps['ndates'], temps['date1'], temps['dt'])
-    if hf < 0:
-        return None
-    nech = etat0[0]
-    id_jour = calcidjour(temps['date1'], temps['date2'], temps['txunit'])
-    matini = np.zeros((8, maillage['nbandes']*10))
-    i = 0
-    p = meteo['rain'][0: temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmin = meteo['tmin'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmax = meteo['tmax'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmoy = (tmin+tmax) * 0.5
-    idj = np.asarray(id_jour['id_days'])
-    don = np.hstack((idj, np.zeros((temps['ndates'], 1)),
-                     p, tmoy, np.zeros((temps['ndates'], 1))))
-    etage = np.zeros((3, maillage['nbandes']))
-    etage[0, :] = 1./maillage['nbandes']
-    etage[1, :] = maillage['altitudes'][0]
+    params = np.tile(np.ravel(param), (maillage['nmailles'], 1))
+    return _create(temps, maillage, meteo, etat0, params, tabinj, nprocs,
+                   fortran, capacite, cache, pool)
 
-    # Preparation des parametres Mordor global
-    param[3] = maillage['descripteurs'][i, 3]
-    param[5] = maillage['descripteurs'][i, 2]
-    param[6] = maillage['descripteurs'][i, 4]
-    # prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-    #                  don, temps['ndates'],
-    #                  np.hstack((temps['ndates']+nech, etat0[0:9])))
-    prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-                     don, temps['ndates'],
-                     np.hstack((temps['ndates']+nech, etat0[1:9]))) # #AP# 20181221
-
-    # Initialisation Mordor global
-    matpmt = prep['pmt2']
-    iniglob = initialisation(prep['pmt2'], tmin, tmax, prep['cond2'])
-
-    matkc = iniglob['prep_kc'].reshape(366, 1)
-    matini = iniglob['etat_ini']
-    iniglob['tpn'] = iniglob['tpn'][0:temps['ndates'], ]
-
-    # remplissage de la base de forcage hf
-    val = remplirsiteforcage(hf, 1, i+1, temps['ndates'], p)
-    val = remplirsiteforcage(hf, 3, i+1, temps['ndates'], tmin)
-    val = remplirsiteforcage(hf, 4, i+1, temps['ndates'], tmax)
-    val = remplirsiteforcage(hf, 6, i+1, temps['ndates'], iniglob['tpn'])
-
-    if maillage['nmailles'] > 1:
-        for i in range(1, maillage['nmailles']):
-            p = meteo['rain'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-            tmin = meteo['tmin'][0:temps['ndates'], i]\
-                .reshape(temps['ndates'], 1)
-            tmax = meteo['tmax'][0:temps['ndates'], i]\
-                .reshape(temps['ndates'], 1)
-            tmoy = (tmin+tmax) * 0.5
-            don = np.hstack((idj, np.zeros((temps['ndates'], 1)), p, tmoy,
-                             np.zeros((temps['ndates'], 1))))
-            etage[1, :] = maillage['altitudes'][i]
-            param[3] = maillage['descripteurs'][i, 3]
-            param[5] = maillage['descripteurs'][i, 2]
-            param[6] = maillage['descripteurs'][i, 4]
-            # prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-            #                  don, temps['ndates'],
-            #                  np.hstack((temps['ndates']+nech, etat0[0:9])))
-            prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-                             don, temps['ndates'],
-                             np.hstack((temps['ndates']+nech, etat0[1:9]))) # #AP# 20181221
-            matpmt = np.vstack((matpmt, prep['pmt2']))
-            iniglob = initialisation(prep['pmt2'], tmin, tmax, prep['cond2'])
-            iniglob['tpn'] = iniglob['tpn'][0:temps['ndates'], ]
-            matkc = np.hstack((matkc, iniglob['prep_kc'].reshape(366, 1)))
-            matini = np.vstack((matini, iniglob['etat_ini']))
-            val = remplirsiteforcage(hf, 1, i+1, temps['ndates'], p)
-            val = remplirsiteforcage(hf, 3, i+1, temps['ndates'], tmin)
-            val = remplirsiteforcage(hf, 4, i+1, temps['ndates'], tmax)
-            val = remplirsiteforcage(hf, 6, i+1, temps['ndates'],
-                                     iniglob['tpn'])
-
-    if maillage['nqinj'] > 0:
-        for i in range(0, maillage['nqinj']):
-            val = remplirsiteforcage(hf, 5, i+1, temps['ndates'], tabinj)
 
-    forc = {'hf': hf, 'prep': prep, 'matpmt': matpmt,
-            'matkc': matkc, 'matini': matini}
-    return forc
-
-
-def create_multi(temps, maillage, meteo, etat0, matparam, tabinj=None):
+def create_multi(temps, maillage, meteo, etat0, matparam, tabinj=None,
+                 nprocs=None, fortran=False, capacite=None, cache=None,
+                 pool=None):
     """
     Instantiation of new inputs
     :param temps: dictionary with info on the computational times
@@ -148,97 +55,234 @@ def create_multi(temps, maillage, meteo, etat0, matparam, tabinj=None):
     :param meteo: array for rain and temperature values
     :param etat0: array of the initial state
     :param matparam: array of hydrological parameters
+    :param nprocs: number of processes for the preparation of the cells
+                   (serial preparation if None)
+    :param pool: optional pool of processes of the caller for the
+                 preparation of the cells (see mordorglobal.prepbatch)
+    :param fortran: if True, matpmt and matini are stored in column-major
+                    order, the layout used by the library (no copy when
+                    creating and initializing the model)
+    :param capacite: total number of time steps of the inputs, including
+                     the ones appended later with update (default: ndates)
+    :param cache: optional cache of the preparation of the cells (see
+                  prepcache.PrepCache): only the cells whose inputs changed
+                  are computed
     """
-    carameteo = np.zeros((maillage['nmailles'], 4))
+    params = matparam[np.asarray(maillage['sbv']) - 1, :]
+    return _create(temps, maillage, meteo, etat0, params, tabinj, nprocs,
+                   fortran, capacite, cache, pool)
+
+
+def _create(temps, maillage, meteo, etat0, params, tabinj, nprocs=None,
+            fortran=False, capacite=None, cache=None, pool=None):
+    """
+    Instantiation of new inputs with one row of parameters per cell
+    """
+    nmailles = maillage['nmailles']
+    axe = timeaxis(temps)
+    ndates = axe['ndates']
+    if capacite is not None and capacite < ndates:
+        raise ValueError('capacity of ' + str(capacite) +
+                         ' time steps lower than ' + str(ndates))
+    carameteo = np.zeros((nmailles, 4))
     carameteo[:, 0:3] = maillage['descripteurs'][:, 0:3]
-    hf = creerbaseforcage('forcage', maillage['nmailles'],
-                          carameteo, maillage['nmailles'],
+    hf = creerbaseforcage('forcage', nmailles, carameteo, nmailles,
                           carameteo, maillage['nqinj'],
-                          temps['ndates'], temps['date1'], temps['dt'])
+                          ndates if capacite is None else capacite,
+                          axe.tmdebut, axe['dt'])
     if hf < 0:
         return None
     nech = etat0[0]
-    id_jour = calcidjour(temps['date1'], temps['date2'], temps['txunit'])
-    matini = np.zeros((8, maillage['nbandes']*10))
-    i = 0
-    p = meteo['rain'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmin = meteo['tmin'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmax = meteo['tmax'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-    tmoy = (tmin+tmax) * 0.5
-    idj = np.asarray(id_jour['id_days'])
-    don = np.hstack((idj, np.zeros((temps['ndates'], 1)), p,
-                     tmoy, np.zeros((temps['ndates'], 1))))
-    etage = np.zeros((3, maillage['nbandes']))
-    etage[0, :] = 1./maillage['nbandes']
-    etage[1, :] = maillage['altitudes'][0]
+    if capacite is None:
+        # slices of the inputs of the caller, released once copied to hf
+        series = {}
+        for nom in ('rain', 'tmin', 'tmax'):
+            series[nom] = np.asarray(meteo[nom], dtype=float)[0:ndates]
+        series['tpn'] = np.zeros((nmailles, ndates))
+        if tabinj is not None:
+            series['tabinj'] = np.ravel(tabinj)[0:ndates]
+    else:
+        # series sized for the whole capacity, kept for the updates
+        series = _series(capacite, nmailles, tabinj is not None)
+        for nom in ('rain', 'tmin', 'tmax'):
+            series[nom][0:ndates] = meteo[nom][0:ndates, :]
+        if tabinj is not None:
+            series['tabinj'][0:ndates] = np.ravel(tabinj)[0:ndates]
+    rain = series['rain'][0:ndates]
+    tmin = series['tmin'][0:ndates]
+    tmax = series['tmax'][0:ndates]
 
     # Preparation des parametres Mordor global
-    param = matparam[maillage['sbv'][i]-1, :]
-    param[3] = maillage['descripteurs'][i, 3]
-    param[5] = maillage['descripteurs'][i, 2]
-    param[6] = maillage['descripteurs'][i, 4]
-    # prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-    #                  don, temps['ndates'],
-    #                  np.hstack((temps['ndates']+nech, etat0[0:9])))
-    prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-                     don, temps['ndates'],
-                     np.hstack((temps['ndates']+nech, etat0[1:9]))) # #AP# 20181221
-
-    # Initialisation Mordor global
-    matpmt = prep['pmt2']
-    iniglob = initialisation(prep['pmt2'], tmin, tmax, prep['cond2'])
-
-    matkc = iniglob['prep_kc'].reshape(366, 1)
-    matini = iniglob['etat_ini']
-    iniglob['tpn'] = iniglob['tpn'][0:temps['ndates'], ]
+    params = np.array(params, dtype=float)
+    params[:, 3] = maillage['descripteurs'][:, 3]
+    params[:, 5] = maillage['descripteurs'][:, 2]
+    params[:, 6] = maillage['descripteurs'][:, 4]
+    cond = np.hstack((ndates+nech, etat0[1:9]))  # #AP# 20181221
+
+    # Matrices of the model sized once and filled in place
+    order = 'F' if fortran else 'C'
+    matpmt = np.zeros((nmailles, NPMT), order=order)
+    matkc = np.zeros((366, nmailles), order='F')
+    matini = np.zeros((nmailles*8, NSTOCK), order=order)
+    if fortran:
+        etat_ini = matini.reshape((8, nmailles, NSTOCK), order='F')\
+            .transpose((1, 0, 2))
+    else:
+        etat_ini = matini.reshape((nmailles, 8, NSTOCK))
+    sortie = {'pmt2': matpmt, 'prep_kc': matkc.transpose(),
+              'etat_ini': etat_ini, 'tpn': series['tpn'][:, 0:ndates]}
+
+    # Preparation et initialisation Mordor global de toutes les mailles
+    tampons = creertampons(maillage['nbandes'], ndates)
+    res = prepbatch(params, maillage['altitudes'], axe.yday,
+                    rain, tmin, tmax, cond, tampons, nprocs, sortie, cache,
+                    pool)
 
     # remplissage de la base de forcage hf
-    val = remplirsiteforcage(hf, 1, i+1, temps['ndates'], p)
-    val = remplirsiteforcage(hf, 3, i+1, temps['ndates'], tmin)
-    val = remplirsiteforcage(hf, 4, i+1, temps['ndates'], tmax)
-    val = remplirsiteforcage(hf, 6, i+1, temps['ndates'], iniglob['tpn'])
-
-    if maillage['nmailles'] > 1:
-        for i in range(1, maillage['nmailles']):
-            p = meteo['rain'][0:temps['ndates'], i].reshape(temps['ndates'], 1)
-            tmin = meteo['tmin'][0:temps['ndates'], i]\
-                .reshape(temps['ndates'], 1)
-            tmax = meteo['tmax'][0:temps['ndates'], i]\
-                .reshape(temps['ndates'], 1)
-            tmoy = (tmin+tmax) * 0.5
-            don = np.hstack((idj, np.zeros((temps['ndates'], 1)), p,
-                             tmoy, np.zeros((temps['ndates'], 1))))
-            etage[1, :] = maillage['altitudes'][i]
-            param = matparam[maillage['sbv'][i]-1, :]
-            param[3] = maillage['descripteurs'][i, 3]
-            param[5] = maillage['descripteurs'][i, 2]
-            param[6] = maillage['descripteurs'][i, 4]
-            # prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-            #                  don, temps['ndates'],
-            #                  np.hstack((temps['ndates']+nech, etat0[0:9])))
-            prep = prepparam(param, etage.transpose(), maillage['nbandes'],
-                             don, temps['ndates'],
-                             np.hstack((temps['ndates']+nech, etat0[1:9])))  # #AP# 20181221
-            matpmt = np.vstack((matpmt, prep['pmt2']))
-            iniglob = initialisation(prep['pmt2'], tmin, tmax, prep['cond2'])
-            iniglob['tpn'] = iniglob['tpn'][0:temps['ndates'], ]
-            matkc = np.hstack((matkc, iniglob['prep_kc'].reshape(366, 1)))
-            matini = np.vstack((matini, iniglob['etat_ini']))
-            val = remplirsiteforcage(hf, 1, i+1, temps['ndates'], p)
-            val = remplirsiteforcage(hf, 3, i+1, temps['ndates'], tmin)
-            val = remplirsiteforcage(hf, 4, i+1, temps['ndates'], tmax)
-            val = remplirsiteforcage(hf, 6, i+1, temps['ndates'],
-                                     iniglob['tpn'])
-
-    if maillage['nqinj'] > 0:
-        for i in range(0, maillage['nqinj']):
-            val = remplirsiteforcage(hf, 5, i+1, temps['ndates'], tabinj)
+    _remplir(hf, series, nmailles, maillage['nqinj'], 0, ndates)
 
+    # preparation of the last cell
+    prep = {'flag': res['flag'][-1], 'pmt2': res['pmt2'][-1],
+            'don2': tampons['don2'].reshape(10, TMAX).transpose(),
+            'cond2': res['cond2'][-1]}
     forc = {'hf': hf, 'prep': prep, 'matpmt': matpmt,
-            'matkc': matkc, 'matini': matini}
+            'matkc': matkc, 'matini': matini,
+            'ndates': ndates, 'dt': axe['dt'], 'nqinj': maillage['nqinj']}
+    if capacite is not None:
+        # state of the inputs for the updates
+        forc.update({'capacite': capacite, 'date1': axe['date1'],
+                     'series': series, 'params': params,
+                     'altitudes': maillage['altitudes'],
+                     'etat0': np.array(etat0, dtype=float),
+                     'tampons': None})
     return forc
 
 
+def _series(capacite, nmailles, injections):
+    """ Series of the inputs allocated for the whole capacity """
+    series = {}
+    for nom in ('rain', 'tmin', 'tmax'):
+        series[nom] = np.zeros((capacite, nmailles))
+    series['tpn'] = np.zeros((nmailles, capacite))
+    if injections:
+        series['tabinj'] = np.zeros(capacite)
+    return series
+
+
+def _remplir(hf, series, nmailles, nqinj, debut, fin):
+    """
+    Copy of the series to the sites of hf, for all the cells and from the
+    first time step to 'fin' (the library fills a site from its first time
+    step), if time steps were added after 'debut'
+    """
+    if fin <= debut:
+        return
+    for i in range(0, nmailles):
+        remplirsiteforcage(hf, 1, i+1, fin, series['rain'][0:fin, i])
+        remplirsiteforcage(hf, 3, i+1, fin, series['tmin'][0:fin, i])
+        remplirsiteforcage(hf, 4, i+1, fin, series['tmax'][0:fin, i])
+        remplirsiteforcage(hf, 6, i+1, fin, series['tpn'][i, 0:fin])
+
+    if nqinj > 0:
+        for i in range(0, nqinj):
+            remplirsiteforcage(hf, 5, i+1, fin, series['tabinj'][0:fin])
+
+
+def update(forc, meteo, tabinj=None, overlap=OVERLAP):
+    """
+    Append new time steps to the inputs of hf (real-time operation)
+    The inputs must have been created with a capacity (see create). The
+    preparation of the cells is computed again on a window starting
+    'overlap' days before the new time steps, with the conditions of this
+    window, and only the TPN of the new time steps is kept: it is the one
+    of a full computation (create) when the window starts at the first
+    time step. The parameters, Kc and initial states of the creation are
+    kept. The model can then go on from its current state (see
+    hm_mordor.run_stream).
+    Each update sends again all the series of hf from their first time
+    step (the library fills a site from its first time step): its cost
+    grows with the total number of time steps, not with the new ones.
+    :param forc: dictionary of the inputs (see create)
+    :param meteo: arrays (nnew x ncells) of the new rain and temperatures
+    :param tabinj: new values of the injections (if any)
+    :param overlap: number of days of the preparation before the new
+                    time steps
+    :return: the new number of time steps
+    """
+    if forc.get('series') is None:
+        raise ValueError('inputs created without a capacity')
+    series = forc['series']
+    nmailles = series['rain'].shape[1]
+    nouvelles = {}
+    for nom in ('rain', 'tmin', 'tmax'):
+        nouvelles[nom] = np.asarray(meteo[nom], dtype=float)
+        if nouvelles[nom].ndim != 2 or \
+                nouvelles[nom].shape[1] != nmailles:
+            raise ValueError('wrong shape for ' + nom + ': ' +
+                             str(nouvelles[nom].shape) + ' instead of (n, ' +
+                             str(nmailles) + ')')
+    nnew = nouvelles['rain'].shape[0]
+    if nouvelles['tmin'].shape[0] != nnew or \
+            nouvelles['tmax'].shape[0] != nnew:
+        raise ValueError('different numbers of time steps for the rain and '
+                         'the temperatures')
+    if 'tabinj' in series:
+        if tabinj is None or np.size(tabinj) < nnew:
+            raise ValueError(str(nnew) + ' values of injections expected')
+    debut = forc['ndates']
+    fin = debut + nnew
+    if fin > forc['capacite']:
+        raise ValueError('capacity of ' + str(forc['capacite']) +
+                         ' time steps exceeded: ' + str(fin))
+    d0 = max(0, debut - overlap * 86400 // forc['dt'])
+    npas = fin - d0
+    if npas > TMAX:
+        raise ValueError('window of ' + str(npas) +
+                         ' time steps larger than ' + str(TMAX))
+    for nom in ('rain', 'tmin', 'tmax'):
+        series[nom][debut:fin] = nouvelles[nom]
+    if 'tabinj' in series:
+        series['tabinj'][debut:fin] = np.ravel(tabinj)[0:nnew]
+
+    # preparation of the window d0:fin with its own conditions
+    dt = forc['dt']
+    date1 = forc['date1'] + datetime.timedelta(seconds=d0 * dt)
+    axe = timeaxis({'date1': date1, 'ndates': npas, 'dt': dt,
+                    'date2': date1 + datetime.timedelta(
+                        seconds=(npas - 1) * dt)})
+    cond = np.hstack((npas + forc['etat0'][0], forc['etat0'][1:9]))
+    tampons = forc['tampons']
+    if tampons is None or tampons['npas'] < npas:
+        tampons = creertampons(forc['altitudes'].shape[1], npas)
+        forc['tampons'] = tampons
+    res = prepbatch(forc['params'], forc['altitudes'], axe.yday,
+                    series['rain'][d0:fin], series['tmin'][d0:fin],
+                    series['tmax'][d0:fin], cond, tampons)
+    series['tpn'][:, debut:fin] = res['tpn'][:, debut-d0:]
+
+    # copy to hf
+    _remplir(forc['hf'], series, nmailles, forc['nqinj'], debut, fin)
+    forc['ndates'] = fin
+    return fin
+
+
+def compact(forc):
+    """
+    Compact storage of the identical Kc columns of the cells: forc['matkc']
+    becomes a dictionary of the distinct columns ('colonnes', 366 x nkc)
+    and of the column of each cell ('index'), expanded only when the model
+    is created
+    :param forc: dictionary of the inputs
+    :return: the number of distinct columns
+    """
+    if isinstance(forc['matkc'], dict):
+        return forc['matkc']['colonnes'].shape[1]
+    colonnes, index = np.unique(forc['matkc'], axis=1, return_inverse=True)
+    forc['matkc'] = {'colonnes': np.asfortranarray(colonnes),
+                     'index': np.ravel(index)}
+    return colonnes.shape[1]
+
+
 def delete(hf):
     """
     Free the memory associated with the instance number hf
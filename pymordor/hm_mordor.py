@@ -7,88 +7,28 @@
     Copyright EDF 2016-2018
 
 """
-import sys
 import os
-from ctypes import *
+import datetime
 import numpy as np
 from pymordor.modelehydro import getdimmodele, getetatmodele, creermodele,\
-                            initmodele, detruiremodele
-
-LIBMORDOR = os.environ.get('LIBMORDOR')
-
-if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'/libRunMordorTS.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.so. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'/libWrapperModeleHydro.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.so. Check the environmental variable LIBMORDOR.')
-elif sys.platform.startswith('win'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'\\libRunMordorTS.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.dll. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'\\libWrapperModeleHydro.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.dll. Check the environmental variable LIBMORDOR.')
-else:
-    raise Exception(u'unsupported OS')
+                            initmodele, detruiremodele, getdateetat, geterreur
+from pymordor.marshaling import ints, tmfin
+from pymordor.libraries import Library
+from pymordor.utils import TimeAxis
+from pymordor import weights
 
+# library loaded on first use (prototypes declared in the registry)
+MY_LIBRARY = Library('WrapperModeleHydro')
 
-def runintercept(hm, temps, idmaille, idinter):
-    """
-    Run the model and get info on the states
-    :param hm: id number of the hydrological model
-    :param temps: dictionary with info on the computational times
-    :param idmaille: list of cells for the interceptions
-    :param idinter: list interception numbers
-    :return: a dictionary of interceptions
-    """
-    # get model sizes
-    dim_mod = getdimmodele(hm)
-    nmailinter_c = c_int(len(idmaille))
-    nintercept_c = c_int(len(idinter))
-    idmaille_c = (c_int * len(idmaille))(*idmaille)
-    idinter_c = (c_int * len(idinter))(*idinter)
-    hm_c = c_int(hm)
-    # get time info
-    tfin = temps['date2']
-    tm = np.zeros((9, 1))
-    tm[0] = tfin.timetuple().tm_sec
-    tm[1] = tfin.timetuple().tm_min
-    tm[2] = tfin.timetuple().tm_hour
-    tm[3] = tfin.timetuple().tm_mday
-    tm[4] = tfin.timetuple().tm_mon - 1
-    tm[5] = tfin.timetuple().tm_year - 1850
-    tm[6] = tfin.timetuple().tm_wday + 1
-    tm[7] = tfin.timetuple().tm_yday - 1
-    tm[8] = tfin.timetuple().tm_isdst
-    if temps['dt'] == 86400:
-        tm[2] = 23
-    elif temps['dt'] == 3600:
-        tm[1] = 59
-    tm_c = (c_double * 9)(*tm)
-    # discharges
-    sizetab = dim_mod['nsortietransfert'] * (temps['ndates'] - 1)
-    qsim_c = (c_double * sizetab)(0.0)
-    # interceptions
-    sizetab = len(idmaille) * len(idinter) * (temps['ndates'] - 1)
-    intercept_c = (c_double * sizetab)(0.0)
-    # calling the library
-    valeur = MY_LIBRARY.hmRunMordorIntercept(hm_c, byref(tm_c), nmailinter_c,
-                                             byref(idmaille_c), nintercept_c,
-                                             byref(idinter_c),
-                                             byref(qsim_c), byref(intercept_c))
-    if valeur != 0:
-        return None
-    # --> state
+# names of the interception variables
+INTERCEPTS = ["U", "L", "Z", "N", "sn", "sns", "tft", "tst", "Preciptot.",
+              "Tmin", "Tmax", "Tpn", "ruiss", "neige", "pluie", "accu",
+              "lglace", "lfonte", "frl", "er", "ep", "fneige", "rsurf",
+              "rvers", "rbase", "echNR", "emax", "Production"]
+
+
+def _state(hm, dim_mod):
+    """ Current state of the model hm """
     etat = getetatmodele(hm)
     state = {}
     state['etatproduction'] = \
@@ -110,19 +50,143 @@ def runintercept(hm, temps, idmaille, idinter):
                                           dim_mod['nmailles'])
     state['qmoyen'] = etat['qmoyen'][0:dim_mod['nsortietransfert']]
     state['qmoyen'] = np.asarray(state['qmoyen'])
-    # --> qsim
-    qsim = np.array(qsim_c)
-    qsim = qsim.reshape(temps['ndates'] - 1, dim_mod['nsortietransfert'])
+    return state
+
+
+def _tmdebut(temps):
+    """ Date of the beginning of the computation (as a 'tm' structure for a
+    TimeAxis) """
+    if isinstance(temps, TimeAxis):
+        return temps.tmdebut
+    return temps['date1']
+
+
+def _tmfin(temps):
+    """ 'tm' structure of the end of the computation """
+    if isinstance(temps, TimeAxis):
+        return temps.tmfin.copy()
+    return tmfin(temps['date2'], temps['dt'])
+
+
+def _windows(hm, temps, chunk):
+    """
+    Time windows of at most chunk time steps, from the date of the current
+    state of the model hm to the end of the computation
+    """
+    courant = getdateetat(hm)
+    if courant is None:
+        raise RuntimeError('no state for the model ' + str(hm) + ': ' +
+                           str(geterreur()))
+    # state at the end of a time step (ex.: 23:00 for a daily step), the
+    # windows start at the beginning of this time step
+    reste = (courant - temps['date1']).total_seconds() % temps['dt']
+    courant = courant - datetime.timedelta(seconds=reste)
+    pas = datetime.timedelta(seconds=temps['dt'])
+    while courant < temps['date2']:
+        fin = min(courant + chunk * pas, temps['date2'])
+        nsteps = int(round((fin - courant).total_seconds() / temps['dt']))
+        yield courant, fin, nsteps
+        courant = fin
+
+
+def runintercept_memmap(hm, temps, idmaille, idinter, repertoire, chunk):
+    """
+    Run the model and write the interceptions in memory-mapped files,
+    one window of time steps at a time
+    :param hm: id number of the hydrological model
+    :param temps: dictionary with info on the computational times
+    :param idmaille: list of cells for the interceptions
+    :param idinter: list interception numbers
+    :param repertoire: folder of the files (one '<name>.npy' per variable)
+    :param chunk: number of time steps of a window
+    :return: a dictionary of interceptions (read-only memory-mapped arrays
+             of nsteps x len(idmaille) values); a failed window raises
+             RuntimeError and the files are removed
+    """
+    # get model sizes
+    dim_mod = getdimmodele(hm)
+    nmailinter = len(idmaille)
+    nintercept = len(idinter)
+    idmaille_c = ints(idmaille)
+    idinter_c = ints(idinter)
+    fenetres = list(_windows(hm, temps, chunk))
+    nsteps = sum([fenetre[2] for fenetre in fenetres])
+    # one file per variable
+    if not os.path.isdir(repertoire):
+        os.makedirs(repertoire)
+    fichiers = {}
+    cartes = {}
+    for nom in INTERCEPTS[0:nintercept]:
+        fichiers[nom] = os.path.join(repertoire, nom + '.npy')
+        cartes[nom] = np.lib.format.open_memmap(fichiers[nom], mode='w+',
+                                                shape=(nsteps, nmailinter))
+    # discharges
+    qsim = np.zeros((nsteps, dim_mod['nsortietransfert']))
+    # interceptions of a window
+    inter = np.zeros((chunk, nmailinter * nintercept))
+    k = 0
+    for courant, fin, n in fenetres:
+        tm_c = tmfin(fin, temps['dt'])
+        # calling the library
+        valeur = MY_LIBRARY.hmRunMordorIntercept(hm, tm_c, nmailinter,
+                                                 idmaille_c, nintercept,
+                                                 idinter_c,
+                                                 qsim[k:k+n].reshape(-1),
+                                                 inter[0:n].reshape(-1))
+        if valeur != 0:
+            erreur = geterreur()
+            # partial files removed
+            cartes.clear()
+            for fichier in fichiers.values():
+                os.remove(fichier)
+            raise RuntimeError('run of the model ' + str(hm) + ' failed at ' +
+                               str(courant) + ': ' + str(erreur))
+        for i in range(0, nintercept):
+            cartes[INTERCEPTS[i]][k:k+n] = \
+                inter[0:n, i*nmailinter:(i+1)*nmailinter]
+        k = k + n
+    # --> intercept
+    intercept = {}
+    for nom in cartes:
+        cartes[nom].flush()
+        intercept[nom] = np.load(fichiers[nom], mmap_mode='r')
+    return{'qsim': qsim, 'state': _state(hm, dim_mod),
+           'intercept': intercept}
+
+
+def runintercept(hm, temps, idmaille, idinter):
+    """
+    Run the model and get info on the states
+    :param hm: id number of the hydrological model
+    :param temps: dictionary with info on the computational times
+    :param idmaille: list of cells for the interceptions
+    :param idinter: list interception numbers
+    :return: a dictionary of interceptions
+    """
+    # get model sizes
+    dim_mod = getdimmodele(hm)
+    idmaille_c = ints(idmaille)
+    idinter_c = ints(idinter)
+    # get time info
+    tm_c = _tmfin(temps)
+    # discharges
+    qsim = np.zeros((temps['ndates'] - 1, dim_mod['nsortietransfert']))
+    # interceptions
+    inter = np.zeros((temps['ndates'] - 1, len(idmaille) * len(idinter)))
+    # calling the library
+    valeur = MY_LIBRARY.hmRunMordorIntercept(hm, tm_c, len(idmaille),
+                                             idmaille_c, len(idinter),
+                                             idinter_c, qsim.reshape(-1),
+                                             inter.reshape(-1))
+    if valeur != 0:
+        return None
+    # --> state
+    state = _state(hm, dim_mod)
     # --> intercept
-    inter = np.array(intercept_c)
-    inter = inter.reshape(temps['ndates'] - 1, len(idmaille) * len(idinter))
-    lnames = ["U", "L", "Z", "N", "sn", "sns", "tft", "tst", "Preciptot.",
-              "Tmin", "Tmax", "Tpn", "ruiss", "neige", "pluie", "accu",
-              "lglace", "lfonte", "frl", "er", "ep", "fneige", "rsurf",
-              "rvers", "rbase", "echNR", "emax", "Production"]
     intercept = {}
     for i in range(0, len(idinter)):
-        intercept[lnames[i]] = inter[:, i*len(idmaille):(i+1)*len(idmaille)]
+        intercept[INTERCEPTS[i]] = \
+            inter[:, i*len(idmaille):(i+1)*len(idmaille)]
     return{'qsim': qsim, 'state': state, 'intercept': intercept}
 
 
@@ -135,43 +199,85 @@ def run(hm, temps):
     """
     # get model sizes
     dim_mod = getdimmodele(hm)
-    hm_c = c_int(hm)
     # get time info
-    tfin = temps['date2']
-    tm = np.zeros((9, 1))
-    tm[0] = tfin.timetuple().tm_sec
-    tm[1] = tfin.timetuple().tm_min
-    tm[2] = tfin.timetuple().tm_hour
-    tm[3] = tfin.timetuple().tm_mday
-    tm[4] = tfin.timetuple().tm_mon - 1
-    tm[5] = tfin.timetuple().tm_year - 1850
-    tm[6] = tfin.timetuple().tm_wday + 1
-    tm[7] = tfin.timetuple().tm_yday - 1
-    tm[8] = tfin.timetuple().tm_isdst
-    if temps['dt'] == 86400:
-        tm[2] = 23
-    elif temps['dt'] == 3600:
-        tm[1] = 59
-    tm_c = (c_double * 9)(*tm)
-    # discharges
-    sizetab = dim_mod['nsortietransfert'] * (temps['ndates'] - 1)
-    qsim_c = (c_double * sizetab)(0.0)
+    tm_c = _tmfin(temps)
+    # discharges (written by the library in the numpy array)
+    qsim = np.zeros((temps['ndates'] - 1, dim_mod['nsortietransfert']))
     # calling the library
-    valeur = MY_LIBRARY.hmRunMordor(hm_c, byref(tm_c), byref(qsim_c))
+    valeur = MY_LIBRARY.hmRunMordor(hm, tm_c, qsim.reshape(-1))
     if valeur != 0:
         return None
-    # --> qsim
-    qsim = np.array(qsim_c)
-    qsim = qsim.reshape(temps['ndates'] - 1, dim_mod['nsortietransfert'])
     return{'qsim': qsim}
 
 
-def create(temps, maillage, forc, inflow=None):
+def run_stream(hm, temps, chunk):
+    """
+    Run the model window by window, from the date of its current state
+    to the end of the computation
+    :param hm: id number of the hydrological model
+    :param temps: dictionary with info on the computational times
+    :param chunk: number of time steps of a window
+    :return: a generator of the discharges of each window (array of
+             nsteps x nsortietransfert values, nsteps <= chunk)
+    """
+    # get model sizes
+    dim_mod = getdimmodele(hm)
+    for courant, fin, nsteps in _windows(hm, temps, chunk):
+        tm_c = tmfin(fin, temps['dt'])
+        qsim = np.zeros((nsteps, dim_mod['nsortietransfert']))
+        # calling the library
+        valeur = MY_LIBRARY.hmRunMordor(hm, tm_c, qsim.reshape(-1))
+        if valeur != 0:
+            raise RuntimeError('run of the model ' + str(hm) + ' failed at ' +
+                               str(courant) + ': ' + str(geterreur()))
+        yield qsim
+
+
+def runintercept_stream(hm, temps, idmaille, idinter, chunk):
+    """
+    Run the model and get the interceptions window by window, from the date
+    of its current state to the end of the computation
+    :param hm: id number of the hydrological model
+    :param temps: dictionary with info on the computational times
+    :param idmaille: list of cells for the interceptions
+    :param idinter: list interception numbers
+    :param chunk: number of time steps of a window
+    :return: a generator of the discharges and the interceptions of each
+             window (dictionary with 'qsim' and 'intercept')
+    """
+    # get model sizes
+    dim_mod = getdimmodele(hm)
+    nmailinter = len(idmaille)
+    nintercept = len(idinter)
+    idmaille_c = ints(idmaille)
+    idinter_c = ints(idinter)
+    for courant, fin, nsteps in _windows(hm, temps, chunk):
+        tm_c = tmfin(fin, temps['dt'])
+        qsim = np.zeros((nsteps, dim_mod['nsortietransfert']))
+        inter = np.zeros((nsteps, nmailinter * nintercept))
+        # calling the library
+        valeur = MY_LIBRARY.hmRunMordorIntercept(hm, tm_c, nmailinter,
+                                                 idmaille_c, nintercept,
+                                                 idinter_c, qsim.reshape(-1),
+                                                 inter.reshape(-1))
+        if valeur != 0:
+            raise RuntimeError('run of the model ' + str(hm) + ' failed at ' +
+                               str(courant) + ': ' + str(geterreur()))
+        intercept = {}
+        for i in range(0, nintercept):
+            intercept[INTERCEPTS[i]] = \
+                inter[:, i*nmailinter:(i+1)*nmailinter]
+        yield {'qsim': qsim, 'intercept': intercept}
+
+
+def create(temps, maillage, forc, inflow=None, compact=False):
     """
     Instantiation of a new hm model
     :param temps: dictionary with info on the computational times
     :param maillage: dictionary of the hydrological mesh
     :param forc: dictionary of associated inputs
+    :param compact: if True, the cells with identical parameters share one
+                    set of parameters of the library
     :return: a new id number for the instantiation
     """
     if np.sum(forc['matpmt'][:, 34] == 0) > 0:  # null velocity detected
@@ -179,11 +285,15 @@ def create(temps, maillage, forc, inflow=None):
     ptc = np.nonzero(maillage['contraintes'])
     cnt = np.vstack((maillage['contraintes'][ptc], ptc[0]+1))
     maillessortiestransfert = ptc[0]+1
-    jeumaille = np.asarray(list(range(1, maillage['nmailles']+1)))
+    if compact:
+        matpmt, jeumaille = np.unique(forc['matpmt'], axis=0,
+                                      return_inverse=True)
+        jeumaille = np.ravel(jeumaille) + 1
+    else:
+        matpmt = forc['matpmt']
+        jeumaille = np.asarray(list(range(1, maillage['nmailles']+1)))
     injectionmaille = np.zeros((maillage['nmailles'], 2))
-    wt = np.zeros((maillage['nmailles'], maillage['nmailles']))
-    np.fill_diagonal(wt, 1)
-    wt = np.vstack((wt, np.zeros((1, maillage['nmailles']))))
+    wt = weights.identity(maillage['nmailles'] + 1, maillage['nmailles'])
     wp = wt
     ndescript = 7
     nsortietransfert = cnt.shape[1]
@@ -193,7 +303,7 @@ def create(temps, maillage, forc, inflow=None):
     hm = creermodele("modele", maillage['nmailles'], maillage['topologie'],
                      ndescript, maillage['descripteurs'], temps['dt'],
                      nsortietransfert, maillessortiestransfert,
-                     nparametres, forc['matpmt'].shape[0], forc['matpmt'],
+                     nparametres, matpmt.shape[0], matpmt,
                      jeumaille, forc['hf'], dimwp, dimwt, wp, wt,
                      injectionmaille, forc['matkc'])
     return hm
@@ -213,8 +323,8 @@ def initialization(hm, temps, matini):
                                   dim_mod['nsortietransfert']))
     bufferproductionzero = np.zeros((dim_mod['nbuffer'], dim_mod['nmailles']))
     # call the init method
-    valeur = initmodele(hm, temps['date1'], matini, etattransfertzero,
-                        bufferproductionzero)
+    valeur = initmodele(hm, _tmdebut(temps), matini,
+                        etattransfertzero, bufferproductionzero)
     return valeur
 
 
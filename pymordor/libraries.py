@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+    Registry of the dynamic libraries of MORDOR-TS
+
+    Each library is loaded on first use (from the folder given by the
+    environment variable LIBMORDOR), only once per process, and the
+    prototype of each function is declared on its first use: a function
+    missing from an older build of a library fails only when it is called.
+
+    Thread safety: the runs of different models (hmRunMordor,
+    hmRunMordorIntercept, RunMordor) work on their own handle and can be
+    made by concurrent threads (ctypes releases the GIL during the call).
+    The other functions are called by one thread at a time (see CALLS):
+    they share the error message of the library (GetErreur) or use
+    Fortran units (LitDonneesModele). The functions which modify the
+    tables of handles (creation and deletion of models and inputs) also
+    wait for the end of the runs in progress, and no run starts before
+    their end (see TABLES: shared by the runs, exclusive for the changes of
+    the tables). If a build of the library is not reentrant at all,
+    serialize(True) makes every call wait for the previous one.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import sys
+import os
+import threading
+import contextlib
+from ctypes import CDLL, POINTER, c_char, c_char_p, c_int, c_double
+from pymordor.marshaling import DOUBLE_PTR, INT_PTR, INT_REF, DOUBLE_REF
+
+# libraries to load before a given library
+DEPENDANCES = {'WrapperModeleHydro': ['RunMordorTS']}
+
+# prototypes of the functions: {library: {function: (argtypes, restype)}}
+PROTOTYPES = {
+    'MordorGlobal': {
+        'mordor_prep_param': ([DOUBLE_PTR, DOUBLE_PTR, DOUBLE_PTR,
+                               DOUBLE_PTR, INT_PTR, DOUBLE_PTR, DOUBLE_PTR,
+                               DOUBLE_PTR], c_int),
+        'mordor_initialisation': ([DOUBLE_PTR, DOUBLE_PTR, DOUBLE_PTR,
+                                   DOUBLE_PTR, INT_PTR, DOUBLE_PTR,
+                                   DOUBLE_PTR, DOUBLE_PTR], c_int)},
+    'WrapperModeleHydro': {
+        'CreerBaseForcage': ([c_char_p, c_int, DOUBLE_PTR, c_int, DOUBLE_PTR,
+                              c_int, c_int, DOUBLE_PTR, c_double], c_int),
+        'RemplirSiteForcage': ([c_int, c_int, c_int, c_int, DOUBLE_PTR],
+                               c_int),
+        'CreerModele': ([c_char_p, c_int, INT_PTR, c_int, DOUBLE_PTR,
+                         c_double, c_int, INT_PTR, c_int, c_int, DOUBLE_PTR,
+                         INT_PTR, c_int, c_int, c_int, DOUBLE_PTR,
+                         DOUBLE_PTR, INT_PTR, DOUBLE_PTR], c_int),
+        'GetDimModele': ([c_int, INT_REF, INT_REF, INT_REF, DOUBLE_REF],
+                         c_int),
+        'InitModele': ([c_int, DOUBLE_PTR, DOUBLE_PTR, c_int, c_int,
+                        DOUBLE_PTR, c_int, c_int, DOUBLE_PTR, c_int, c_int],
+                       c_int),
+        'RunMordor': ([c_int, DOUBLE_PTR], c_int),
+        'GetIntercept': ([c_int, c_int, POINTER(DOUBLE_REF)], c_int),
+        'R_GetEtatModele': ([c_int, DOUBLE_PTR, DOUBLE_PTR, DOUBLE_PTR,
+                             DOUBLE_PTR], c_int),
+        'GetDateEtat': ([c_int, DOUBLE_PTR], c_int),
+        'GetErreur': ([], POINTER(c_char)),
+        'VersionModele': ([], POINTER(c_char)),
+        'DetruireModele': ([c_int], c_int),
+        'DetruireForcage': ([c_int], c_int),
+        'mktime_': ([DOUBLE_PTR], c_int),
+        'hmRunMordorIntercept': ([c_int, DOUBLE_PTR, c_int, INT_PTR, c_int,
+                                  INT_PTR, DOUBLE_PTR, DOUBLE_PTR], c_int),
+        'hmRunMordor': ([c_int, DOUBLE_PTR, DOUBLE_PTR], c_int)},
+    'LitDonneesModele': {
+        'lit_postes': ([POINTER(c_int), c_char_p, POINTER(c_int),
+                        POINTER(c_double), POINTER(c_char), POINTER(c_char)],
+                       None),
+        'lit_maillage_bandes': ([POINTER(c_int), c_char_p, POINTER(c_int),
+                                 POINTER(c_int), POINTER(c_int),
+                                 POINTER(c_double), POINTER(c_int),
+                                 POINTER(c_double)], None),
+        'lit_contraintes': ([POINTER(c_int), c_char_p, POINTER(c_int),
+                             POINTER(c_double), POINTER(c_char),
+                             POINTER(c_char), POINTER(c_char)], None)}}
+
+# functions that can be called by concurrent threads (different handles)
+REENTRANT = {'WrapperModeleHydro': frozenset(['hmRunMordor',
+                                              'hmRunMordorIntercept',
+                                              'RunMordor'])}
+
+# functions that modify the tables of handles of a library
+MUTATIONS = {'WrapperModeleHydro': frozenset(['CreerModele', 'DetruireModele',
+                                              'CreerBaseForcage',
+                                              'DetruireForcage'])}
+
+_CHARGEES = {}
+_DECLAREES = set()
+_VERROU = threading.RLock()
+# lock of the calls which are not reentrant
+CALLS = threading.RLock()
+_SERIALISE = [False]
+
+
+class SharedLock(object):
+    """
+    Lock held by several threads at once (shared) or by one thread only
+    (exclusive); a thread waiting for the exclusive lock goes before the
+    new shared ones
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.partages = 0
+        self.exclusif = False
+        self.attentes = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        """ Shared lock in a 'with' block """
+        with self.condition:
+            while self.exclusif or self.attentes > 0:
+                self.condition.wait()
+            self.partages += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.partages -= 1
+                if self.partages == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """ Exclusive lock in a 'with' block """
+        with self.condition:
+            self.attentes += 1
+            try:
+                while self.exclusif or self.partages > 0:
+                    self.condition.wait()
+            finally:
+                self.attentes -= 1
+            self.exclusif = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusif = False
+                self.condition.notify_all()
+
+
+# lock of the tables of handles: shared by the calls, exclusive for the
+# functions of MUTATIONS (always taken after CALLS)
+TABLES = SharedLock()
+
+
+def chemin(nom):
+    """
+    Full name of a library
+    :param nom: name of the library without prefix and extension
+                (ex.: 'MordorGlobal')
+    :return: the path of the file
+    """
+    if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
+        fichier = 'lib' + nom + '.so'
+        separateur = '/'
+    elif sys.platform.startswith('win'):
+        fichier = 'lib' + nom + '.dll'
+        separateur = '\\'
+    else:
+        raise Exception(u'unsupported OS')
+    libmordor = os.environ.get('LIBMORDOR')
+    if libmordor is None:
+        raise Exception('unable to load the dynamic library: ' + fichier +
+                        '. Check the environmental variable LIBMORDOR.')
+    return libmordor + separateur + fichier
+
+
+def load(nom):
+    """
+    Library of the registry, loaded on first use
+    :param nom: name of the library without prefix and extension
+    :return: the library (CDLL)
+    """
+    lib = _CHARGEES.get(nom)
+    if lib is not None:
+        return lib
+    with _VERROU:
+        if nom not in _CHARGEES:
+            for dependance in DEPENDANCES.get(nom, []):
+                load(dependance)
+            fichier = chemin(nom)
+            try:
+                lib = CDLL(fichier)
+            except Exception:
+                raise Exception('unable to load the dynamic library: ' +
+                                os.path.basename(fichier) + '. Check the '
+                                'environmental variable LIBMORDOR.')
+            _CHARGEES[nom] = lib
+        return _CHARGEES[nom]
+
+
+def function(nom, fonction):
+    """
+    Function of a library of the registry, with its prototype declared on
+    first use
+    :param nom: name of the library without prefix and extension
+    :param fonction: name of the function
+    :return: the function (AttributeError if the library does not have it)
+    """
+    lib = load(nom)
+    if (nom, fonction) not in _DECLAREES:
+        with _VERROU:
+            if (nom, fonction) not in _DECLAREES:
+                cfonction = getattr(lib, fonction)
+                if fonction in PROTOTYPES.get(nom, {}):
+                    cfonction.argtypes, cfonction.restype = \
+                        PROTOTYPES[nom][fonction]
+                _DECLAREES.add((nom, fonction))
+    return getattr(lib, fonction)
+
+
+def serialize(actif=True):
+    """
+    Serialized fallback: all the calls to the libraries, including the runs,
+    are made by one thread at a time
+    :param actif: True to serialize all the calls, False to serialize only
+                  the ones which are not reentrant
+    """
+    _SERIALISE[0] = actif
+
+
+def _protegee(fonction, serialisee, exclusive):
+    """ Call of a function under the locks CALLS (if serialized) and
+    TABLES """
+    verrou = TABLES.exclusive if exclusive else TABLES.shared
+
+    def appel(*args):
+        if serialisee:
+            with CALLS:
+                with verrou():
+                    return fonction(*args)
+        with verrou():
+            return fonction(*args)
+    return appel
+
+
+class Library(object):
+    """
+    Handle of a library of the registry: the library is loaded when one of
+    its functions is used for the first time
+    """
+
+    def __init__(self, nom):
+        self.nom = nom
+
+    def __getattr__(self, fonction):
+        if fonction.startswith('__'):
+            raise AttributeError(fonction)
+        cfonction = function(self.nom, fonction)
+        serialisee = _SERIALISE[0] or \
+            fonction not in REENTRANT.get(self.nom, frozenset())
+        return _protegee(cfonction, serialisee,
+                         fonction in MUTATIONS.get(self.nom, frozenset()))
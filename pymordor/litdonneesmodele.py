@@ -7,42 +7,111 @@
     Copyright EDF 2016-2018
 
 """
-import sys
 import os
+import json
+import datetime
+import hashlib
+import itertools
+import threading
 from ctypes import *
 import numpy as np
+from multiprocessing.pool import ThreadPool
+from pymordor.utils import timeaxis, replace_file
+from pymordor.libraries import Library
 
 MAXPOSTES = 1500
 MAXCARREAU = 2000
 MAXCONTRAINTES = 1500
 LENSTR = 200
-LIBMORDOR = os.environ.get('LIBMORDOR')
-
-if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'/libLitDonneesModele.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libLitDonneesModele.so. Check the environmental variable LIBMORDOR.')
-elif sys.platform.startswith('win'):
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'\\libLitDonneesModele.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libLitDonneesModele.dll. Check the environmental variable LIBMORDOR.')
-else:
-    raise Exception(u'unsupported OS')
-
-
-def litpostes(postfile):
+# Fortran units given to the readers of the library
+UNITE_MIN = 10
+UNITE_MAX = 1000000
+# dates of the index of the binary weather files
+FORMAT = '%Y-%m-%dT%H:%M:%S'
+# library loaded on first use (prototypes declared in the registry)
+MY_LIBRARY = Library('LitDonneesModele')
+
+_UNITES = itertools.count(UNITE_MIN)
+_VERROU_UNITES = threading.Lock()
+
+
+def _unite():
+    """ Fortran unit of a new file: a different number for each call, so
+    that concurrent readers never share a unit """
+    with _VERROU_UNITES:
+        return UNITE_MIN + (next(_UNITES) - UNITE_MIN) % \
+            (UNITE_MAX - UNITE_MIN)
+
+
+def _empreinte(nature, fichier):
+    """ Hash of the content of a file """
+    empreinte = hashlib.sha1(nature.encode())
+    with open(fichier, 'rb') as fic:
+        for bloc in iter(lambda: fic.read(1 << 20), b''):
+            empreinte.update(bloc)
+    return empreinte.hexdigest()
+
+
+def _avec_cache(nature, fichier, cache, lecture, scalaires, listes):
+    """
+    Reading of a data file through a cache of binary files ('.npz' format)
+    :param nature: kind of data ('postes', 'maillage', 'contraintes')
+    :param fichier: the name of the data file
+    :param cache: the folder of the cache (no cache if None)
+    :param lecture: function reading the data file
+    :param scalaires: keys of the integer values of the dictionary
+    :param listes: keys of the lists of strings of the dictionary
+    :return: the dictionary given by the function 'lecture'
+    """
+    if cache is None or not os.path.isfile(fichier):
+        return lecture(fichier)
+    chemin = os.path.join(cache, nature + '_' + _empreinte(nature, fichier) +
+                          '.npz')
+    if os.path.isfile(chemin):
+        with np.load(chemin) as donnees:
+            res = {}
+            for nom in donnees.files:
+                if nom in scalaires:
+                    res[nom] = int(donnees[nom])
+                elif nom in listes:
+                    res[nom] = [str(val) for val in donnees[nom]]
+                else:
+                    res[nom] = donnees[nom]
+        return res
+    res = lecture(fichier)
+    if res is not None:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        tableaux = {}
+        for nom in res:
+            if nom in listes:
+                tableaux[nom] = np.array(res[nom], dtype=np.str_)
+            else:
+                tableaux[nom] = np.asarray(res[nom])
+        tmp = chemin + '.' + str(os.getpid())
+        with open(tmp, 'wb') as fic:
+            np.savez(fic, **tableaux)
+        replace_file(tmp, chemin)
+    return res
+
+
+def litpostes(postfile, cache=None):
     """
     Read all the data files (rain and weather)
     :param postfile: the name (string char) of the file defining the positions
+    :param cache: optional folder of a cache of the files already read
+                  (keyed on the content of the file)
     :return: a dictionary of information on the positions
     """
+    return _avec_cache('postes', postfile, cache, _litpostes,
+                       ['npostes'], ['nompostes', 'fichpostes'])
+
+
+def _litpostes(postfile):
+    """ Read all the data files with the library """
     # Data preparation in ctype format
     if os.path.isfile(postfile):
-        u_c = c_int(np.random.randint(10, 1000000))
+        u_c = c_int(_unite())
         adresse_c = c_char_p(postfile.encode())
         npostes_c = c_int()
         sizetab = 4 * MAXPOSTES
@@ -52,8 +121,7 @@ def litpostes(postfile):
         fichpostes_c = (c_char * sizetab)()
         # Calling the library
         MY_LIBRARY.lit_postes(byref(u_c), adresse_c, byref(npostes_c),
-                              byref(carapostes_c), byref(nompostes_c),
-                              byref(fichpostes_c))
+                              carapostes_c, nompostes_c, fichpostes_c)
         # Return values in standard types
         npostes = npostes_c.value
         car = np.array(carapostes_c)
@@ -75,16 +143,24 @@ def litpostes(postfile):
         return None
 
 
-def litmaillage(meshfile):
+def litmaillage(meshfile, cache=None):
     """
     Read the mesh of the watershed (Carreau format)
     :param meshfile: the name (string char) of the file defining
                         the hydrological mesh
+    :param cache: optional folder of a cache of the files already read
+                  (keyed on the content of the file)
     :return: a dictionary of information on the mesh
     """
+    return _avec_cache('maillage', meshfile, cache, _litmaillage,
+                       ['nmailles', 'nbandes'], [])
+
+
+def _litmaillage(meshfile):
+    """ Read the mesh of the watershed with the library """
     if os.path.isfile(meshfile):
         # Data preparation in ctype format
-        u_c = c_int(np.random.randint(10, 1000000))
+        u_c = c_int(_unite())
         adresse_c = c_char_p(meshfile.encode())
         nmailles_c = c_int()
         nbandes_c = c_int()
@@ -97,9 +173,8 @@ def litmaillage(meshfile):
         # Calling the library
         MY_LIBRARY.lit_maillage_bandes(byref(u_c), adresse_c,
                                        byref(nmailles_c), byref(nbandes_c),
-                                       byref(topologie_c),
-                                       byref(descripteurs_c),
-                                       byref(contraintes_c), byref(alt_c))
+                                       topologie_c, descripteurs_c,
+                                       contraintes_c, alt_c)
         # Return values in standard types
         nmailles = nmailles_c.value
         nbandes = nbandes_c.value
@@ -113,14 +188,10 @@ def litmaillage(meshfile):
         alt = np.array(alt_c)
         alti = alt.reshape(10, MAXCARREAU).transpose()
         altit = alti[0:nmailles, 0:nbandes]
-        nval = np.sum(cont > 0)
-        cntr = np.zeros((nval, 2))
-        k = 0
-        for i in range(nmailles):
-            if cont[i] > 0:
-                cntr[k, 0] = i+1
-                cntr[k, 1] = cont[i]
-                k = k + 1
+        ind = np.nonzero(cont > 0)[0]
+        cntr = np.zeros((ind.size, 2))
+        cntr[:, 0] = ind + 1
+        cntr[:, 1] = cont[ind]
         return {'nmailles': nmailles, 'nbandes': nbandes, 'topologie': topo,
                 'descripteurs': descr,
                 'contraintes': cont, 'altitudes': altit, 'cntr': cntr}
@@ -128,15 +199,23 @@ def litmaillage(meshfile):
         return None
 
 
-def litcontraintes(confile):
+def litcontraintes(confile, cache=None):
     """
     Read a list of constraints on the points of a mesh
     :param confile: the name (string char) of the file defining the constraints
+    :param cache: optional folder of a cache of the files already read
+                  (keyed on the content of the file)
     :return: a dictionary of information on the constraints
     """
+    return _avec_cache('contraintes', confile, cache, _litcontraintes,
+                       ['ncontraintes'], ['typec', 'noms', 'fichiers'])
+
+
+def _litcontraintes(confile):
+    """ Read a list of constraints with the library """
     if os.path.isfile(confile):
         # Data preparation in ctype format
-        u_c = c_int(np.random.randint(10, 1000000))
+        u_c = c_int(_unite())
         adresse_c = c_char_p(confile.encode())
         ncontraintes_c = c_int()
         sizetab = MAXCONTRAINTES * 2
@@ -148,9 +227,8 @@ def litcontraintes(confile):
         fichiers_c = (c_char * sizetab)()
         # calling the library
         MY_LIBRARY.lit_contraintes(byref(u_c), adresse_c,
-                                   byref(ncontraintes_c),
-                                   byref(xy_c), byref(typec_c),
-                                   byref(noms_c), byref(fichiers_c))
+                                   byref(ncontraintes_c), xy_c, typec_c,
+                                   noms_c, fichiers_c)
         # Return values in standard types
         ncontraintes = ncontraintes_c.value
         xy_ = np.array(xy_c)
@@ -177,14 +255,169 @@ def litcontraintes(confile):
         return None
 
 
-def litficmeteo(rep, temps, nom_bv):
+def convertmeteo(source, cible, annee=None, dt=None):
+    """
+    Conversion of a yearly weather file into a binary array
+    :param source: the name of the text file (one column per cell)
+    :param cible: the name of the binary file ('.npy' format)
+    :param annee: optional year of the file (first row on the 1st of
+                  January at 0h)
+    :param dt: optional time step of the rows in seconds (with annee, the
+               dates of the first and last rows are stored in the index)
+    :return: the index of the binary file (dictionary)
+    """
+    valeurs = np.loadtxt(source, ndmin=2)
+    info = os.stat(source)
+    index = {'source': os.path.abspath(source), 'mtime': info.st_mtime,
+             'size': info.st_size, 'rows': valeurs.shape[0],
+             'cells': valeurs.shape[1]}
+    if annee is not None and dt is not None:
+        debut = datetime.datetime(annee, 1, 1)
+        fin = debut + datetime.timedelta(seconds=dt*(valeurs.shape[0]-1))
+        index.update({'dt': dt, 'date1': debut.strftime(FORMAT),
+                      'date2': fin.strftime(FORMAT)})
+    repertoire = os.path.dirname(cible)
+    if repertoire and not os.path.isdir(repertoire):
+        os.makedirs(repertoire)
+    # writing in temporary files first (concurrent readers)
+    tmp = cible + '.' + str(os.getpid())
+    with open(tmp, 'wb') as fic:
+        np.save(fic, np.ascontiguousarray(valeurs))
+    replace_file(tmp, cible)
+    with open(tmp, 'w') as fic:
+        json.dump(index, fic)
+    replace_file(tmp, cible + '.json')
+    return index
+
+
+def _meteobinaire(source, cache, annee, dt, derniere):
+    """
+    Memory-mapped array of a yearly weather file, from the cache
+    (the binary file is created or updated when needed)
+    :param derniere: last date read in the file
+    """
+    # the name of the binary file depends on the full path of the source
+    # and on the time step
+    source = os.path.abspath(source)
+    empreinte = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    cible = os.path.join(cache, os.path.basename(os.path.dirname(source)),
+                         os.path.basename(source)[:-4] + '_' + empreinte +
+                         '_' + str(dt) + '.npy')
+    info = os.stat(source)
+    index = None
+    if os.path.isfile(cible + '.json') and os.path.isfile(cible):
+        with open(cible + '.json') as fic:
+            index = json.load(fic)
+        # source modified or not covering the period
+        if index.get('source') != source or \
+                index['mtime'] != info.st_mtime or \
+                index['size'] != info.st_size or \
+                index.get('dt') != dt or \
+                index.get('date1') != datetime.datetime(annee, 1, 1)\
+                .strftime(FORMAT) or \
+                index['date2'] < derniere.strftime(FORMAT):
+            index = None
+    if index is None:
+        convertmeteo(source, cible, annee, dt)
+    return np.load(cible, mmap_mode='r')
+
+
+def _segments(temps):
+    """
+    Parts of the yearly files covering [date1, date2]: list of
+    (year, first row, number of rows)
+    """
+    return timeaxis(temps).segments
+
+
+def _verifie(tab, n, fichier):
+    """ Check of the number of rows read in a weather file """
+    if tab.shape[0] < n:
+        raise ValueError('missing values in ' + fichier + ': ' +
+                         str(tab.shape[0]) + ' rows instead of ' + str(n))
+
+
+def _litcache(radical, temps, cache):
+    """
+    Values of a weather variable for [date1, date2] from the binary cache
+    """
+    valeurs = None
+    k = 0
+    for annee, debut, n in _segments(temps):
+        fichier = radical + "_" + str(annee) + ".txt"
+        derniere = datetime.datetime(annee, 1, 1) + \
+            datetime.timedelta(seconds=temps['dt']*(debut+n-1))
+        tab = _meteobinaire(fichier, cache, annee, temps['dt'], derniere)
+        if valeurs is None:
+            valeurs = np.zeros((temps["ndates"], tab.shape[1]))
+        _verifie(tab[debut:debut+n], n, fichier)
+        valeurs[k:k+n] = tab[debut:debut+n]
+        k = k + n
+    return valeurs
+
+
+def _littexte(args):
+    """ Parsing of the useful rows of a yearly weather file """
+    fichier, debut, n = args
+    tab = np.loadtxt(fichier, skiprows=debut, max_rows=n, ndmin=2)
+    _verifie(tab, n, fichier)
+    return tab
+
+
+def _littextes(radicaux, temps, nthreads):
+    """
+    Values of weather variables for [date1, date2] from the text files
+    :param radicaux: list of the radicals of the file names (a file common
+                     to several variables is read only once)
+    :param temps: a dictionary concerning the calculation times
+    :param nthreads: number of threads parsing the files
+    :return: list of arrays (one per radical)
+    """
+    segments = _segments(temps)
+    taches = []
+    for radical in radicaux:
+        for annee, debut, n in segments:
+            tache = (radical + "_" + str(annee) + ".txt", debut, n)
+            if tache not in taches:
+                taches.append(tache)
+    if nthreads is not None and nthreads > 1 and len(taches) > 1:
+        pool = ThreadPool(min(nthreads, len(taches)))
+        try:
+            tableaux = pool.map(_littexte, taches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tableaux = [_littexte(tache) for tache in taches]
+    lus = dict(zip(taches, tableaux))
+    # preallocated results
+    resultats = []
+    for radical in radicaux:
+        valeurs = None
+        k = 0
+        for annee, debut, n in segments:
+            tab = lus[(radical + "_" + str(annee) + ".txt", debut, n)]
+            if valeurs is None:
+                valeurs = np.zeros((temps["ndates"], tab.shape[1]))
+            valeurs[k:k+n] = tab
+            k = k + n
+        resultats.append(valeurs)
+    return resultats
+
+
+def litficmeteo(rep, temps, nom_bv, cache=None, nthreads=None):
     """
     Read weather information from files
     :param rep: the folder where are located the files of the weather
     :param temps: a dictionary concerning the calculation times
     :param nom_bv: name of the watershed
+    :param cache: optional folder of a binary cache of the weather files:
+                  the values are then read without text parsing (except for
+                  new or modified files)
+    :param nthreads: number of threads parsing the text files (serial
+                     reading if None)
     :return: a dictionary containing values for the rain and the temperatures
-                for all the period
+                for all the period [date1, date2]
     """
     # Folders and filenames
     reprain = rep + "/Meteo/Precip/"
@@ -200,24 +433,17 @@ def litficmeteo(rep, temps, nom_bv):
     radtmin = reptmin + "Forcage_carreau_" + nom_bv
     radtmax = reptmax + "Forcage_carreau_" + nom_bv
     # Read files
-    a1 = temps["date1"].year
-    a2 = temps["date2"].year
-    id_d = temps["date1"].timetuple().tm_yday
-    id_f = id_d + temps["ndates"]
-    filerain = radrain + "_" + str(a1) + ".txt"
-    # rain = np.loadtxt(filerain) #AP# 20180724
-    rain = np.loadtxt(filerain,skiprows=id_d-1)
-    filetmin = radtmin + "_" + str(a1) + ".txt"
-    #tmin = np.loadtxt(filetmin) #AP# 20180724
-    tmin = np.loadtxt(filetmin,skiprows=id_d-1)
-    filetmax = radtmax + "_" + str(a1) + ".txt"
-    #tmax = np.loadtxt(filetmax) #AP# 20180724
-    tmax = np.loadtxt(filetmax,skiprows=id_d-1)
-    for i in list(range(a1+1, a2+1)):
-        filerain = radrain + "_" + str(i) + ".txt"
-        rain = np.vstack((rain, np.loadtxt(filerain)))
-        filetmin = radtmin + "_" + str(i) + ".txt"
-        tmin = np.vstack((tmin, np.loadtxt(filetmin)))
-        filetmax = radtmax + "_" + str(i) + ".txt"
-        tmax = np.vstack((tmax, np.loadtxt(filetmax)))
+    if cache is not None:
+        rain = _litcache(radrain, temps, cache)
+        tmin = _litcache(radtmin, temps, cache)
+        if radtmax == radtmin:
+            tmax = tmin.copy()
+        else:
+            tmax = _litcache(radtmax, temps, cache)
+    elif radtmax == radtmin:
+        rain, tmin = _littextes([radrain, radtmin], temps, nthreads)
+        tmax = tmin.copy()
+    else:
+        rain, tmin, tmax = _littextes([radrain, radtmin, radtmax], temps,
+                                      nthreads)
     return {'rain': rain, 'tmin': tmin, 'tmax': tmax}
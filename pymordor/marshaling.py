@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    NumPy <-> ctypes marshaling for the MORDOR-TS libraries
+
+    Arrays are handed to the Fortran code by pointer: the helpers below only
+    make sure that the buffers are contiguous, in the expected order and of
+    the expected type, copying them only when this is not already the case.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+from ctypes import c_int, c_double, POINTER
+import numpy as np
+
+# pointer types used in the 'argtypes' declarations of the libraries
+DOUBLE_PTR = np.ctypeslib.ndpointer(dtype=np.float64, ndim=1,
+                                    flags='C_CONTIGUOUS')
+INT_PTR = np.ctypeslib.ndpointer(dtype=np.intc, ndim=1, flags='C_CONTIGUOUS')
+INT_REF = POINTER(c_int)
+DOUBLE_REF = POINTER(c_double)
+
+
+def doubles(tab, sizetab=None, order='F'):
+    """
+    Flat, contiguous float64 view of an array for the library
+    :param tab: array-like of values
+    :param sizetab: size of the buffer expected by the library (the values
+                    are completed with zeros if 'tab' is shorter)
+    :param order: 'F' for column-major (Fortran) order, 'C' for row-major
+    :return: 1D-array sharing memory with 'tab' whenever possible
+    """
+    tab = np.asarray(tab, dtype=np.float64)
+    return _flat(tab, sizetab, order)
+
+
+def ints(tab, sizetab=None, order='F'):
+    """
+    Flat, contiguous C int view of an array for the library
+    :param tab: array-like of values
+    :param sizetab: size of the buffer expected by the library (the values
+                    are completed with zeros if 'tab' is shorter)
+    :param order: 'F' for column-major (Fortran) order, 'C' for row-major
+    :return: 1D-array sharing memory with 'tab' whenever possible
+    """
+    tab = np.asarray(tab)
+    if tab.dtype != np.intc:
+        tab = tab.astype(np.intc)
+    return _flat(tab, sizetab, order)
+
+
+def _flat(tab, sizetab, order):
+    """ Contiguous 1D-array of exactly 'sizetab' values """
+    flat = np.ascontiguousarray(tab.ravel(order=order))
+    if sizetab is None or flat.size == sizetab:
+        return flat
+    if flat.size > sizetab:
+        raise ValueError('too many values: ' + str(flat.size) +
+                         ' instead of ' + str(sizetab))
+    padded = np.zeros(sizetab, dtype=flat.dtype)
+    padded[0:flat.size] = flat
+    return padded
+
+
+def tmstruct(date):
+    """
+    The 9-field 'tm' structure (as doubles) used by MORDOR-TS for a date
+    :param date: a date (datetime format) or an already computed structure
+    :return: 1D-array of 9 values
+    """
+    if not hasattr(date, 'timetuple'):
+        return np.array(date, dtype=np.float64).reshape(9)
+    tt = date.timetuple()
+    tm = np.empty(9)
+    tm[0] = tt.tm_sec
+    tm[1] = tt.tm_min
+    tm[2] = tt.tm_hour
+    tm[3] = tt.tm_mday
+    tm[4] = tt.tm_mon - 1
+    tm[5] = tt.tm_year - 1850
+    tm[6] = tt.tm_wday + 1
+    tm[7] = tt.tm_yday - 1
+    tm[8] = tt.tm_isdst
+    return tm
+
+
+def tmfin(date, dt):
+    """
+    The 'tm' structure of the end of a run, covering the whole last time step
+    :param date: last date of the run (datetime format)
+    :param dt: time step in seconds
+    :return: 1D-array of 9 values
+    """
+    tm = tmstruct(date)
+    if dt == 86400:
+        tm[2] = 23
+    elif dt == 3600:
+        tm[1] = 59
+    return tm
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    Models created once and re-initialized for each run
+
+    A Model owns the inputs (hf) and the hydrological model (hm) of a basin:
+    a new run only calls InitModele instead of creating and deleting the
+    handles of the library. The handles are freed when the model is closed,
+    at the latest at the end of its 'with' block. A ModelPool keeps a
+    bounded number of models alive and closes the least recently used one
+    among the models which are not in use (see ModelPool.use).
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import datetime
+import threading
+import contextlib
+from collections import OrderedDict
+import numpy as np
+from pymordor import hf_mordor, hm_mordor
+from pymordor.modelehydro import getdimmodele, getetatmodele, getdateetat,\
+    initmodele, geterreur
+
+CHUNK = 10000
+
+
+class Model(object):
+    """ Inputs and hydrological model of a basin """
+
+    def __init__(self, temps, maillage, meteo, etat0, matparam, tabinj=None,
+                 **options):
+        """
+        Creation of the handles (see hf_mordor.create_multi for the
+        parameters and the options)
+        """
+        self.temps = temps
+        self.forc = hf_mordor.create_multi(temps, maillage, meteo, etat0,
+                                           matparam, tabinj, **options)
+        if self.forc is None:
+            raise RuntimeError('creation of the inputs failed')
+        try:
+            self.hm = hm_mordor.create(temps, maillage, self.forc)
+        except Exception:
+            hf_mordor.delete(self.forc['hf'])
+            self.forc = None
+            raise
+        if self.hm is None or self.hm < 0:
+            hf_mordor.delete(self.forc['hf'])
+            self.forc = None
+            raise RuntimeError('creation of the model failed: ' +
+                               str(geterreur()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def closed(self):
+        """ True once the handles are freed """
+        return self.forc is None
+
+    def close(self):
+        """ Free the handles of the library (can be called several times) """
+        if self.forc is None:
+            return
+        try:
+            hm_mordor.delete(self.hm)
+        finally:
+            hf_mordor.delete(self.forc['hf'])
+            self.forc = None
+            self.hm = None
+
+    def _verifie(self):
+        """ Check that the handles are alive """
+        if self.forc is None:
+            raise ValueError('the model is closed')
+
+    def initialize(self, etat=None):
+        """
+        Initialization of the model
+        :param etat: state given by 'state' (or checkpoint.load), with its
+                     'date' (default: the initial state of the inputs)
+        :return: the date of the initial state
+        """
+        self._verifie()
+        if etat is None:
+            valeur = hm_mordor.initialization(self.hm, self.temps,
+                                              self.forc['matini'])
+            date = self.temps['date1']
+        else:
+            valeur = initmodele(self.hm, etat['date'],
+                                etat['etatproduction'],
+                                etat['etattransfert'],
+                                etat['bufferproduction'])
+            date = etat['date']
+        if valeur != 0:
+            raise RuntimeError('initialization of the model ' + str(self.hm) +
+                               ' failed: ' + str(geterreur()))
+        return date
+
+    def state(self):
+        """
+        Current state of the model
+        :return: a dictionary of the state arrays and its 'date'
+        """
+        self._verifie()
+        etat = getetatmodele(self.hm)
+        if etat is None:
+            raise RuntimeError('no state for the model ' + str(self.hm) +
+                               ': ' + str(geterreur()))
+        etat['date'] = getdateetat(self.hm)
+        return etat
+
+    def run(self, date2=None, etat=None, chunk=CHUNK):
+        """
+        Re-initialization and run of the model
+        :param date2: end of the run (default: end of the inputs)
+        :param etat: initial state (see initialize)
+        :param chunk: number of time steps computed at once
+        :return: array of nsteps x nsortietransfert discharges from the date
+                 of the initial state to date2
+        """
+        self._verifie()
+        temps = dict(self.temps)
+        if date2 is not None:
+            # inputs appended by hf_mordor.update included
+            derniere = temps['date1'] + datetime.timedelta(
+                seconds=temps['dt'] * (self.forc['ndates'] - 1))
+            if date2 > derniere or date2 < temps['date1']:
+                raise ValueError('end of the run outside the inputs (' +
+                                 str(temps['date1']) + ' to ' +
+                                 str(derniere) + '): ' + str(date2))
+            temps['date2'] = date2
+        self.initialize(etat)
+        qsim = list(hm_mordor.run_stream(self.hm, temps, chunk))
+        if len(qsim) == 0:
+            return np.zeros((0, getdimmodele(self.hm)['nsortietransfert']))
+        return np.vstack(qsim)
+
+
+class ModelPool(object):
+    """
+    Models kept alive, at most 'capacite' (more if they are all in use),
+    closed in LRU order. A model given by get is in use until it is
+    released, and is never closed by the pool in the meantime.
+    """
+
+    def __init__(self, capacite):
+        self.capacite = capacite
+        self.modeles = OrderedDict()
+        # number of uses of the models in use (by id)
+        self.utilisations = {}
+        self.verrou = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.modeles)
+
+    def __contains__(self, cle):
+        return cle in self.modeles
+
+    def get(self, cle, *args, **kwargs):
+        """
+        Model of a key, created with the arguments of Model if needed, in
+        use until it is given back to release
+        :param cle: key of the model (ex.: (nom_bv, parameter hash))
+        :return: the model
+        """
+        with self.verrou:
+            if cle in self.modeles:
+                return self._prend(cle, self.modeles[cle])
+        # created without the lock: the other keys stay available
+        nouveau = Model(*args, **kwargs)
+        with self.verrou:
+            # model of the same key created by another thread meanwhile
+            modele = self.modeles.get(cle, nouveau)
+            self._prend(cle, modele)
+        if modele is not nouveau:
+            nouveau.close()
+        return modele
+
+    def _prend(self, cle, modele):
+        """ Model of a key marked as in use and most recently used """
+        self.modeles.pop(cle, None)
+        self.modeles[cle] = modele
+        self.utilisations[id(modele)] = \
+            self.utilisations.get(id(modele), 0) + 1
+        self._evince()
+        return modele
+
+    def release(self, modele):
+        """
+        End of a use of a model given by get
+        :param modele: the model
+        """
+        with self.verrou:
+            if id(modele) not in self.utilisations:
+                raise ValueError('the model is not in use')
+            self.utilisations[id(modele)] -= 1
+            if self.utilisations[id(modele)] > 0:
+                return
+            del self.utilisations[id(modele)]
+            if any([autre is modele for autre in self.modeles.values()]):
+                self._evince()
+            else:  # discarded while in use
+                modele.close()
+
+    @contextlib.contextmanager
+    def use(self, cle, *args, **kwargs):
+        """
+        Model of a key (see get) in a 'with' block, released at its end
+        """
+        modele = self.get(cle, *args, **kwargs)
+        try:
+            yield modele
+        finally:
+            self.release(modele)
+
+    def _evince(self):
+        """ Close the least recently used models which are not in use """
+        libres = [cle for cle, modele in self.modeles.items()
+                  if id(modele) not in self.utilisations]
+        for cle in libres:
+            if len(self.modeles) <= self.capacite:
+                break
+            self.modeles.pop(cle).close()
+
+    def discard(self, cle):
+        """ Close the model of a key (at the end of its use if it is in
+        use) """
+        with self.verrou:
+            modele = self.modeles.pop(cle, None)
+            if modele is not None and id(modele) not in self.utilisations:
+                modele.close()
+
+    def close(self):
+        """ Close all the models (the ones in use at the end of their use) """
+        with self.verrou:
+            while len(self.modeles) > 0:
+                modele = self.modeles.popitem(last=False)[1]
+                if id(modele) not in self.utilisations:
+                    modele.close()
@@ -7,73 +7,28 @@
     Copyright EDF 2016-2018
 
 """
-import sys
-import os
 from ctypes import *
 import numpy as np
 import datetime
+from pymordor.marshaling import doubles, ints, tmstruct
+from pymordor.libraries import Library, CALLS
+from pymordor import weights
 
-LIBMORDOR = os.environ.get('LIBMORDOR')
-
-if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'/libRunMordorTS.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.so. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'/libWrapperModeleHydro.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.so. Check the environmental variable LIBMORDOR.')
-elif sys.platform.startswith('win'):
-    try:
-        MY_LIBRARY0 = CDLL(LIBMORDOR+'\\libRunMordorTS.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libRunMordorTS.dll. Check the environmental variable LIBMORDOR.')
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'\\libWrapperModeleHydro.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libWrapperModeleHydro.dll. Check the environmental variable LIBMORDOR.')
-else:
-    raise Exception(u'unsupported OS')
+# library loaded on first use (prototypes declared in the registry)
+MY_LIBRARY = Library('WrapperModeleHydro')
 
 
 def creerbaseforcage(nom, npluvio, carapluvio, nmeteo, carameteo, nqinj,
                      ndates, tdeb, dt0):
     """ handle of weather inputs """
     # Data preparation in ctype format
-    nom_c = c_char_p(nom.encode())
-    npluvio_c = c_int(npluvio)
-    sizetab = 4 * npluvio
-    carapluvio = carapluvio.transpose().reshape(carapluvio.size, 1)
-    carapluvio_c = (c_double * sizetab)(*carapluvio)
-    nmeteo_c = c_int(nmeteo)
-    sizetab = 4 * nmeteo
-    carameteo = carameteo.transpose().reshape(carameteo.size, 1)
-    carameteo_c = (c_double * sizetab)(*carameteo)
-    nqinj_c = c_int(nqinj)
-    ndates_c = c_int(ndates)
-    tm = np.zeros((9, 1))
-    tm[0] = tdeb.timetuple().tm_sec
-    tm[1] = tdeb.timetuple().tm_min
-    tm[2] = tdeb.timetuple().tm_hour
-    tm[3] = tdeb.timetuple().tm_mday
-    tm[4] = tdeb.timetuple().tm_mon - 1
-    tm[5] = tdeb.timetuple().tm_year - 1850
-    tm[6] = tdeb.timetuple().tm_wday + 1
-    tm[7] = tdeb.timetuple().tm_yday - 1
-    tm[8] = tdeb.timetuple().tm_isdst
-    tm_c = (c_double * 9)(*tm)
-    dt_c = c_double(dt0)
+    carapluvio_c = doubles(carapluvio, 4 * npluvio)
+    carameteo_c = doubles(carameteo, 4 * nmeteo)
+    tm_c = tmstruct(tdeb)
     # calling the library
-    valeur = MY_LIBRARY.CreerBaseForcage(nom_c, npluvio_c,
-                                         byref(carapluvio_c),
-                                         nmeteo_c, byref(carameteo_c),
-                                         nqinj_c, ndates_c,
-                                         byref(tm_c), dt_c)
+    valeur = MY_LIBRARY.CreerBaseForcage(nom.encode(), npluvio, carapluvio_c,
+                                         nmeteo, carameteo_c, nqinj, ndates,
+                                         tm_c, dt0)
     # return values in standard types
     return valeur
 
@@ -82,15 +37,10 @@ def remplirsiteforcage(handleforcage, numfeuille, numsite,
                        ndates, valeurssite):
     """ Copy of the time series to the required site """
     # Data preparation in ctype format
-    handleforcage_c = c_int(handleforcage)
-    numfeuille_c = c_int(numfeuille)
-    numsite_c = c_int(numsite)
-    ndates_c = c_int(ndates)
-    valeurssite_c = (c_double * ndates)(*valeurssite)
+    valeurssite_c = doubles(valeurssite, ndates)
     # calling the library
-    valeur = MY_LIBRARY.RemplirSiteForcage(handleforcage_c, numfeuille_c,
-                                           numsite_c, ndates_c,
-                                           byref(valeurssite_c))
+    valeur = MY_LIBRARY.RemplirSiteForcage(handleforcage, numfeuille,
+                                           numsite, ndates, valeurssite_c)
     # return values in standard types
     return valeur
 
@@ -101,67 +51,69 @@ def creermodele(nom, nmailles, topologiemailles, ndescript,
                 jeumaille, handleforcage, dimregpj, dimregtj, regpj, regtj,
                 tabinject, matricekc):
     """ Handle of weather inputs """
-    # Data preparation in ctype format
-    descripteursmailles = \
-        descripteursmailles.transpose().reshape(descripteursmailles.size, 1)
-    regpj = regpj.transpose().reshape(regpj.size, 1)
-    regtj = regtj.transpose().reshape(regtj.size, 1)
-    tabinject = tabinject.transpose().reshape(tabinject.size, 1)
-    matricekc = matricekc.transpose().reshape(matricekc.size, 1)
-    nom_c = c_char_p(nom.encode())
-    nmailles_c = c_int(nmailles)
-    topologiemailles_c = (c_int * nmailles)(*topologiemailles)
-    ndescript_c = c_int(ndescript)
-    sizetab = nmailles * ndescript
-    descripteursmailles_c = (c_double * sizetab)(*descripteursmailles)
-    dt_c = c_double(dt0)
-    nsortietransfert_c = c_int(nsortietransfert)
-    maillesortietransfert_c = (c_int*nsortietransfert)(*maillesortietransfert)
-    nparametres_c = c_int(nparametres)
-    njeux_c = c_int(njeux)
-    sizetab = njeux * nparametres
-    matriceparametres = matriceparametres.transpose()
-    matriceparametres = matriceparametres.reshape(matriceparametres.size, 1)
-    matriceparametres_c = (c_double * sizetab)(*matriceparametres)
-    jeumaille_c = (c_int * nmailles)(*jeumaille)
-    handleforcage_c = c_int(handleforcage)
-    dimregpj_c = c_int(dimregpj)
-    dimregtj_c = c_int(dimregtj)
-    regpj_c = (c_double * dimregpj)(*regpj)
-    regtj_c = (c_double * dimregtj)(*regtj)
-    sizetab = 2 * nmailles
-    tabinject_c = (c_int * sizetab)(*tabinject)
-    sizetab = 366 * nmailles
-    matricekc_c = (c_double * sizetab)(*matricekc)
+    # Data preparation in ctype format (column-major order)
+    topologiemailles_c = ints(topologiemailles, nmailles)
+    descripteursmailles_c = doubles(descripteursmailles,
+                                    nmailles * ndescript)
+    maillesortietransfert_c = ints(maillesortietransfert, nsortietransfert)
+    matriceparametres_c = doubles(matriceparametres, njeux * nparametres)
+    jeumaille_c = ints(jeumaille, nmailles)
+    regpj_c = _regression(regpj, dimregpj)
+    if regtj is regpj and dimregtj == dimregpj:
+        regtj_c = regpj_c
+    else:
+        regtj_c = _regression(regtj, dimregtj)
+    tabinject_c = ints(tabinject, 2 * nmailles)
+    matricekc_c = _matricekc(matricekc, nmailles)
     # calling the library
-    valeur = MY_LIBRARY.CreerModele(nom_c, nmailles_c,
-                                    byref(topologiemailles_c), ndescript_c,
-                                    byref(descripteursmailles_c),
-                                    dt_c, nsortietransfert_c,
-                                    byref(maillesortietransfert_c),
-                                    nparametres_c, njeux_c,
-                                    byref(matriceparametres_c),
-                                    byref(jeumaille_c), handleforcage_c,
-                                    dimregpj_c, dimregtj_c,
-                                    byref(regpj_c), byref(regtj_c),
-                                    byref(tabinject_c),
-                                    byref(matricekc_c))
+    valeur = MY_LIBRARY.CreerModele(nom.encode(), nmailles,
+                                    topologiemailles_c, ndescript,
+                                    descripteursmailles_c, dt0,
+                                    nsortietransfert, maillesortietransfert_c,
+                                    nparametres, njeux, matriceparametres_c,
+                                    jeumaille_c, handleforcage,
+                                    dimregpj, dimregtj, regpj_c, regtj_c,
+                                    tabinject_c, matricekc_c)
     # return values in standard types
     return valeur
 
 
+def _regression(reg, dimreg):
+    """
+    Regression matrix (dense or compact) expanded for the library
+    The library only takes a dense column-major buffer: a compact matrix
+    (see weights) is expanded here into a buffer of dimreg values (ex.:
+    (n+1) x n), allocated for the creation of the model only. The compact
+    storage saves memory before and after this call, not during it.
+    """
+    if weights.iscompact(reg):
+        return weights.tofortran(reg, np.zeros(dimreg))
+    return doubles(reg, dimreg)
+
+
+def _matricekc(matricekc, nmailles):
+    """
+    Kc matrix (dense or compact, see hf_mordor.compact) expanded for the
+    library: one column of 366 values per cell in column-major order
+    """
+    if isinstance(matricekc, dict):
+        colonnes = np.ascontiguousarray(matricekc['colonnes'].transpose())
+        return doubles(colonnes[matricekc['index']], 366 * nmailles,
+                       order='C')
+    return doubles(matricekc, 366 * nmailles)
+
+
 def getdimmodele(handlemodele):
     """ Sizes of model Handle """
     # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
     nmailles_c = c_int()
     nsortietransfert_c = c_int()
     nbuffer_c = c_int()
     dt_c = c_double()
     # calling the library
-    valeur = MY_LIBRARY.GetDimModele(handlemodele_c, byref(nmailles_c),
-                                     byref(nsortietransfert_c),
-                                     byref(nbuffer_c), byref(dt_c))
+    MY_LIBRARY.GetDimModele(handlemodele, byref(nmailles_c),
+                            byref(nsortietransfert_c), byref(nbuffer_c),
+                            byref(dt_c))
     # return values in standard types
     return{'nmailles': nmailles_c.value,
            'nsortietransfert': nsortietransfert_c.value,
@@ -171,53 +123,23 @@ def getdimmodele(handlemodele):
 def initmodele(handlemodele, tdeb, etatproductionzero,
                etattransfertzero, bufferproductionzero):
     """ State initialization of model Handle """
-    # Get dimensions and ravel
-    dimep1 = etatproductionzero.shape[0]
-    dimep2 = etatproductionzero.shape[1]
-    dimet1 = etattransfertzero.shape[0]
-    dimet2 = etattransfertzero.shape[1]
-    dimbp1 = bufferproductionzero.shape[0]
-    dimbp2 = bufferproductionzero.shape[1]
+    # Get dimensions
+    dimep1, dimep2 = etatproductionzero.shape
+    dimet1, dimet2 = etattransfertzero.shape
+    dimbp1, dimbp2 = bufferproductionzero.shape
     # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
-    tm = np.zeros((9, 1))
-    tm[0] = tdeb.timetuple().tm_sec
-    tm[1] = tdeb.timetuple().tm_min
-    tm[2] = tdeb.timetuple().tm_hour
-    tm[3] = tdeb.timetuple().tm_mday
-    tm[4] = tdeb.timetuple().tm_mon - 1
-    tm[5] = tdeb.timetuple().tm_year - 1850
-    tm[6] = tdeb.timetuple().tm_wday + 1
-    tm[7] = tdeb.timetuple().tm_yday - 1
-    tm[8] = tdeb.timetuple().tm_isdst
-    tm_c = (c_double * 9)(*tm)
-    sizetab = dimep1 * dimep2
-    etatproductionzero_c = \
-        (c_double * sizetab)(*etatproductionzero.transpose().ravel())
-    dimep1_c = c_int(dimep1)
-    dimep2_c = c_int(dimep2)
-    etattransfertzero = \
-        etattransfertzero.reshape(etattransfertzero.size, 1)
-    sizetab = dimet1 * dimet2
-    etattransfertzero_c = \
-        (c_double * sizetab)(*etattransfertzero.transpose().ravel())
-    dimet1_c = c_int(dimet1)
-    dimet2_c = c_int(dimet2)
-    bufferproductionzero = \
-        bufferproductionzero.reshape(bufferproductionzero.size, 1)
-    sizetab = dimbp1 * dimbp2
-    bufferproductionzero_c = \
-        (c_double * sizetab)(*bufferproductionzero.transpose().ravel())
-    dimbp1_c = c_int(dimbp1)
-    dimbp2_c = c_int(dimbp2)
+    # (production state in column-major order, the others in row-major order)
+    tm_c = tmstruct(tdeb)
+    etatproductionzero_c = doubles(etatproductionzero, dimep1 * dimep2)
+    etattransfertzero_c = doubles(etattransfertzero, dimet1 * dimet2,
+                                  order='C')
+    bufferproductionzero_c = doubles(bufferproductionzero, dimbp1 * dimbp2,
+                                     order='C')
     # calling the library
-    valeur = MY_LIBRARY.InitModele(handlemodele_c, byref(tm_c),
-                                   byref(etatproductionzero_c),
-                                   dimep1_c, dimep2_c,
-                                   byref(etattransfertzero_c),
-                                   dimet1_c, dimet2_c,
-                                   byref(bufferproductionzero_c),
-                                   dimbp1_c, dimbp2_c)
+    valeur = MY_LIBRARY.InitModele(handlemodele, tm_c,
+                                   etatproductionzero_c, dimep1, dimep2,
+                                   etattransfertzero_c, dimet1, dimet2,
+                                   bufferproductionzero_c, dimbp1, dimbp2)
     # return values in standard types
     return valeur
 
@@ -225,20 +147,9 @@ def initmodele(handlemodele, tdeb, etatproductionzero,
 def runmordor(handlemodele, tfin):
     """ Run the spatialized Modor for the model Handle """
     # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
-    tm = np.zeros((9, 1))
-    tm[0] = tfin.timetuple().tm_sec
-    tm[1] = tfin.timetuple().tm_min
-    tm[2] = tfin.timetuple().tm_hour
-    tm[3] = tfin.timetuple().tm_mday
-    tm[4] = tfin.timetuple().tm_mon - 1
-    tm[5] = tfin.timetuple().tm_year - 1850
-    tm[6] = tfin.timetuple().tm_wday + 1
-    tm[7] = tfin.timetuple().tm_yday - 1
-    tm[8] = tfin.timetuple().tm_isdst
-    tm_c = (c_double * 9)(*tm)
+    tm_c = tmstruct(tfin)
     # calling the library
-    valeur = MY_LIBRARY.RunMordor(handlemodele_c, byref(tm_c))
+    valeur = MY_LIBRARY.RunMordor(handlemodele, tm_c)
     # return values in standard types
     return valeur
 
@@ -246,11 +157,9 @@ def runmordor(handlemodele, tfin):
 def getintercept(handlemodele, numintercept):
     """ Get the flux and the state of the model Handle """
     # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
-    numintercept_c = c_int(numintercept)
     intercept_c = POINTER(c_double)()
     # calling the library
-    valeur = MY_LIBRARY.GetIntercept(handlemodele_c, numintercept_c,
+    valeur = MY_LIBRARY.GetIntercept(handlemodele, numintercept,
                                      byref(intercept_c))
     # return values in standard types
     return valeur, intercept_c
@@ -258,35 +167,25 @@ def getintercept(handlemodele, numintercept):
 
 def getetatmodele(handlemodele):
     """ Get the state of the model """
-    # Data preparation in ctype format
+    # Data preparation: the library writes directly in numpy arrays
     dim_mod = getdimmodele(handlemodele)
     nbuffer = dim_mod['nbuffer']
     nmailles = dim_mod['nmailles']
     nsortietransfert = dim_mod['nsortietransfert']
-    handlemodele_c = c_int(handlemodele)
-    sizetab = 8 * nmailles * 10
-    etatproduction_c = (c_double * sizetab)(0.0)
-    sizetab = nmailles * nsortietransfert
-    etattransfert_c = (c_double * sizetab)(0.0)
-    sizetab = nmailles * nbuffer
-    bufferproduction_c = (c_double * sizetab)(0.0)
-    qmoyen_c = (c_double * nsortietransfert)(0.0)
+    etatproduction = np.zeros((10, 8*nmailles))
+    etattransfert = np.zeros((nmailles, nsortietransfert))
+    bufferproduction = np.zeros((nbuffer, nmailles))
+    qmoyen = np.zeros((nsortietransfert, 1))
     # calling the library
-    valeur = MY_LIBRARY.R_GetEtatModele(handlemodele_c,
-                                        byref(etatproduction_c),
-                                        byref(etattransfert_c),
-                                        byref(bufferproduction_c),
-                                        byref(qmoyen_c))
+    valeur = MY_LIBRARY.R_GetEtatModele(handlemodele,
+                                        etatproduction.reshape(-1),
+                                        etattransfert.reshape(-1),
+                                        bufferproduction.reshape(-1),
+                                        qmoyen.reshape(-1))
     if valeur != 0:
         return None
     # return values in numpy array
-    etatproduction = np.array(etatproduction_c).reshape(10, 8*nmailles)
-    etatproduction = etatproduction.transpose()
-    etattransfert = \
-        np.array(etattransfert_c).reshape(nmailles, nsortietransfert)
-    bufferproduction = np.array(bufferproduction_c).reshape(nbuffer, nmailles)
-    qmoyen = np.array(qmoyen_c).reshape(nsortietransfert, 1)
-    return{'etatproduction': etatproduction,
+    return{'etatproduction': etatproduction.transpose(),
            'etattransfert': etattransfert,
            'bufferproduction': bufferproduction,
            'qmoyen': qmoyen}
@@ -295,15 +194,13 @@ def getetatmodele(handlemodele):
 def getdateetat(handlemodele):
     """ Get the date associated with the state of the model """
     # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
-    ptr_tm_etat_c = (c_double * 9)(0.0)
+    ptr_tm_etat = np.zeros(9)
     # calling the library
-    valeur = MY_LIBRARY.GetDateEtat(handlemodele_c, byref(ptr_tm_etat_c))
+    valeur = MY_LIBRARY.GetDateEtat(handlemodele, ptr_tm_etat)
     # return values in standard types
     if valeur != 0:
         return None
     else:
-        ptr_tm_etat = np.array(ptr_tm_etat_c)
         datestate = datetime.datetime(int(ptr_tm_etat[5])+1850,
                                       int(ptr_tm_etat[4])+1,
                                       int(ptr_tm_etat[3]),
@@ -315,18 +212,15 @@ def getdateetat(handlemodele):
 
 def geterreur():
     """ Error message """
-    # Data preparation in ctype format
-    MY_LIBRARY.GetErreur.restype = POINTER(c_char)
-    # calling the library
-    valeur = MY_LIBRARY.GetErreur()
-    # renvoie du message
-    return string_at(valeur)
+    # calling the library (the message is read before another call)
+    with CALLS:
+        valeur = MY_LIBRARY.GetErreur()
+        # renvoie du message
+        return string_at(valeur)
 
 
 def getversion():
     """ Mordor code version """
-    # Data preparation in ctype format
-    MY_LIBRARY.VersionModele.restype = POINTER(c_char)
     # calling the library
     valeur = MY_LIBRARY.VersionModele()
     # renvoie du message
@@ -335,20 +229,16 @@ def getversion():
 
 def detruiremodele(handlemodele):
     """ Delete the hydrological model """
-    # Data preparation in ctype format
-    handlemodele_c = c_int(handlemodele)
     # calling the library
-    valeur = MY_LIBRARY.DetruireModele(handlemodele_c)
+    valeur = MY_LIBRARY.DetruireModele(handlemodele)
     # return values in standard types
     return valeur
 
 
 def detruireforcage(handleforcage):
     """ Delete the inputs """
-    # Data preparation in ctype format
-    handleforcage_c = c_int(handleforcage)
     # calling the library
-    valeur = MY_LIBRARY.DetruireForcage(handleforcage_c)
+    valeur = MY_LIBRARY.DetruireForcage(handleforcage)
     # return values in standard types
     return valeur
 
@@ -360,7 +250,7 @@ def mktime(ptr_tm):
     """
     # Data preparation in ctype format
     ptr_tm_fin_c = (c_double * 9)(*ptr_tm)
-    # calling the library
-    valeur = MY_LIBRARY.mktime_(byref(ptr_tm_fin_c))
+    # calling the library (through a NumPy view of the ctypes array)
+    valeur = MY_LIBRARY.mktime_(np.ctypeslib.as_array(ptr_tm_fin_c))
     # return values in standard types
     return valeur, ptr_tm_fin_c
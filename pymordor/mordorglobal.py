@@ -7,87 +7,281 @@
     Copyright EDF 2016-2018
 
 """
-import sys
-import os
-from ctypes import *
 import numpy as np
+from pymordor.libraries import Library
 
 NPMT = 150
 TMAX = 200000
 NSTOCK = 10
 NRES1 = 25
-LIBMORDOR = os.environ.get('LIBMORDOR')
 
-if sys.platform.startswith('linux') | sys.platform.startswith('darwin'):
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'/libMordorGlobal.so')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libMordorGlobal.so. Check the environmental variable LIBMORDOR.')
-elif sys.platform.startswith('win'):
-    try:
-        MY_LIBRARY = CDLL(LIBMORDOR+'\\libMordorGlobal.dll')
-    except Exception:
-        raise Exception('unable to load the dynamic library: \
-libMordorGlobal.dll. Check the environmental variable LIBMORDOR.')
-else:
-    raise Exception(u'unsupported OS')
-
-
-def prepparam(pmt, etagement, nstock, don, npas, cond):
-    """ Data preparation of global Mordor """
-    # ctype format
-    pmt_c = (c_double*49)(*pmt)
-    sizetab = 3*nstock
-    etagement_c = (c_double*sizetab)(*etagement.reshape(sizetab, 1))
-    sizetab = 5*npas
-    don_c = (c_double*sizetab)(*don.reshape(sizetab, 1))
-    cond_c = (c_double*9)(*cond)
-    flag_c = c_int()
-    pmt2_c = (c_double*NPMT)(0.0)
-    sizetab = 10*TMAX
-    don2_c = (c_double*sizetab)(0.0)
-    cond2_c = (c_double*NPMT)(0.0)
+# library loaded on first use (prototypes declared in the registry)
+MY_LIBRARY = Library('MordorGlobal')
+
+
+def creertampons(nstock, npas):
+    """
+    Pool of buffers for the calls to the library, reusable from one cell
+    to another
+    :param nstock: number of altitude bands
+    :param npas: number of time steps
+    :return: a dictionary of preallocated arrays
+    """
+    tampons = _tamponsprep(nstock, npas)
+    tampons.update(_tamponsinit())
+    return tampons
+
+
+def _tamponsprep(nstock, npas):
+    """ Buffers of mordor_prep_param """
+    return {'nstock': nstock, 'npas': npas,
+            'pmt': np.zeros(49), 'etagement': np.zeros(3*nstock),
+            'don': np.zeros(5*npas), 'cond': np.zeros(9),
+            'flag': np.zeros(1, dtype=np.intc), 'pmt2': np.zeros(NPMT),
+            'don2': np.zeros(10*TMAX), 'cond2': np.zeros(NPMT)}
+
+
+def _tamponsinit():
+    """ Buffers of mordor_initialisation """
+    return {'pmt_ini': np.zeros(NPMT), 'tnn': np.zeros(TMAX),
+            'txn': np.zeros(TMAX), 'cond_ini': np.zeros(NPMT),
+            'flag_ini': np.zeros(10, dtype=np.intc), 'tpn': np.zeros(TMAX),
+            'prep_kc': np.zeros(366), 'etat_ini': np.zeros(NSTOCK*8)}
+
+
+def _copie(tampon, valeurs):
+    """ Copy of values at the beginning of a buffer, the rest is zeroed """
+    valeurs = np.ravel(valeurs)
+    if valeurs.size > tampon.size:
+        raise ValueError('too many values: ' + str(valeurs.size) +
+                         ' instead of ' + str(tampon.size))
+    tampon[0:valeurs.size] = valeurs
+    tampon[valeurs.size:] = 0.0
+
+
+def _prepparam(tampons, pmt, etagement, don, cond, razdon2=True):
+    """ Call of mordor_prep_param with the buffers of a pool """
+    _copie(tampons['pmt'], pmt)
+    _copie(tampons['etagement'], etagement)
+    _copie(tampons['don'], don)
+    _copie(tampons['cond'], cond)
+    for nom in ('flag', 'pmt2', 'cond2'):
+        tampons[nom].fill(0)
+    if razdon2:
+        tampons['don2'].fill(0.0)
+    MY_LIBRARY.mordor_prep_param(tampons['pmt'], tampons['etagement'],
+                                 tampons['don'], tampons['cond'],
+                                 tampons['flag'], tampons['pmt2'],
+                                 tampons['don2'], tampons['cond2'])
+
+
+def _initialisation(tampons, pmt, tnn, txn, cond):
+    """ Call of mordor_initialisation with the buffers of a pool """
+    _copie(tampons['pmt_ini'], pmt)
+    _copie(tampons['tnn'], tnn)
+    _copie(tampons['txn'], txn)
+    _copie(tampons['cond_ini'], cond)
+    for nom in ('flag_ini', 'tpn', 'prep_kc', 'etat_ini'):
+        tampons[nom].fill(0)
+    MY_LIBRARY.mordor_initialisation(tampons['pmt_ini'], tampons['tnn'],
+                                     tampons['txn'], tampons['cond_ini'],
+                                     tampons['flag_ini'], tampons['tpn'],
+                                     tampons['prep_kc'], tampons['etat_ini'])
 
+
+def prepparam(pmt, etagement, nstock, don, npas, cond, tampons=None):
+    """
+    Data preparation of global Mordor
+    With a pool of buffers (see creertampons), the returned arrays are views
+    on the pool: they are overwritten by the next call using the same pool.
+    """
+    if tampons is None:
+        tampons = _tamponsprep(nstock, npas)
     # calling the librairie
-    MY_LIBRARY.mordor_prep_param(byref(pmt_c), byref(etagement_c),
-                                 byref(don_c), byref(cond_c), byref(flag_c),
-                                 byref(pmt2_c), byref(don2_c), byref(cond2_c))
+    _prepparam(tampons, pmt, np.reshape(etagement, 3*nstock),
+               np.reshape(don, 5*npas), cond)
 
     # return values in standard types
-    flag = flag_c.value
-    pmt2 = np.array(pmt2_c)
-    don2 = np.array(don2_c)
-    don2_ = don2.reshape(10, TMAX).transpose()
-    cond2 = np.array(cond2_c)
-
-    return{'flag': flag, 'pmt2': pmt2, 'don2': don2_, 'cond2': cond2}
-
-
-def initialisation(pmt, tnn, txn, cond):
-    """ Data initialization of global Mordor """
-    # ctype format
-    pmt_c = (c_double*NPMT)(*pmt)
-    tnn_c = (c_double*TMAX)(*tnn)
-    txn_c = (c_double*TMAX)(*txn)
-    cond_c = (c_double*NPMT)(*cond)
-    flag_c = (c_int*10)()
-    tpn_c = (c_double*TMAX)(0.0)
-    prep_kc_c = (c_double*366)(0.0)
-    sizetab = NSTOCK*8
-    etat_ini_c = (c_double*sizetab)(0.0)
+    flag = int(tampons['flag'][0])
+    don2_ = tampons['don2'].reshape(10, TMAX).transpose()
+
+    return{'flag': flag, 'pmt2': tampons['pmt2'], 'don2': don2_,
+           'cond2': tampons['cond2']}
 
+
+def initialisation(pmt, tnn, txn, cond, tampons=None):
+    """
+    Data initialization of global Mordor
+    With a pool of buffers (see creertampons), the returned arrays are views
+    on the pool: they are overwritten by the next call using the same pool.
+    """
+    if tampons is None:
+        tampons = _tamponsinit()
     # calling the library
-    MY_LIBRARY.mordor_initialisation(byref(pmt_c), byref(tnn_c), byref(txn_c),
-                                     byref(cond_c), byref(flag_c),
-                                     byref(tpn_c), byref(prep_kc_c),
-                                     byref(etat_ini_c))
+    _initialisation(tampons, pmt, tnn, txn, cond)
 
     # return values in standard types
-    flag = np.array(flag_c)
-    tpn = np.array(tpn_c)
-    prep_kc = np.array(prep_kc_c)
-    etat_i = np.array(etat_ini_c)
-    etat_ini = etat_i.reshape(NSTOCK, 8).transpose()
+    etat_ini = tampons['etat_ini'].reshape(NSTOCK, 8).transpose()
+
+    return{'flag': tampons['flag_ini'], 'tpn': tampons['tpn'],
+           'prep_kc': tampons['prep_kc'], 'etat_ini': etat_ini}
+
+
+def prepbatch(params, altitudes, idj, rain, tmin, tmax, cond, tampons=None,
+              nprocs=None, sortie=None, cache=None, pool=None):
+    """
+    Preparation and initialization of global Mordor for a set of cells
+    :param params: array (ncells x 49) of parameters, one row per cell
+    :param altitudes: array (ncells x nbands) of altitudes
+    :param idj: day of the year for each of the npas time steps
+    :param rain: array (npas x ncells) of rain values
+    :param tmin: array (npas x ncells) of minimum temperatures
+    :param tmax: array (npas x ncells) of maximum temperatures
+    :param cond: the 9 initial conditions
+    :param tampons: optional pool of buffers (see creertampons) of at least
+                    npas time steps
+    :param nprocs: number of worker processes (serial computation if None)
+    :param pool: optional pool of processes of the caller (a
+                 multiprocessing.Pool or a concurrent.futures executor)
+                 reused instead of a new pool of nprocs processes
+    :param sortie: optional dictionary of preallocated arrays (any memory
+                   layout) receiving some of the results, the missing ones
+                   are allocated
+    :param cache: optional cache of the results (see prepcache.PrepCache),
+                  only the cells whose inputs are unknown are computed;
+                  with a pool of buffers, the last cell is always computed
+                  again, even when all the cells are cached, to leave its
+                  'don2' in the pool (10 x TMAX values, not cached)
+    :return: a dictionary of arrays with one row per cell
+             ('pmt2', 'cond2', 'tpn', 'prep_kc', 'etat_ini' and the flags)
+    """
+    ncells, nstock = altitudes.shape
+    npas = rain.shape[0]
+    res = _sortie(ncells, npas, sortie)
+    if cache is not None:
+        _prepcache(params, altitudes, idj, rain, tmin, tmax, cond, tampons,
+                   nprocs, res, cache, pool)
+        return res
+    if (pool is not None or (nprocs is not None and nprocs > 1)) and \
+            ncells > 1:
+        _prepparallele(params, altitudes, idj, rain, tmin, tmax, cond,
+                       tampons, nprocs, res, pool)
+        return res
+    if tampons is None or tampons['nstock'] != nstock \
+            or tampons['npas'] < npas:
+        tampons = creertampons(nstock, npas)
+    # constant parts of the inputs
+    etage = np.zeros((nstock, 3))
+    etage[:, 0] = 1./nstock
+    don = np.zeros((npas, 5))
+    don[:, 0] = np.ravel(idj)
+    for i in range(ncells):
+        don[:, 2] = rain[:, i]
+        don[:, 3] = (tmin[:, i] + tmax[:, i]) * 0.5
+        etage[:, 1] = altitudes[i]
+        _prepparam(tampons, params[i], etage, don, cond, razdon2=False)
+        res['flag'][i] = tampons['flag'][0]
+        res['pmt2'][i] = tampons['pmt2']
+        res['cond2'][i] = tampons['cond2']
+        _initialisation(tampons, res['pmt2'][i], tmin[:, i], tmax[:, i],
+                        res['cond2'][i])
+        res['flagini'][i] = tampons['flag_ini']
+        res['tpn'][i] = tampons['tpn'][0:npas]
+        res['prep_kc'][i] = tampons['prep_kc']
+        res['etat_ini'][i] = tampons['etat_ini'].reshape(NSTOCK, 8)\
+            .transpose()
+    return res
+
 
-    return{'flag': flag, 'tpn': tpn, 'prep_kc': prep_kc, 'etat_ini': etat_ini}
+def _prepcache(params, altitudes, idj, rain, tmin, tmax, cond, tampons,
+               nprocs, res, cache, pool=None):
+    """
+    Preparation of the cells missing from a cache (the last cell is always
+    computed when a pool of buffers is given, so that its 'don2' is in the
+    pool as without cache: caching 'don2' would store 10 x TMAX values per
+    cell for the only cell that uses them)
+    """
+    ncells = altitudes.shape[0]
+    cles = cache.keys(params, altitudes, idj, rain, tmin, tmax, cond)
+    manquantes = []
+    for i, cle in enumerate(cles):
+        valeurs = None
+        if i < ncells-1 or tampons is None:
+            valeurs = cache.get(cle)
+        if valeurs is None:
+            manquantes.append(i)
+            continue
+        for nom in res:
+            res[nom][i] = valeurs[nom]
+    if len(manquantes) == 0:
+        return
+    b = np.array(manquantes)
+    calcul = prepbatch(params[b], altitudes[b], idj, rain[:, b], tmin[:, b],
+                       tmax[:, b], cond, tampons, nprocs, pool=pool)
+    for k, i in enumerate(b):
+        for nom in res:
+            res[nom][i] = calcul[nom][k]
+        cache.put(cles[i], dict([(nom, calcul[nom][k]) for nom in calcul]))
+
+
+def _sortie(ncells, npas, sortie=None):
+    """ Arrays of the results of prepbatch, allocated once for all cells """
+    formes = {'flag': (ncells,), 'pmt2': (ncells, NPMT),
+              'cond2': (ncells, NPMT), 'flagini': (ncells, 10),
+              'tpn': (ncells, npas), 'prep_kc': (ncells, 366),
+              'etat_ini': (ncells, 8, NSTOCK)}
+    res = {}
+    for nom, forme in formes.items():
+        if sortie is not None and nom in sortie:
+            if sortie[nom].shape != forme:
+                raise ValueError('wrong shape for ' + nom + ': ' +
+                                 str(sortie[nom].shape) + ' instead of ' +
+                                 str(forme))
+            res[nom] = sortie[nom]
+        elif nom in ('flag', 'flagini'):
+            res[nom] = np.zeros(forme, dtype=int)
+        else:
+            res[nom] = np.zeros(forme)
+    return res
+
+
+def _prepbloc(args):
+    """ Work of a process: preparation of a block of cells """
+    params, altitudes, idj, rain, tmin, tmax, cond, dernier = args
+    tampons = creertampons(altitudes.shape[1], rain.shape[0])
+    res = prepbatch(params, altitudes, idj, rain, tmin, tmax, cond, tampons)
+    if dernier:
+        res['don2'] = tampons['don2']
+    return res
+
+
+def _prepparallele(params, altitudes, idj, rain, tmin, tmax, cond, tampons,
+                   nprocs, res, pool=None):
+    """
+    Preparation of the cells distributed by blocks over a pool of processes
+    (the cells are independent: the results are those of the serial case)
+    """
+    import multiprocessing
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    ncells = altitudes.shape[0]
+    blocs = np.array_split(np.arange(ncells), min(ncells, 4*nprocs))
+    taches = ((params[b], altitudes[b], idj, rain[:, b], tmin[:, b],
+               tmax[:, b], cond, b[-1] == ncells-1) for b in blocs)
+    propre = pool is None
+    if propre:
+        pool = multiprocessing.Pool(nprocs)
+    try:
+        # the results of each block are stored as soon as they arrive
+        # (imap of a multiprocessing pool, map of an executor)
+        resultats = pool.imap(_prepbloc, taches) if hasattr(pool, 'imap') \
+            else pool.map(_prepbloc, taches)
+        for b, r in zip(blocs, resultats):
+            for nom in res:
+                res[nom][b[0]:b[-1]+1] = r[nom]
+            if tampons is not None and 'don2' in r:
+                tampons['don2'][:] = r['don2']
+    finally:
+        if propre:
+            pool.close()
+            pool.join()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache of the preparation of global Mordor for the cells
+
+    The preparation and initialization of a cell (mordor_prep_param and
+    mordor_initialisation) only depend on its parameters, its altitudes,
+    its weather series and the initial conditions: the results are stored
+    under a hash of these inputs, so that only the cells whose inputs
+    changed are computed again (ex.: in a calibration where only the
+    parameters of some sub-basins change). The cache is bounded in memory
+    (least recently used entries evicted first) and can be backed by a
+    folder. The work array 'don2' of mordor_prep_param is not cached: the
+    last cell, whose 'don2' is kept by hf_mordor.create, is computed again
+    at each preparation.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from pymordor.utils import replace_file
+
+# default size of the cache in memory (bytes)
+MAXBYTES = 256 * 1024 * 1024
+
+
+def _octets(tab):
+    """ Bytes of an array of doubles """
+    return np.ascontiguousarray(tab, dtype=np.float64).tobytes()
+
+
+class PrepCache(object):
+    """ Results of the preparation of cells, keyed by a hash of the inputs """
+
+    def __init__(self, maxbytes=MAXBYTES, repertoire=None):
+        """
+        :param maxbytes: maximum size of the results kept in memory
+        :param repertoire: optional folder where the results are also saved
+        """
+        self.maxbytes = maxbytes
+        self.repertoire = repertoire
+        self.entrees = OrderedDict()
+        self.taille = 0
+        self.hits = 0
+        self.misses = 0
+        self.verrou = threading.Lock()
+        if repertoire is not None and not os.path.isdir(repertoire):
+            os.makedirs(repertoire)
+
+    def keys(self, params, altitudes, idj, rain, tmin, tmax, cond):
+        """
+        Keys of a set of cells (same arguments as prepbatch)
+        :return: list of one key per cell
+        """
+        commun = hashlib.sha1(_octets(np.ravel(idj)))
+        commun.update(_octets(cond))
+        cles = []
+        for i in range(altitudes.shape[0]):
+            empreinte = commun.copy()
+            for tab in (params[i], altitudes[i], rain[:, i], tmin[:, i],
+                        tmax[:, i]):
+                empreinte.update(_octets(tab))
+            cles.append(empreinte.hexdigest())
+        return cles
+
+    def _fichier(self, cle):
+        """ File of an entry in the folder of the cache """
+        return os.path.join(self.repertoire, cle + '.npz')
+
+    def get(self, cle):
+        """
+        Results of a cell
+        :param cle: key of the cell
+        :return: a dictionary of arrays or None if the key is unknown
+        """
+        with self.verrou:
+            if cle in self.entrees:
+                self.entrees[cle] = self.entrees.pop(cle)
+                self.hits = self.hits + 1
+                return self.entrees[cle]
+        if self.repertoire is not None and os.path.isfile(self._fichier(cle)):
+            with np.load(self._fichier(cle)) as donnees:
+                valeurs = dict([(nom, donnees[nom]) for nom in donnees.files])
+            self._ajoute(cle, valeurs)
+            with self.verrou:
+                self.hits = self.hits + 1
+            return valeurs
+        with self.verrou:
+            self.misses = self.misses + 1
+        return None
+
+    def put(self, cle, valeurs):
+        """
+        Store the results of a cell
+        :param cle: key of the cell
+        :param valeurs: dictionary of arrays (copied)
+        """
+        valeurs = dict([(nom, np.array(tab)) for nom, tab in valeurs.items()])
+        self._ajoute(cle, valeurs)
+        if self.repertoire is not None and \
+                not os.path.isfile(self._fichier(cle)):
+            tmp = self._fichier(cle) + '.' + str(os.getpid()) + '.' + \
+                str(threading.current_thread().ident) + '.npz'
+            np.savez(tmp, **valeurs)
+            replace_file(tmp, self._fichier(cle))
+
+    def _ajoute(self, cle, valeurs):
+        """ Entry added in memory, the oldest ones are evicted """
+        taille = sum([tab.nbytes for tab in valeurs.values()])
+        with self.verrou:
+            if cle in self.entrees:
+                return
+            self.entrees[cle] = valeurs
+            self.taille = self.taille + taille
+            while self.taille > self.maxbytes and len(self.entrees) > 0:
+                ancienne = self.entrees.popitem(last=False)[1]
+                self.taille = self.taille - \
+                    sum([tab.nbytes for tab in ancienne.values()])
+
+    def clear(self):
+        """ Empty the cache in memory (the folder is kept) """
+        with self.verrou:
+            self.entrees.clear()
+            self.taille = 0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Lambert II <-> geographical coordinates for large sets of points
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Lambert II (extended) projection
+XS = 600000.0
+YS = 8199695.768
+N = 0.7289686274
+C = 11745793.39
+E = 0.08248325676
+DELTA = 0.040792344
+# numerical parameters
+TOLERANCE = 1.e-11
+MAXITER = 50
+CHUNK = 1000000
+# cache of the coordinates of the meshes
+NCACHE = 32
+_CACHE = OrderedDict()
+_VERROU = threading.Lock()
+
+
+def _isometrique(latitude):
+    """ Isometric latitude """
+    s = np.sin(latitude)
+    return np.arctanh(s) - E*np.arctanh(E*s)
+
+
+def _latitude(lambert):
+    """
+    Latitude from the isometric latitude (Newton's method with the analytic
+    derivative, the points are left out as soon as they have converged)
+    """
+    p = np.full(lambert.shape, np.pi*42.0/180.0)    # starting value
+    actifs = np.arange(lambert.size)
+    for _ in range(MAXITER):
+        if actifs.size == 0:
+            break
+        f = p[actifs]
+        s = np.sin(f)
+        derivee = (1.0 - E*E) / ((1.0 - E*E*s*s) * np.cos(f))
+        delta = (_isometrique(f) - lambert[actifs]) / derivee
+        p[actifs] = f - delta
+        actifs = actifs[np.abs(delta) >= TOLERANCE]
+    return p
+
+
+def lambert2geo(x, y, chunk=CHUNK):
+    """
+    Change Lambert II coordinates (x,y) (m) into geographical \
+    coordinates (latitude, longitude)
+    :param x: x-coordinate
+    :param y: y-coordinate
+    :param chunk: number of points processed at once
+    :return: a dictionary of the new coordinates (radians), with the shape
+             of x
+    """
+    forme = np.shape(x)
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    longitude = np.empty(x.size)
+    latitude = np.empty(x.size)
+    for k in range(0, x.size, chunk):
+        xk = x[k:k+chunk] - XS
+        yk = YS - y[k:k+chunk]
+        longitude[k:k+chunk] = DELTA + np.arctan(xk/yk)/N
+        lambert = (-1.0/N)*np.log(np.abs(np.sqrt(xk*xk + yk*yk)/C))
+        latitude[k:k+chunk] = _latitude(lambert)
+    return {'longitude': longitude.reshape(forme),
+            'latitude': latitude.reshape(forme)}
+
+
+def geo2lambert(longitude, latitude, chunk=CHUNK):
+    """
+    Change geographical coordinates (radians) into Lambert II coordinates
+    :param longitude: longitude (radians)
+    :param latitude: latitude (radians)
+    :param chunk: number of points processed at once
+    :return: a dictionary of the new coordinates (m), with the shape of
+             longitude
+    """
+    forme = np.shape(longitude)
+    longitude = np.asarray(longitude, dtype=float).ravel()
+    latitude = np.asarray(latitude, dtype=float).ravel()
+    x = np.empty(longitude.size)
+    y = np.empty(longitude.size)
+    for k in range(0, x.size, chunk):
+        r = C*np.exp(-N*_isometrique(latitude[k:k+chunk]))
+        g = N*(longitude[k:k+chunk] - DELTA)
+        x[k:k+chunk] = XS + r*np.sin(g)
+        y[k:k+chunk] = YS - r*np.cos(g)
+    return {'x': x.reshape(forme), 'y': y.reshape(forme)}
+
+
+def geo_maillage(maillage):
+    """
+    Geographical coordinates of the cells of a mesh (Lambert II coordinates
+    in the first two columns of the descriptors), cached for each mesh
+    (thread-safe: the cache is shared by the threads)
+    :param maillage: dictionary of the hydrological mesh
+    :return: a dictionary of the coordinates (radians)
+    """
+    xy = np.ascontiguousarray(maillage['descripteurs'][:, 0:2], dtype=float)
+    cle = hashlib.sha1(xy.tobytes()).hexdigest()
+    with _VERROU:
+        res = _CACHE.pop(cle, None)
+        if res is not None:
+            _CACHE[cle] = res
+    if res is None:
+        # computed without the lock, the other meshes stay available
+        res = lambert2geo(xy[:, 0], xy[:, 1])
+        with _VERROU:
+            _CACHE[cle] = res
+            while len(_CACHE) > NCACHE:
+                _CACHE.popitem(last=False)
+    return {'longitude': res['longitude'].copy(),
+            'latitude': res['latitude'].copy()}
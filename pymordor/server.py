@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+    Server keeping hydrological models in memory, with a local socket API
+
+    The inputs (hf) and the models (hm) are created once by the server
+    process (see add_model) and the clients send requests on a Unix socket
+    (or a TCP socket on localhost). A message is a JSON header preceded by
+    its size (4 bytes, big-endian) and followed by the raw data of the
+    arrays described in the header. The requests are served by threads:
+    the requests on one model are serialized, the ones on different models
+    are served concurrently (the calls to the library are protected by the
+    registry of the libraries, see libraries.CALLS). A malformed message or
+    a message larger than the limits of the server is answered with an
+    error and the connection is closed.
+
+    Requests ('op' of the header):
+        - 'list': names of the models
+        - 'run': discharges from the current state of a model to 'date2'
+        - 'intercept': the same with the interceptions of some cells
+        - 'update': new time steps of the inputs (see hf_mordor.update)
+        - 'state': current state of a model
+        - 'restore': initialization of a model from a given state (or from
+          the state of the model when it was added)
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import stat
+import json
+import socket
+import struct
+import datetime
+import threading
+import numpy as np
+from pymordor import hf_mordor, hm_mordor
+from pymordor.modelehydro import getetatmodele, getdateetat, initmodele,\
+    geterreur
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+FORMAT = '%Y-%m-%dT%H:%M:%S'
+CHUNK = 10000
+# largest header and largest data of the arrays of a request (bytes)
+MAX_HEADER = 1 << 20
+MAX_DATA = 1 << 30
+
+
+class ProtocolError(ValueError):
+    """ Malformed message """
+
+
+def _recoit(sock, taille):
+    """ Exactly 'taille' bytes from a socket """
+    donnees = bytearray(taille)
+    vue = memoryview(donnees)
+    k = 0
+    while k < taille:
+        n = sock.recv_into(vue[k:], taille - k)
+        if n == 0:
+            raise EOFError('connection closed')
+        k = k + n
+    return donnees
+
+
+def send(sock, header, arrays=None):
+    """
+    Send a message
+    :param sock: a connected socket
+    :param header: dictionary of JSON values
+    :param arrays: optional dictionary of arrays
+    """
+    header = dict(header)
+    tableaux = []
+    header['arrays'] = []
+    for nom, tab in (arrays or {}).items():
+        tab = np.ascontiguousarray(tab)
+        header['arrays'].append([nom, tab.dtype.str, list(tab.shape)])
+        tableaux.append(tab)
+    entete = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('!I', len(entete)) + entete)
+    for tab in tableaux:
+        sock.sendall(memoryview(tab.reshape(-1).view(np.uint8)))
+
+
+def receive(sock, maxheader=MAX_HEADER, maxdata=None):
+    """
+    Receive a message
+    :param sock: a connected socket
+    :param maxheader: largest size of the header in bytes
+    :param maxdata: largest size of the data of the arrays in bytes (no
+                    limit if None)
+    :return: the header (dictionary) and the dictionary of arrays
+    :raise ProtocolError: for a malformed message or a message too large
+    """
+    taille = struct.unpack('!I', bytes(_recoit(sock, 4)))[0]
+    if taille > maxheader:
+        raise ProtocolError('header of ' + str(taille) +
+                            ' bytes larger than ' + str(maxheader))
+    try:
+        header = json.loads(bytes(_recoit(sock, taille)).decode('utf-8'))
+        if not isinstance(header, dict):
+            raise ValueError('the header is not a JSON object')
+        descriptions = _descriptions(header.pop('arrays', []))
+    except (ValueError, TypeError) as err:
+        raise ProtocolError('malformed header: ' + str(err))
+    total = sum([n for _, _, _, n in descriptions])
+    if maxdata is not None and total > maxdata:
+        raise ProtocolError('arrays of ' + str(total) +
+                            ' bytes larger than ' + str(maxdata))
+    arrays = {}
+    for nom, dtype, forme, n in descriptions:
+        arrays[nom] = np.frombuffer(_recoit(sock, n), dtype=dtype)\
+            .reshape(forme)
+    return header, arrays
+
+
+def _descriptions(liste):
+    """ Name, dtype, shape and size in bytes of the arrays of a header """
+    descriptions = []
+    for nom, dtype, forme in liste:
+        dtype = np.dtype(str(dtype))
+        if dtype.hasobject:
+            raise ValueError('arrays of objects are not allowed')
+        forme = tuple([int(k) for k in forme])
+        if any([k < 0 for k in forme]):
+            raise ValueError('negative dimension for ' + str(nom))
+        n = int(np.prod(forme, dtype=np.int64)) * dtype.itemsize
+        descriptions.append((str(nom), dtype, forme, n))
+    return descriptions
+
+
+def _date(texte):
+    """ Date of a header """
+    return datetime.datetime.strptime(texte, FORMAT)
+
+
+def _fin(modele, header):
+    """ End of a run: 'date2' of the request or the last date of hf """
+    derniere = modele['temps']['date1'] + datetime.timedelta(
+        seconds=modele['temps']['dt'] * (modele['forc']['ndates'] - 1))
+    if header.get('date2') is None:
+        return derniere
+    fin = _date(header['date2'])
+    if fin > derniere:
+        raise ValueError('no inputs after ' + derniere.strftime(FORMAT))
+    return fin
+
+
+def _etat(hm):
+    """ State of a model and its date """
+    etat = getetatmodele(hm)
+    date = getdateetat(hm)
+    if etat is None or date is None:
+        raise RuntimeError('no state for the model ' + str(hm) + ': ' +
+                           str(geterreur()))
+    return etat, date
+
+
+def _traite(serveur, header, arrays):
+    """ Answer to a request: header and arrays """
+    op = header.get('op')
+    with serveur.verrou:
+        if op == 'list':
+            return {'models': sorted(serveur.modeles)}, {}
+        modele = serveur.modeles.get(header.get('model'))
+    if modele is None:
+        raise KeyError('unknown model: ' + str(header.get('model')))
+    hm = modele['hm']
+    with modele['verrou']:
+        if op in ('run', 'intercept'):
+            temps = dict(modele['temps'])
+            temps['date2'] = _fin(modele, header)
+            chunk = int(header.get('chunk', CHUNK))
+            if op == 'run':
+                fenetres = list(hm_mordor.run_stream(hm, temps, chunk))
+                res = {'qsim': np.vstack(fenetres)} if fenetres else {}
+            else:
+                fenetres = list(hm_mordor.runintercept_stream(
+                    hm, temps, header['idmaille'], header['idinter'], chunk))
+                res = {}
+                if fenetres:
+                    res['qsim'] = np.vstack([f['qsim'] for f in fenetres])
+                    for nom in fenetres[0]['intercept']:
+                        res[nom] = np.vstack([f['intercept'][nom]
+                                              for f in fenetres])
+            return {'date2': temps['date2'].strftime(FORMAT)}, res
+        if op == 'update':
+            ndates = hf_mordor.update(modele['forc'], arrays,
+                                      arrays.get('tabinj'))
+            return {'ndates': ndates}, {}
+        if op == 'state':
+            etat, date = _etat(hm)
+            return {'date': date.strftime(FORMAT)}, etat
+        if op == 'restore':
+            if len(arrays) > 0:
+                etat, date = arrays, _date(header['date'])
+            else:
+                etat, date = modele['reference']
+            valeur = initmodele(hm, date, etat['etatproduction'],
+                                etat['etattransfert'],
+                                etat['bufferproduction'])
+            if valeur != 0:
+                raise RuntimeError('initialization of the model ' + str(hm) +
+                                   ' failed: ' + str(geterreur()))
+            return {'date': date.strftime(FORMAT)}, {}
+    raise ValueError('unknown request: ' + str(op))
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """ Requests of a client, until the connection is closed """
+
+    def handle(self):
+        while True:
+            try:
+                header, arrays = receive(self.request, self.server.maxheader,
+                                         self.server.maxdata)
+            except EOFError:
+                break
+            except ProtocolError as err:
+                # the rest of the message cannot be skipped
+                send(self.request, {'status': 'error', 'message': str(err)})
+                break
+            try:
+                reponse, tableaux = _traite(self.server, header, arrays)
+                reponse['status'] = 'ok'
+            except Exception as err:
+                reponse = {'status': 'error', 'message': str(err)}
+                tableaux = {}
+            send(self.request, reponse, tableaux)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_server(adresse, maxheader=MAX_HEADER, maxdata=MAX_DATA):
+    """
+    New server (the requests are served by serve_forever)
+    :param adresse: path of a Unix socket or (host, port) for a TCP socket
+                    (ex.: ('127.0.0.1', 8765)); the Unix socket is only
+                    accessible to its owner
+    :param maxheader: largest header of a request in bytes
+    :param maxdata: largest data of the arrays of a request in bytes
+    :return: the server
+    """
+    if isinstance(adresse, tuple):
+        serveur = _TCPServer(adresse, Handler)
+    else:
+        # socket file left by a previous server
+        if os.path.exists(adresse) and \
+                stat.S_ISSOCK(os.stat(adresse).st_mode):
+            os.remove(adresse)
+        serveur = _UnixServer(adresse, Handler)
+        os.chmod(adresse, stat.S_IRUSR | stat.S_IWUSR)
+    serveur.maxheader = maxheader
+    serveur.maxdata = maxdata
+    serveur.modeles = {}
+    serveur.verrou = threading.Lock()
+    return serveur
+
+
+def add_model(serveur, nom, temps, forc, hm):
+    """
+    Add a model to a server
+    :param serveur: the server (see create_server)
+    :param nom: name of the model for the requests
+    :param temps: dictionary with info on the computational times of hf
+    :param forc: dictionary of the inputs (see hf_mordor.create)
+    :param hm: id number of the initialized hydrological model
+    """
+    with serveur.verrou:
+        serveur.modeles[nom] = {'temps': temps, 'forc': forc, 'hm': hm,
+                                'reference': _etat(hm),
+                                'verrou': threading.Lock()}
+
+
+class Client(object):
+    """ Connection to a server """
+
+    def __init__(self, adresse, timeout=None):
+        """
+        :param adresse: path of a Unix socket or (host, port)
+        :param timeout: timeout of the socket in seconds
+        """
+        if isinstance(adresse, tuple):
+            self.sock = socket.create_connection(adresse, timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(adresse)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Close the connection """
+        self.sock.close()
+
+    def request(self, op, arrays=None, **params):
+        """
+        Send a request and wait for the answer
+        :param op: name of the request
+        :param arrays: optional dictionary of arrays
+        :param params: values of the header
+        :return: the header and the arrays of the answer
+        """
+        params['op'] = op
+        send(self.sock, params, arrays)
+        header, res = receive(self.sock)
+        if header.get('status') != 'ok':
+            raise RuntimeError(header.get('message'))
+        return header, res
+
+    def run(self, model, date2=None, chunk=CHUNK):
+        """
+        Discharges of a model from its current state
+        :param model: name of the model
+        :param date2: end of the run (datetime format, default: last date
+                      of the inputs)
+        :return: array of nsteps x nsortietransfert values
+        """
+        if date2 is not None:
+            date2 = date2.strftime(FORMAT)
+        header, res = self.request('run', model=model, date2=date2,
+                                   chunk=chunk)
+        return res.get('qsim')
+
+    def intercept(self, model, idmaille, idinter, date2=None, chunk=CHUNK):
+        """
+        Discharges and interceptions of a model from its current state
+        :return: a dictionary with 'qsim' and the interceptions
+        """
+        if date2 is not None:
+            date2 = date2.strftime(FORMAT)
+        header, res = self.request('intercept', model=model, date2=date2,
+                                   chunk=chunk,
+                                   idmaille=[int(i) for i in idmaille],
+                                   idinter=[int(i) for i in idinter])
+        return res
+
+    def update(self, model, meteo, tabinj=None):
+        """
+        New time steps of the inputs of a model
+        :param meteo: arrays (nnew x ncells) 'rain', 'tmin' and 'tmax'
+        :return: the new number of time steps
+        """
+        arrays = dict([(nom, meteo[nom]) for nom in ('rain', 'tmin', 'tmax')])
+        if tabinj is not None:
+            arrays['tabinj'] = tabinj
+        header, res = self.request('update', arrays, model=model)
+        return header['ndates']
+
+    def state(self, model):
+        """
+        Current state of a model
+        :return: a dictionary of the state arrays and its 'date'
+        """
+        header, res = self.request('state', model=model)
+        res['date'] = _date(header['date'])
+        return res
+
+    def restore(self, model, etat=None):
+        """
+        Initialization of a model from a state (see state), or from its
+        state when it was added to the server
+        :return: the date of the state
+        """
+        if etat is None:
+            header, res = self.request('restore', model=model)
+        else:
+            arrays = dict([(nom, etat[nom]) for nom in
+                           ('etatproduction', 'etattransfert',
+                            'bufferproduction')])
+            header, res = self.request('restore', arrays, model=model,
+                                       date=etat['date'].strftime(FORMAT))
+        return _date(header['date'])
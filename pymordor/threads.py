@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    Concurrent runs of independent models in a pool of threads
+
+    The runs of different models (hm) release the GIL and can be computed
+    at the same time by several threads of one process, without the start
+    of new processes and the pickling of the inputs. The calls which are
+    not reentrant (creation, initialization, states, error messages) are
+    serialized by the registry of the libraries (see libraries.CALLS), the
+    creations and deletions of models wait for the end of the runs in
+    progress (see libraries.TABLES), and libraries.serialize(True) is the
+    fallback for a library that cannot run two models at once.
+
+    The error message of the library is shared by all the threads: when
+    runs fail concurrently, a message may come from another run (the
+    messages are exact with a serialized library).
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import time
+from multiprocessing.pool import ThreadPool
+from pymordor import hm_mordor
+
+
+def _run(args):
+    """ Initialization (if any) and run of a model """
+    hm, temps, matini = args
+    if matini is not None and \
+            hm_mordor.initialization(hm, temps, matini) != 0:
+        return None
+    return hm_mordor.run(hm, temps)
+
+
+def _runintercept(args):
+    """ Initialization (if any) and run of a model with interceptions """
+    hm, temps, matini, idmaille, idinter = args
+    if matini is not None and \
+            hm_mordor.initialization(hm, temps, matini) != 0:
+        return None
+    return hm_mordor.runintercept(hm, temps, idmaille, idinter)
+
+
+def _liste(valeur, n):
+    """ One value per model """
+    if isinstance(valeur, (list, tuple)):
+        if len(valeur) != n:
+            raise ValueError(str(len(valeur)) + ' values for ' + str(n) +
+                             ' models')
+        return list(valeur)
+    return [valeur] * n
+
+
+def _map(fonction, taches, nthreads):
+    """ Tasks computed by a pool of threads (in order) """
+    if nthreads is not None and nthreads <= 1:
+        return [fonction(tache) for tache in taches]
+    pool = ThreadPool(nthreads)
+    try:
+        return pool.map(fonction, taches, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(modeles, temps, matini=None, nthreads=None):
+    """
+    Run independent models concurrently
+    :param modeles: list of id numbers of hydrological models
+    :param temps: dictionary with info on the computational times, or one
+                  dictionary per model
+    :param matini: optional matrix of init values, or one per model: the
+                   models are then initialized before their run
+    :param nthreads: number of threads (default: number of CPUs, sequential
+                     runs for 1)
+    :return: list of the results of hm_mordor.run (None for a failure)
+    """
+    n = len(modeles)
+    taches = list(zip(modeles, _liste(temps, n), _liste(matini, n)))
+    return _map(_run, taches, nthreads)
+
+
+def runintercept(modeles, temps, idmaille, idinter, matini=None,
+                 nthreads=None):
+    """
+    Run independent models concurrently and get info on the states
+    :param modeles: list of id numbers of hydrological models
+    :param temps: dictionary with info on the computational times, or one
+                  dictionary per model
+    :param idmaille: list of cells for the interceptions
+    :param idinter: list interception numbers
+    :param matini: optional matrix of init values, or one per model
+    :param nthreads: number of threads (default: number of CPUs)
+    :return: list of the results of hm_mordor.runintercept
+    """
+    n = len(modeles)
+    taches = [(hm, t, m, idmaille, idinter) for hm, t, m in
+              zip(modeles, _liste(temps, n), _liste(matini, n))]
+    return _map(_runintercept, taches, nthreads)
+
+
+def benchmark(modeles, temps, matini, nthreads=None, repetitions=3):
+    """
+    Time of the runs of independent models, sequential and with threads
+    :param modeles: list of id numbers of hydrological models
+    :param temps: dictionary with info on the computational times, or one
+                  dictionary per model
+    :param matini: matrix of init values, or one per model (the models
+                   are initialized before each run)
+    :param nthreads: number of threads (default: number of CPUs)
+    :param repetitions: number of measures (the best one is kept)
+    :return: a dictionary with the times in seconds ('sequential',
+             'threads') and the 'speedup'
+    """
+    res = {}
+    for nom, n in (('sequential', 1), ('threads', nthreads)):
+        meilleur = None
+        for _ in range(repetitions):
+            debut = time.time()
+            run(modeles, temps, matini, n)
+            duree = time.time() - debut
+            if meilleur is None or duree < meilleur:
+                meilleur = duree
+        res[nom] = meilleur
+    res['speedup'] = res['sequential'] / res['threads'] \
+        if res['threads'] > 0 else float('nan')
+    return res
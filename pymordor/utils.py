@@ -8,8 +8,12 @@
 
 """
 
+import os
 import datetime
 import numpy as np
+from pymordor import drainage
+from pymordor import projection
+from pymordor.marshaling import tmstruct, tmfin
 
 
 def lambert2geo(x, y):
@@ -20,50 +24,41 @@ def lambert2geo(x, y):
     :param y: y-coordinate
     :return: a dictionary of the new coordinates
     """
-    taille = x.size
-    XS = np.ones(taille)*600000.0
-    YS = np.ones(taille)*8199695.768
-    N = 0.7289686274
-    C = 11745793.39
-    E = 0.08248325676
-    DELTA = 0.040792344
-    r = np.sqrt(np.power(x-XS, 2)+np.power(y-YS, 2))
-    g = np.arctan((x-XS)/(YS-y))
-    longitude = DELTA + g/N  # radians !
-    lambert = (-1.0/N)*np.log(np.abs(r/C))
-    p = np.pi*42.0/180.0    # starting value
-    f = 0.0
-    q = 0.0
-    v = 0.0
-    o = 0.0
-    while 1:
-        if np.max(np.abs(v-p)) < 1.e-6:
-            break
-        f = p
-        o = lambert - 0.5*np.log((1.0+np.sin(f))/(1.0-np.sin(f))) \
-            + E/2.0*np.log((1.0+E*np.sin(f))/(1.0-E*np.sin(f)))
-        f = p + 0.0001
-        q = lambert - 0.5*np.log((1.0+np.sin(f))/(1.0-np.sin(f))) \
-            + E/2.0*np.log((1.0+(E*np.sin(f)))/(1.0-E*np.sin(f)))
-        v = p
-        p = p-0.0001*o/(q-o)
-    latitude = p
-    return {'longitude': longitude, 'latitude': latitude}
+    return projection.lambert2geo(x, y)
 
 
-def datenum(date):
+def _composantes(dates):
+    """
+    Year, month, day, hour, minute and second of dates
+    :param dates: array (... x 6) of dates as [Y,M,D,H,Mn,S] or array of
+                  datetime64 dates
+    :return: list of 6 arrays
+    """
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.datetime64):
+        annees = dates.astype('M8[Y]')
+        mois = dates.astype('M8[M]')
+        jours = dates.astype('M8[D]')
+        secondes = (dates - jours) / np.timedelta64(1, 's')
+        heure = np.floor(secondes / 3600.)
+        secondes = secondes - 3600. * heure
+        mn = np.floor(secondes / 60.)
+        return [annees.astype(np.int64) + 1970,
+                (mois - annees).astype(np.int64) + 1,
+                (jours - mois).astype(np.int64) + 1,
+                heure, mn, secondes - 60. * mn]
+    return [dates[..., k] for k in range(6)]
+
+
+def datenum_array(dates):
     """
     Change the date format : Year/Month/Day/Hour/Minute/Second \
-    to a scalar number
-    :param date: a date as a list
-    :return: the corresponding number (scalar value)
+    to a scalar number, for arrays of dates
+    :param dates: array (... x 6) of dates as [Y,M,D,H,Mn,S] or array of
+                  datetime64 dates
+    :return: array of the corresponding numbers (shape of the dates)
     """
-    annee = date[0]
-    mois = date[1]
-    jour = date[2]
-    heure = date[3]
-    mn = date[4]
-    seconde = date[5]
+    annee, mois, jour, heure, mn, seconde = _composantes(dates)
     rep = ((np.mod(annee, 100) != 0) & (np.mod(annee, 4) == 0)) \
         | (np.mod(annee, 400) == 0)
     decimal_part = (seconde * (1. / (24. * 3600.))) + \
@@ -71,33 +66,41 @@ def datenum(date):
     # convert of month and day
     integer_part = jour + np.floor((mois * 3057. - 3007.) / 100.)
     # Beyond February
-    integer_part = integer_part + ((mois < 3) - 1)
+    integer_part = integer_part + ((mois < 3).astype(int) - 1)
     # Beyond February and non leap year
-    integer_part = integer_part + (((mois < 3) | (rep)) - 1)
+    integer_part = integer_part + (((mois < 3) | rep).astype(int) - 1)
     # Conversion of years
     leap_year_case = annee * 365. + (annee / 4.) - np.floor(annee / 100.) +\
         np.floor(annee / 400.)
     not_leap_year_case = annee * 365. + np.floor(annee / 4.) + \
         1 - np.floor(annee / 100.) + np.floor(annee / 400.)
-    rep = ((np.mod(annee, 100) != 0) & (np.mod(annee, 4) == 0))\
-        | (np.mod(annee, 400) == 0)
-    if rep:
-        not_leap_year_case = 0
-    else:
-        leap_year_case = 0
-    integer_part = integer_part + leap_year_case + not_leap_year_case
-    scalaire = integer_part + decimal_part
-    return {'scalar': scalaire}
+    integer_part = integer_part + np.where(rep, leap_year_case,
+                                           not_leap_year_case)
+    return integer_part + decimal_part
 
 
-def datevec(n):
+def datenum(date):
     """
-    Generate a date [Y,M,D,H,Mn,S] from a scalar number
-    :param n:
-    :return: a dictionary with the date information
+    Change the date format : Year/Month/Day/Hour/Minute/Second \
+    to a scalar number
+    :param date: a date as a list
+    :return: the corresponding number (scalar value)
+    """
+    scalaire = datenum_array(np.asarray(date[0:6]))
+    return {'scalar': scalaire[()]}
+
+
+def datevec_array(n):
+    """
+    Generate dates [Y,M,D,H,Mn,S] from an array of numbers
+    :param n: array of numbers
+    :return: a dictionary of arrays with the date information
     """
-    common_year = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
-    leap_year = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]
+    common_year = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273,
+                            304, 334, 365])
+    leap_year = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305,
+                          335, 366])
+    n = np.asarray(n, dtype=float)
     # hour, minute, second
     second = 86400. * (n - np.floor(n))
     hour = np.floor(second / 3600.)
@@ -110,36 +113,34 @@ def datevec(n):
     temp = n - (365.0 * year + np.ceil(0.25 * year)
                 - np.ceil(0.01 * year) + np.ceil(0.0025 * year))
     mask = (temp <= 0)
-    if mask:
-        year = year - 1
-        n = n - (365.0 * year + np.ceil(0.25 * year)
-                 - np.ceil(0.01 * year) + np.ceil(0.0025 * year))
-    else:
-        n = temp
+    year = np.where(mask, year - 1, year)
+    n = np.where(mask, n - (365.0 * year + np.ceil(0.25 * year)
+                            - np.ceil(0.01 * year) + np.ceil(0.0025 * year)),
+                 temp)
     # month
-    month = int(n / 29)
+    month = (n / 29).astype(int)
     # return value
     rep = ((np.mod(year, 100) != 0) & (np.mod(year, 4) == 0))\
         | (np.mod(year, 400) == 0)
-    if rep:
-        month_day_mat = leap_year[month]
-    else:
-        month_day_mat = common_year[month]
-    if n > month_day_mat:
-        month = month + 1
-    if rep:
-        month_day_mat = leap_year[month-1]
-    else:
-        month_day_mat = common_year[month-1]
+    month_day_mat = np.where(rep, leap_year[month], common_year[month])
+    month = np.where(n > month_day_mat, month + 1, month)
+    month_day_mat = np.where(rep, leap_year[month-1], common_year[month-1])
     day = n - month_day_mat
-    y = int(year)
-    mo = int(month)
-    d = int(day)
-    h = int(hour)
-    m = int(minute)
-    s = second
-    return {'year': y, 'month': mo, 'day': d,
-            'hour': h, 'minute': m, 'second': s}
+    return {'year': year.astype(int), 'month': month,
+            'day': day.astype(int), 'hour': hour.astype(int),
+            'minute': minute.astype(int), 'second': second}
+
+
+def datevec(n):
+    """
+    Generate a date [Y,M,D,H,Mn,S] from a scalar number
+    :param n:
+    :return: a dictionary with the date information
+    """
+    date = datevec_array(n)
+    return {'year': int(date['year']), 'month': int(date['month']),
+            'day': int(date['day']), 'hour': int(date['hour']),
+            'minute': int(date['minute']), 'second': date['second'][()]}
 
 
 def calcidjour(datedeb, datefin, txunit):
@@ -156,18 +157,161 @@ def calcidjour(datedeb, datefin, txunit):
     delta = datefin - datedeb
     if txunit == 'days':
         longueur = delta.days + 1
-        date_gen = [datedeb + datetime.timedelta(days=x)
-                    for x in range(0, longueur)]
+        pas = np.timedelta64(1, 'D')
     elif txunit == 'hours':
         longueur = delta.days*24+delta.seconds/3600 + 1
         longueur = int(longueur)
-        date_gen = [datedeb + datetime.timedelta(seconds=3600*x)
-                    for x in range(0, longueur)]
-    id_jour = [[date_gen[x].timetuple().tm_yday] for x in range(0, longueur)]
+        pas = np.timedelta64(3600, 's')
+    dates = np.datetime64(datedeb, 's') + np.arange(longueur) * pas
+    id_jour = _jourannee(dates).reshape(longueur, 1)
 
     return {'id_days': id_jour}
 
 
+def _jourannee(dates):
+    """ Day of the year (from 1) of datetime64 dates """
+    return (dates.astype('M8[D]') - dates.astype('M8[Y]')).astype(int) + 1
+
+
+def tmstructs(dates):
+    """
+    The 9-field 'tm' structures (as doubles) used by MORDOR-TS for dates
+    :param dates: array of datetime64 dates
+    :return: array (ndates x 9) of the structures
+    """
+    dates = np.asarray(dates, dtype='M8[s]')
+    jours = dates.astype('M8[D]')
+    mois = dates.astype('M8[M]')
+    annees = dates.astype('M8[Y]')
+    secondes = (dates - jours).astype(np.int64)
+    tm = np.empty(dates.shape + (9,))
+    tm[..., 0] = secondes % 60
+    tm[..., 1] = (secondes // 60) % 60
+    tm[..., 2] = secondes // 3600
+    tm[..., 3] = (jours - mois).astype(np.int64) + 1
+    tm[..., 4] = (mois - annees).astype(np.int64)
+    tm[..., 5] = annees.astype(np.int64) + 1970 - 1850
+    # 1970-01-01 is a Thursday (tm_wday of datetime = 3)
+    tm[..., 6] = (jours.astype(np.int64) + 3) % 7 + 1
+    tm[..., 7] = (jours - annees).astype(np.int64)
+    tm[..., 8] = -1
+    return tm
+
+
+class TimeAxis(dict):
+    """
+    Information on the calculation times: the dictionary given by time_prep
+    with time quantities computed on first use for all the dates of the
+    computation (computed again after a change of the dictionary)
+    """
+
+    def __setitem__(self, cle, valeur):
+        dict.__setitem__(self, cle, valeur)
+        self._invalide()
+
+    def __delitem__(self, cle):
+        dict.__delitem__(self, cle)
+        self._invalide()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._invalide()
+
+    def setdefault(self, cle, valeur=None):
+        if cle not in self:
+            self[cle] = valeur
+        return self[cle]
+
+    def pop(self, *args):
+        self._invalide()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._invalide()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._invalide()
+
+    def _invalide(self):
+        """ The computed quantities are forgotten """
+        self.__dict__['_valeurs'] = {}
+
+    def _valeur(self, nom, calcul):
+        """ Quantity computed on first use """
+        valeurs = self.__dict__.setdefault('_valeurs', {})
+        if nom not in valeurs:
+            valeurs[nom] = calcul()
+        return valeurs[nom]
+
+    @property
+    def dates(self):
+        """ datetime64 dates of the time steps """
+        return self._valeur('dates', lambda: np.datetime64(
+            self['date1'], 's') + np.arange(self['ndates']) *
+            np.timedelta64(self['dt'], 's'))
+
+    @property
+    def yday(self):
+        """ Day of the year (from 1) of the time steps """
+        return self._valeur('yday', lambda: _jourannee(self.dates))
+
+    @property
+    def year_starts(self):
+        """ Indices of the first time step of each year """
+        return self._valeur('annees', self._annees)[0]
+
+    @property
+    def segments(self):
+        """ Parts of the yearly weather files: (year, first row, number) """
+        return self._valeur('annees', self._annees)[1]
+
+    def _annees(self):
+        """
+        First time step and parts of the files of each year (one row per
+        time step from the 1st of January at 0h: the first file is read
+        from the row of date1, 24 rows per day for hourly files)
+        """
+        annees = self.dates.astype('M8[Y]')
+        _, premiers, nombres = np.unique(annees, return_index=True,
+                                         return_counts=True)
+        decalage = (self.yday[0] - 1) * (86400 // self['dt']) + \
+            (self.dates[0] - self.dates[0].astype('M8[D]')).astype(int) // \
+            self['dt']
+        segments = [(int(annees[i].astype(int)) + 1970,
+                     int(decalage) if k == 0 else 0, int(n))
+                    for k, (i, n) in enumerate(zip(premiers, nombres))]
+        return premiers, segments
+
+    @property
+    def tmdebut(self):
+        """ 'tm' structure of the first date """
+        return self._valeur('tmdebut', lambda: tmstruct(self['date1']))
+
+    @property
+    def tmfin(self):
+        """ 'tm' structure of the end of the computation (last time step) """
+        return self._valeur('tmfin', lambda: tmfin(self['date2'],
+                                                   self['dt']))
+
+    @property
+    def tm(self):
+        """ 'tm' structures of all the dates (ndates x 9) """
+        return self._valeur('tm', lambda: tmstructs(self.dates))
+
+
+def timeaxis(temps):
+    """
+    Time axis of a computation
+    :param temps: dictionary with info on the computational times
+    :return: temps itself if it is already a TimeAxis, else a new TimeAxis
+    """
+    if isinstance(temps, TimeAxis):
+        return temps
+    return TimeAxis(temps)
+
+
 def time_prep(firstdate, lastdate, step):
     """
     Preparation of information on the calculation times
@@ -176,7 +320,7 @@ def time_prep(firstdate, lastdate, step):
     :param step: a character indicating the calculation step
                 ('J' for days and 'H' for 'hours')
     :return: a dictionary of global information including the time period value
-            ('ndates')
+            ('ndates'), as a TimeAxis
     """
     if isinstance(firstdate, datetime.datetime) & \
        isinstance(lastdate, datetime.datetime):
@@ -194,71 +338,135 @@ def time_prep(firstdate, lastdate, step):
 
     else:
         return None
-    return{'dt': dt, 'date1': firstdate, 'date2': lastdate,
-           'txunit': txunit, 'ndates': ndates, 'step': step}
+    return TimeAxis({'dt': dt, 'date1': firstdate, 'date2': lastdate,
+                     'txunit': txunit, 'ndates': ndates, 'step': step})
+
+
+def dates64(tab):
+    """
+    datetime64 dates of the rows of a table
+    :param tab: array whose first columns are Year, Month, Day, Hour, Minute
+    :return: 1D-array of datetime64 dates (in seconds)
+    """
+    tab = np.asarray(tab)
+    annees = (tab[:, 0].astype(np.int64) - 1970).astype('M8[Y]')
+    mois = annees.astype('M8[M]') + (tab[:, 1].astype(np.int64) - 1)
+    jours = mois.astype('M8[D]') + (tab[:, 2].astype(np.int64) - 1)
+    return jours.astype('M8[s]') + \
+        tab[:, 3].astype(np.int64) * np.timedelta64(3600, 's') + \
+        tab[:, 4].astype(np.int64) * np.timedelta64(60, 's')
+
+
+class TimeSeries(object):
+    """
+    Time series indexed by its dates: the rows of a table whose first
+    columns are Year, Month, Day, Hour, Minute, followed by the values
+    """
+
+    def __init__(self, tab):
+        #: table of the time series
+        self.tab = tab
+        #: datetime64 dates of the rows
+        self.keys = dates64(tab)
+
+    def gaps(self, dt):
+        """
+        Irregularities of the time axis
+        :param dt: expected time step in seconds
+        :return: indices i of the rows such as the date of row i+1 is not
+                 the date of row i plus one time step
+        """
+        return np.nonzero(np.diff(self.keys) != np.timedelta64(dt, 's'))[0]
+
+    def bounds(self, firstdate, lastdate):
+        """
+        Indices of the last rows before or at two dates
+        :param firstdate: first date (datetime format)
+        :param lastdate: last date (datetime format)
+        :return: the two indices (0 and the number of rows for dates before
+                 the first row)
+        """
+        cles = np.array([firstdate, lastdate], dtype='M8[s]')
+        i1, i2 = np.searchsorted(self.keys, cles, side='right') - 1
+        if i1 < 0:
+            i1 = 0
+        if i2 < 0:
+            i2 = self.keys.size
+        return int(i1), int(i2)
+
+    def cut(self, firstdate, lastdate, colonne=5):
+        """
+        Values between two dates (view on the table, no copy)
+        :param firstdate: first date (datetime format)
+        :param lastdate: last date (datetime format)
+        :param colonne: column of the values
+        :return: 1D-array of values
+        """
+        i1, i2 = self.bounds(firstdate, lastdate)
+        return self.tab[i1:i2, colonne]
 
 
 def cutarray(tab, firstdate, lastdate, txunit):
     """
     Extraction of data from a time series
-    :param tab: array of data
+    :param tab: array of data (or TimeSeries, to reuse the index of dates)
     :param firstdate: date of the begining of the calculation (datetime format)
     :param lastdate: date of the end of the calculation (datetime format)
     :param txunit: time step 'days' or 'hours'
     :return: 1D-array of values between firstdate and lastdate (time series)
     """
-    nc = tab.shape[1]
-    ndt = tab.shape[0]
+    if isinstance(tab, TimeSeries):
+        serie = tab
+    else:
+        serie = TimeSeries(tab)
     # check that all the time steps are present
-    date1 = datetime.datetime(int(tab[0, 0]), int(tab[0, 1]), int(tab[0, 2]),
-                              int(tab[0, 3]), int(tab[0, 4]))
-    date2 = datetime.datetime(int(tab[-1, 0]), int(tab[-1, 1]),
-                              int(tab[-1, 2]), int(tab[-1, 3]),
-                              int(tab[-1, 4]))
-    if date2 <= date1:
+    if serie.keys[-1] <= serie.keys[0]:
         return None
-    else:
-        delta = date2 - date1
     if txunit == 'days':
-        nbok = delta.days + 1
+        dt = 86400
     elif txunit == 'hours':
-        nbok = int(delta.days*24 + delta.seconds/3600 + 1)
-    if nbok != ndt:
+        dt = 3600
+    if serie.gaps(dt).size > 0:
         return None
     if firstdate >= lastdate:
         return None
-    # indices for cutting
-    i1 = 0
-    i2 = ndt
-    for i in range(0, ndt):
-        datec = datetime.datetime(int(tab[i, 0]), int(tab[i, 1]),
-                                  int(tab[i, 2]), int(tab[i, 3]),
-                                  int(tab[i, 4]))
-        if datec <= firstdate:
-            i1 = i
-        if datec <= lastdate:
-            i2 = i
     # extracting results
-    return tab[i1:i2, 5]
+    return serie.cut(firstdate, lastdate)
 
 
-def upstream_list(maillage, id_exut):
+def upstream_list(maillage, id_exut, index=None):
     """
     upstream of id_exut
     :param maillage: dictionary of the hydrological mesh
     :param id_exut: outlet id number
+    :param index: optional drainage index of the mesh (drainage.build_index),
+                  by default the one kept in the mesh (drainage.mesh_index)
     :return: 1D-array of cell numbers
     """
-    nmailles = range(1, maillage['nmailles']+1)
+    if index is None:
+        index = drainage.mesh_index(maillage)
     mailleamont = [id_exut]
     recherche = [id_exut]
     while len(recherche) > 0:
         ajout = []
-        for i in range(0, len(recherche)):
-            im = recherche[i]
-            ajout.extend(np.take(nmailles,
-                                 np.where(maillage['topologie'] == im))
-                         .ravel().tolist())
+        for im in recherche:
+            ajout.extend((index['fils'][index['indptr'][im-1]:
+                                        index['indptr'][im]] + 1).tolist())
         mailleamont.extend(ajout)
         recherche = ajout
     return np.array(mailleamont)
+
+
+def replace_file(tmp, cible):
+    """
+    Renaming of a temporary file, replacing the target (atomic except on
+    Python 2, where the target is removed first)
+    :param tmp: the name of the temporary file
+    :param cible: the name of the target file
+    """
+    if hasattr(os, 'replace'):
+        os.replace(tmp, cible)
+    else:
+        if os.path.isfile(cible):
+            os.remove(cible)
+        os.rename(tmp, cible)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    Compact storage of the regression (weight) matrices of MORDOR-TS
+
+    A matrix is a dictionary with a 'format' ('diag' or 'csr'), its 'shape'
+    and its non-zero values. It is expanded into the dense column-major
+    buffer required by the library only when the model is created.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import numpy as np
+
+
+def identity(nrows, ncols):
+    """
+    Identity matrix, completed with null rows or columns
+    :param nrows: number of rows
+    :param ncols: number of columns
+    :return: a compact matrix
+    """
+    return diagonal(np.ones(min(nrows, ncols)), nrows, ncols)
+
+
+def diagonal(values, nrows=None, ncols=None):
+    """
+    Diagonal matrix
+    :param values: 1D-array of the diagonal values
+    :param nrows: number of rows (default: number of values)
+    :param ncols: number of columns (default: number of values)
+    :return: a compact matrix
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    nrows = values.size if nrows is None else nrows
+    ncols = values.size if ncols is None else ncols
+    if values.size > min(nrows, ncols):
+        raise ValueError('too many diagonal values for the shape ' +
+                         str((nrows, ncols)))
+    return {'format': 'diag', 'shape': (nrows, ncols), 'data': values}
+
+
+def csr(dense):
+    """
+    Compressed sparse row matrix
+    :param dense: 2D-array
+    :return: a compact matrix
+    """
+    dense = np.asarray(dense, dtype=np.float64)
+    rows, cols = np.nonzero(dense)
+    indptr = np.zeros(dense.shape[0]+1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=dense.shape[0]), out=indptr[1:])
+    return {'format': 'csr', 'shape': dense.shape, 'indptr': indptr,
+            'indices': cols, 'data': dense[rows, cols]}
+
+
+def iscompact(mat):
+    """
+    Check if a matrix is in a compact format
+    :param mat: a compact matrix or an array
+    :return: True for a compact matrix
+    """
+    return isinstance(mat, dict) and 'format' in mat
+
+
+def tofortran(mat, out=None):
+    """
+    Dense matrix in column-major order, as a flat buffer for the library
+    :param mat: a compact matrix
+    :param out: optional 1D-array of nrows*ncols values to fill
+    :return: 1D-array of nrows*ncols values
+    """
+    nrows, ncols = mat['shape']
+    if out is None:
+        out = np.zeros(nrows*ncols)
+    elif out.size != nrows*ncols:
+        raise ValueError('wrong size of buffer: ' + str(out.size) +
+                         ' values instead of ' + str(nrows*ncols))
+    else:
+        out.fill(0.0)
+    if mat['format'] == 'diag':
+        k = np.arange(mat['data'].size)
+        out[k + k*nrows] = mat['data']
+    elif mat['format'] == 'csr':
+        rows = np.repeat(np.arange(nrows), np.diff(mat['indptr']))
+        out[rows + mat['indices']*nrows] = mat['data']
+    else:
+        raise ValueError('unknown matrix format: ' + str(mat['format']))
+    return out
+
+
+def todense(mat):
+    """
+    Dense 2D-array of a compact matrix
+    :param mat: a compact matrix
+    :return: 2D-array
+    """
+    return tofortran(mat).reshape(mat['shape'], order='F')
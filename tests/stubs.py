@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    Stubs of the MORDOR-TS libraries for the tests
+
+    The stubs are compiled with the C compiler of the system (the tests
+    using them are skipped without it). They do not compute anything
+    hydrological: their results only depend on their inputs, so that two
+    ways of computing the same inputs can be compared.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import datetime
+import shutil
+import subprocess
+import tempfile
+import unittest
+from ctypes import c_double
+import numpy as np
+from pymordor import libraries, utils
+
+MORDORGLOBAL = r"""
+int mordor_prep_param(double *pmt, double *etag, double *don, double *cond,
+                      int *flag, double *pmt2, double *don2, double *cond2)
+{
+    int npas = (int)cond[0], k, c;
+    for (k = 0; k < 150; k++)
+        pmt2[k] = pmt[k % 49] + 0.001 * k + don[5 * (npas - 1) + 2] +
+                  etag[1] + etag[0];
+    for (k = 0; k < 150; k++)
+        cond2[k] = cond[k % 9] + k;
+    for (k = 0; k < npas; k++)
+        for (c = 0; c < 10; c++)
+            don2[c * 200000 + k] = don[5 * k + (c % 5)] * 2;
+    *flag = 1;
+    return 0;
+}
+/* the number of time steps is given by the conditions */
+int mordor_initialisation(double *pmt, double *tnn, double *txn,
+                          double *cond, int *flag, double *tpn, double *kc,
+                          double *ei)
+{
+    int npas = (int)cond[0], t;
+    double a = 0.0;
+    for (t = 0; t < npas; t++) {
+        a = 0.9 * a + 0.1 * (tnn[t] + txn[t]) / 2 + pmt[3] * 1e-3;
+        tpn[t] = a;
+    }
+    for (t = 0; t < 366; t++)
+        kc[t] = pmt[1] + t + pmt[5];
+    for (t = 0; t < 80; t++)
+        ei[t] = pmt[t % 150] + t;
+    for (t = 0; t < 10; t++)
+        flag[t] = t;
+    return 0;
+}
+"""
+
+WRAPPERMODELEHYDRO = r"""
+#include <string.h>
+#define NMAX 1000
+static int nm[NMAX], ns[NMAX], nh = 0, nf = 0;
+static double tmst[NMAX][9];
+/* checksums of the series of the sites: sum of (i+1)*v[i], length */
+static double forc[NMAX][8][64];
+static int nforc[NMAX][8][64];
+int CreerBaseForcage(char *n, int np, double *cp, int nme, double *cm,
+                     int nq, int nd, double *tm, double dt)
+{ return ++nf % NMAX; }
+int RemplirSiteForcage(int h, int f, int s, int nd, double *v)
+{
+    double t = 0.0;
+    int i;
+    for (i = 0; i < nd; i++)
+        t += v[i] * (i + 1);
+    forc[h][f][s] = t;
+    nforc[h][f][s] = nd;
+    return 0;
+}
+double GetForc(int h, int f, int s) { return forc[h][f][s]; }
+int GetNForc(int h, int f, int s) { return nforc[h][f][s]; }
+int CreerModele(char *n, int nmai, int *top, int nd, double *de, double dt,
+                int nst, int *mst, int npar, int nj, double *mp, int *jm,
+                int hf, int dp, int dt2, double *rp, double *rt, int *ti,
+                double *kc)
+{
+    nh = nh % (NMAX - 1) + 1;
+    nm[nh] = nmai;
+    ns[nh] = nst;
+    return nh;
+}
+int GetDimModele(int h, int *n, int *nst, int *nb, double *dt)
+{ *n = nm[h]; *nst = ns[h]; *nb = 3; *dt = 86400; return 0; }
+int InitModele(int h, double *tm, double *ep, int a, int b, double *et,
+               int c, int d, double *bp, int e, int f)
+{ memcpy(tmst[h], tm, 9 * sizeof(double)); return 0; }
+/* number of days from the date of the state (same year) */
+static int ndays(int h, double *tm)
+{ return (int)(tm[7] - tmst[h][7]) + 365 * (int)(tm[5] - tmst[h][5]); }
+int RunMordor(int h, double *tm)
+{ memcpy(tmst[h], tm, 9 * sizeof(double)); return 0; }
+int hmRunMordor(int h, double *tm, double *q)
+{
+    int i, n = ndays(h, tm) * ns[h];
+    for (i = 0; i < n; i++)
+        q[i] = h * 1000 + i;
+    memcpy(tmst[h], tm, 9 * sizeof(double));
+    return 0;
+}
+int hmRunMordorIntercept(int h, double *tm, int nmi, int *im, int ni,
+                         int *ii, double *q, double *it)
+{
+    int i, n = ndays(h, tm);
+    for (i = 0; i < n * ns[h]; i++)
+        q[i] = h * 1000 + i;
+    for (i = 0; i < n * nmi * ni; i++)
+        it[i] = i;
+    memcpy(tmst[h], tm, 9 * sizeof(double));
+    return 0;
+}
+int GetIntercept(int h, int n, double **p) { return 0; }
+int R_GetEtatModele(int h, double *ep, double *et, double *bp, double *q)
+{
+    int i;
+    for (i = 0; i < 80 * nm[h]; i++)
+        ep[i] = i;
+    return 0;
+}
+int GetDateEtat(int h, double *tm)
+{ memcpy(tm, tmst[h], 9 * sizeof(double)); return 0; }
+char *GetErreur(void) { return "stub error"; }
+char *VersionModele(void) { return "stub"; }
+int DetruireModele(int h) { return 0; }
+int DetruireForcage(int h) { return 0; }
+int mktime_(double *tm) { return 0; }
+"""
+
+RUNMORDORTS = r"""
+int vide(void) { return 0; }
+"""
+
+LITDONNEESMODELE = r"""
+void lit_postes(void) {}
+void lit_maillage_bandes(void) {}
+void lit_contraintes(void) {}
+"""
+
+SOURCES = {'MordorGlobal': MORDORGLOBAL,
+           'WrapperModeleHydro': WRAPPERMODELEHYDRO,
+           'RunMordorTS': RUNMORDORTS,
+           'LitDonneesModele': LITDONNEESMODELE}
+
+
+def compile_stubs(repertoire, sources=SOURCES):
+    """
+    Stub libraries compiled in a folder
+    :return: False without a C compiler
+    """
+    for nom, source in sources.items():
+        fichier = os.path.join(repertoire, nom + '.c')
+        with open(fichier, 'w') as fic:
+            fic.write(source)
+        try:
+            subprocess.check_call(['cc', '-shared', '-fPIC', '-o',
+                                   os.path.join(repertoire, 'lib' + nom +
+                                                '.so'), fichier])
+        except (OSError, subprocess.CalledProcessError):
+            return False
+    return True
+
+
+def forget(noms=tuple(SOURCES)):
+    """ Libraries removed from the registry (loaded again on next use) """
+    for nom in noms:
+        libraries._CHARGEES.pop(nom, None)
+        for cle in [cle for cle in libraries._DECLAREES if cle[0] == nom]:
+            libraries._DECLAREES.discard(cle)
+
+
+class StubTestCase(unittest.TestCase):
+    """ Tests with the stubs of all the libraries """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.repertoire = tempfile.mkdtemp()
+        cls.libmordor = os.environ.get('LIBMORDOR')
+        if not compile_stubs(cls.repertoire):
+            shutil.rmtree(cls.repertoire)
+            raise unittest.SkipTest('no C compiler')
+        os.environ['LIBMORDOR'] = cls.repertoire
+        forget()
+        cls.stub = libraries.load('WrapperModeleHydro')
+        cls.stub.GetForc.restype = c_double
+
+    @classmethod
+    def tearDownClass(cls):
+        forget()
+        if cls.libmordor is None:
+            os.environ.pop('LIBMORDOR', None)
+        else:
+            os.environ['LIBMORDOR'] = cls.libmordor
+        shutil.rmtree(cls.repertoire)
+
+
+def mesh(nmailles=4, seed=0):
+    """ Small mesh of two sub-basins, the outlet at the third cell """
+    rng = np.random.RandomState(seed)
+    sbv = np.arange(nmailles) % 2 + 1
+    topologie = np.arange(2, nmailles + 2)
+    topologie[2] = 0
+    topologie[topologie > nmailles] = 3
+    contraintes = np.zeros(nmailles, dtype=int)
+    contraintes[2] = 1
+    return {'nmailles': nmailles, 'nbandes': 3, 'nqinj': 0,
+            'descripteurs': rng.rand(nmailles, 7),
+            'altitudes': rng.rand(nmailles, 3) * 1000, 'sbv': sbv,
+            'topologie': topologie, 'contraintes': contraintes}
+
+
+def weather(ndates, nmailles=4, seed=1):
+    """ Random rain and temperatures """
+    rng = np.random.RandomState(seed)
+    return {'rain': rng.rand(ndates, nmailles),
+            'tmin': rng.rand(ndates, nmailles),
+            'tmax': rng.rand(ndates, nmailles) + 1.0}
+
+
+def days(ndays, first=datetime.datetime(2000, 1, 1)):
+    """ Daily computation of ndays days """
+    return utils.time_prep(first, first + datetime.timedelta(days=ndays-1),
+                           'D')
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    Objectives and checkpoints of the calibration
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from pymordor import calibration
+
+QOBS = np.array([[1.], [2.], [3.], [4.]])
+QSIM = np.array([[1.], [2.], [3.], [5.]])
+
+
+class TestObjectives(unittest.TestCase):
+
+    def test_nse(self):
+        """ 1 - 1 / 5 """
+        self.assertAlmostEqual(calibration.nse(QSIM, QOBS)[0], 0.8)
+
+    def test_kge(self):
+        """ Correlation, ratio of the deviations and of the means """
+        r = 6.5 / np.sqrt(8.75 * 5.)
+        alpha = np.sqrt(8.75 / 5.)
+        beta = 2.75 / 2.5
+        attendu = 1. - np.sqrt((r - 1.)**2 + (alpha - 1.)**2 +
+                               (beta - 1.)**2)
+        self.assertAlmostEqual(calibration.kge(QSIM, QOBS)[0], attendu)
+        self.assertAlmostEqual(calibration.kge(QOBS, QOBS)[0], 1.)
+
+    def test_lognse(self):
+        """ NSE of the logarithms, epsilon given or 1/100 of the mean """
+        for epsilon, donne in ((0., 0.), (0.025, None)):
+            lobs = np.log(np.array([1., 2., 3., 4.]) + epsilon)
+            num = (np.log(5. + epsilon) - lobs[3])**2
+            den = ((lobs - lobs.mean())**2).sum()
+            self.assertAlmostEqual(
+                calibration.lognse(QSIM, QOBS, donne)[0], 1. - num / den)
+
+    def test_missing(self):
+        """ Missing observations left out """
+        qobs = np.array([[1.], [np.nan], [2.], [3.], [4.]])
+        qsim = np.array([[1.], [7.], [2.], [3.], [5.]])
+        self.assertAlmostEqual(calibration.nse(qsim, qobs)[0], 0.8)
+
+    def test_scores(self):
+        """ Mean over the observed outlets, -inf for the failed members """
+        qobs = np.column_stack((QOBS, QOBS * np.nan))
+        qsim = np.array([np.column_stack((QSIM, QSIM)),
+                         np.column_stack((QOBS, QSIM)),
+                         np.column_stack((QSIM * np.nan, QSIM))])
+        res = calibration.scores(qsim, qobs)
+        np.testing.assert_allclose(res[0:2], [0.8, 1.])
+        self.assertEqual(res[2], -np.inf)
+        self.assertRaises(ValueError, calibration.scores, qsim, qobs * np.nan)
+        # the warm-up leaves out the first time steps
+        self.assertAlmostEqual(calibration.scores(qsim, qobs, 'nse', 2)[0],
+                               1. - 1. / 0.5)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.rep = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rep)
+        self.fichier = os.path.join(self.rep, 'calibration.npz')
+        self.lower = np.zeros((1, 49))
+        self.upper = np.ones((1, 49))
+        etat = {'population': np.zeros((4, 49)), 'scores': np.zeros(4),
+                'generation': 1, 'lower': self.lower, 'upper': self.upper,
+                'objective': np.array('nse')}
+        calibration._sauve(self.fichier, etat, np.random.RandomState(0))
+
+    def _reprend(self, lower, upper, objective):
+        """ Resume of the saved calibration (fails before any run) """
+        calibration.calibrate(None, None, None, None, None, lower, upper,
+                              objective, popsize=4, generations=1,
+                              checkpoint=self.fichier)
+
+    def test_different(self):
+        """ Other bounds or objective: the checkpoint is refused """
+        upper = self.upper.copy()
+        upper[0, 3] = 2.
+        self.assertRaises(ValueError, self._reprend, self.lower, upper, 'nse')
+        self.assertRaises(ValueError, self._reprend, self.lower - 1.,
+                          self.upper, 'nse')
+        self.assertRaises(ValueError, self._reprend, self.lower, self.upper,
+                          'kge')
+
+    def test_same(self):
+        """ Same calibration: resumed (already finished) """
+        res = calibration.calibrate(None, None, None, None, None, self.lower,
+                                    self.upper, 'nse', popsize=4,
+                                    generations=1, checkpoint=self.fichier)
+        self.assertEqual(res['population'].shape, (4, 1, 49))
+
+
+if __name__ == '__main__':
+    unittest.main()
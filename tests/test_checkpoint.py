@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    Checkpoints of the states of the models with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import stubs
+from pymordor import checkpoint, hf_mordor, hm_mordor
+from pymordor.modelehydro import getdateetat, getetatmodele, initmodele
+
+PARAMS = np.ones(49)
+DATES = [datetime.datetime(2000, 1, j) for j in (2, 5, 9)]
+
+
+class TestCheckpoint(stubs.StubTestCase):
+
+    def setUp(self):
+        self.rep = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rep)
+        temps = stubs.days(10)
+        forc = hf_mordor.create(temps, stubs.mesh(), stubs.weather(10),
+                                np.zeros(9), PARAMS)
+        self.hm = hm_mordor.create(temps, stubs.mesh(), forc)
+        self.etat = getetatmodele(self.hm)
+
+    def _date(self, date):
+        """ State of the model moved to a date """
+        self.assertEqual(initmodele(self.hm, date,
+                                    self.etat['etatproduction'],
+                                    self.etat['etattransfert'],
+                                    self.etat['bufferproduction']), 0)
+
+    def _sauve(self):
+        """ Checkpoints at all the dates """
+        for date in DATES:
+            self._date(date)
+            fichier = checkpoint.save(self.hm, self.rep, 'bv', PARAMS)
+            self.assertTrue(os.path.isfile(fichier))
+
+    def test_roundtrip(self):
+        """ Saved, found, read and given back to the model """
+        self._sauve()
+        self.assertEqual(checkpoint.dates(self.rep, 'bv', PARAMS), DATES)
+        # other basin or other parameters: no checkpoint
+        self.assertEqual(checkpoint.dates(self.rep, 'autre', PARAMS), [])
+        self.assertEqual(checkpoint.dates(self.rep, 'bv', PARAMS * 2), [])
+        jour = datetime.datetime(2000, 1, 7)
+        self.assertEqual(checkpoint.nearest(self.rep, 'bv', PARAMS, jour),
+                         DATES[1])
+        self.assertEqual(checkpoint.nearest(self.rep, 'bv', PARAMS,
+                                            DATES[2]), DATES[2])
+        self.assertIsNone(checkpoint.nearest(self.rep, 'bv', PARAMS,
+                                             datetime.datetime(2000, 1, 1)))
+        etat = checkpoint.load(self.rep, 'bv', PARAMS, DATES[1])
+        self.assertEqual(etat['date'], DATES[1])
+        for nom in ('etatproduction', 'etattransfert', 'bufferproduction',
+                    'qmoyen'):
+            np.testing.assert_array_equal(etat[nom], self.etat[nom])
+        # the model goes back to the checkpoint
+        self.assertEqual(checkpoint.restore(self.hm, self.rep, 'bv', PARAMS,
+                                            jour), DATES[1])
+        self.assertEqual(getdateetat(self.hm), DATES[1])
+        self.assertIsNone(checkpoint.restore(
+            self.hm, self.rep, 'bv', PARAMS, datetime.datetime(2000, 1, 1)))
+        self.assertEqual(getdateetat(self.hm), DATES[1])
+
+    def test_purge(self):
+        """ Only the most recent checkpoints are kept """
+        self._sauve()
+        # foreign files are left alone
+        autre = os.path.join(os.path.dirname(checkpoint.save(
+            self.hm, self.rep, 'bv', PARAMS)), 'notes.txt')
+        open(autre, 'w').close()
+        self.assertEqual(checkpoint.purge(self.rep, 'bv', PARAMS, 2), 1)
+        self.assertEqual(checkpoint.dates(self.rep, 'bv', PARAMS), DATES[1:])
+        self.assertEqual(checkpoint.purge(self.rep, 'bv', PARAMS, 5), 0)
+        self.assertEqual(checkpoint.purge(self.rep, 'bv', PARAMS, 0), 2)
+        self.assertEqual(checkpoint.dates(self.rep, 'bv', PARAMS), [])
+        self.assertTrue(os.path.isfile(autre))
+        self.assertEqual(checkpoint.purge(self.rep, 'autre', PARAMS, 0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    Drainage index of a mesh against a scan of the topology
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import unittest
+import numpy as np
+from pymordor import drainage, utils
+
+
+def _maillage(nmailles, seed=0):
+    """ Random mesh of two basins: each cell drains into a smaller one """
+    rng = np.random.RandomState(seed)
+    topologie = np.zeros(nmailles, dtype=int)
+    for i in range(2, nmailles):
+        topologie[i] = rng.randint(1, i + 1)
+    contraintes = np.zeros(nmailles, dtype=int)
+    contraintes[[0, 1, 5]] = 1
+    return {'nmailles': nmailles, 'topologie': topologie,
+            'contraintes': contraintes}
+
+
+def _amont(maillage, id_exut):
+    """ Upstream cells found by scanning the topology (first version) """
+    nmailles = range(1, maillage['nmailles'] + 1)
+    mailleamont = [id_exut]
+    recherche = [id_exut]
+    while len(recherche) > 0:
+        ajout = []
+        for im in recherche:
+            ajout.extend(np.take(nmailles,
+                                 np.where(maillage['topologie'] == im))
+                         .ravel().tolist())
+        mailleamont.extend(ajout)
+        recherche = ajout
+    return np.array(mailleamont)
+
+
+class TestDrainage(unittest.TestCase):
+
+    def setUp(self):
+        self.maillage = _maillage(60)
+        self.index = drainage.build_index(self.maillage)
+
+    def test_upstream_list(self):
+        """ Same cells in the same order as the scan of the topology """
+        for c in range(1, 61):
+            np.testing.assert_array_equal(
+                utils.upstream_list(self.maillage, c),
+                _amont(self.maillage, c))
+
+    def test_upstream(self):
+        """ Upstream areas, membership and sums """
+        valeurs = np.arange(1., 61.)
+        sommes = drainage.upstream_sum(self.index, valeurs)
+        for c in range(1, 61):
+            amont = drainage.upstream(self.index, c)
+            self.assertEqual(amont[0], c)
+            self.assertEqual(sorted(amont), sorted(_amont(self.maillage, c)))
+            dedans = drainage.is_upstream(self.index, np.arange(1, 61), c)
+            self.assertEqual(sorted(np.nonzero(dedans)[0] + 1),
+                             sorted(amont))
+            self.assertEqual(sommes[c - 1], valeurs[amont - 1].sum())
+        sorties = drainage.outlets(self.index, self.maillage)
+        self.assertEqual(sorted(sorties), [1, 2, 6])
+
+    def test_downstream(self):
+        """ Path to the outlet """
+        for c in range(1, 61):
+            chemin = drainage.downstream(self.index, c)
+            self.assertEqual(chemin[0], c)
+            self.assertEqual(self.maillage['topologie'][chemin[-1] - 1], 0)
+            for amont, aval in zip(chemin[:-1], chemin[1:]):
+                self.assertEqual(self.maillage['topologie'][amont - 1], aval)
+
+    def test_loop(self):
+        """ A topology with a loop is refused """
+        maillage = {'nmailles': 3, 'topologie': np.array([2, 3, 1])}
+        self.assertRaises(ValueError, drainage.build_index, maillage)
+
+    def test_mesh_index(self):
+        """ Index kept in the mesh, built again for a new topology """
+        index = drainage.mesh_index(self.maillage)
+        self.assertIs(drainage.mesh_index(self.maillage), index)
+        self.maillage['topologie'] = self.maillage['topologie'].copy()
+        self.maillage['topologie'][10] = 0
+        nouveau = drainage.mesh_index(self.maillage)
+        self.assertIsNot(nouveau, index)
+        np.testing.assert_array_equal(utils.upstream_list(self.maillage, 11),
+                                      _amont(self.maillage, 11))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+    Runs of an ensemble of parameters with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import unittest
+import numpy as np
+import stubs
+from pymordor import ensemble
+
+
+class TestEnsemble(stubs.StubTestCase):
+
+    def setUp(self):
+        self.arguments = (stubs.days(10), stubs.mesh(), stubs.weather(10),
+                          np.zeros(9))
+        self.matparams = list(np.random.RandomState(0).rand(4, 2, 49) + 1.)
+
+    def test_serial(self):
+        """ Members run serially or by processes, serial inputs released """
+        serie = ensemble.run(*self.arguments, matparams=self.matparams)
+        self.assertEqual(ensemble._CONTEXTE, {})
+        self.assertEqual(serie['failed'], [])
+        self.assertEqual(serie['qsim'].shape, (4, 9, 1))
+        processus = ensemble.run(*self.arguments, matparams=self.matparams,
+                                 nprocs=2)
+        # the stub numbers the discharges after the handles of the models
+        self.assertEqual(processus['failed'], [])
+        self.assertTrue(np.all(np.isfinite(processus['qsim'])))
+
+    def test_error(self):
+        """ Inputs released when the weather cannot be read """
+        temps, maillage, _, etat0 = self.arguments
+        self.assertRaises(Exception, ensemble.run, temps, maillage,
+                          ('/inexistant', 'bv'), etat0, self.matparams)
+        self.assertEqual(ensemble._CONTEXTE, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    Inputs of the models (hf) with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import unittest
+import numpy as np
+import stubs
+from pymordor import hf_mordor
+
+PARAM = np.linspace(0.1, 4.9, 49)
+# no warm-up time steps: the stubs read cond[0] time steps
+ETAT0 = np.array([0., 1., 2., 3., 4., 5., 6., 7., 8.])
+
+
+class TestUpdate(stubs.StubTestCase):
+
+    def setUp(self):
+        self.maillage = stubs.mesh()
+        self.meteo = stubs.weather(400)
+
+    def _create(self, ndates, capacite=None):
+        meteo = dict((nom, v[0:ndates]) for nom, v in self.meteo.items())
+        return hf_mordor.create(stubs.days(ndates), self.maillage, meteo,
+                                ETAT0, PARAM, capacite=capacite)
+
+    def _sites(self, hf):
+        """ Checksums of the series of the sites of hf """
+        return np.array([[self.stub.GetForc(hf, f, s) for f in (1, 3, 4, 6)]
+                         for s in range(1, self.maillage['nmailles'] + 1)])
+
+    def test_full(self):
+        """
+        Update from the first time step: the new time steps are those of
+        a full creation (the first ones are kept)
+        """
+        forc = self._create(100, capacite=400)
+        avant = forc['series']['tpn'][:, 0:100].copy()
+        nouvelles = dict((nom, v[100:400]) for nom, v in self.meteo.items())
+        self.assertEqual(hf_mordor.update(forc, nouvelles), 400)
+        complet = self._create(400, capacite=400)
+        np.testing.assert_array_equal(forc['series']['tpn'][:, 100:],
+                                      complet['series']['tpn'][:, 100:])
+        np.testing.assert_array_equal(forc['series']['tpn'][:, 0:100], avant)
+        np.testing.assert_array_equal(self._sites(forc['hf'])[:, 0:3],
+                                      self._sites(complet['hf'])[:, 0:3])
+        complet['series']['tpn'][:, 0:100] = avant
+        tpn = [self.stub.GetForc(forc['hf'], 6, s) for s in range(1, 5)]
+        np.testing.assert_allclose(
+            tpn, np.dot(complet['series']['tpn'], np.arange(1, 401)),
+            rtol=1e-12)
+
+    def test_overlap(self):
+        """ Short overlap: only the new time steps are computed again """
+        forc = self._create(300, capacite=400)
+        avant = forc['series']['tpn'].copy()
+        nouvelles = dict((nom, v[300:400]) for nom, v in self.meteo.items())
+        hf_mordor.update(forc, nouvelles, overlap=200)
+        np.testing.assert_array_equal(forc['series']['tpn'][:, 0:300],
+                                      avant[:, 0:300])
+        self.assertTrue(np.all(forc['series']['tpn'][:, 300:] != 0))
+        complet = self._create(400, capacite=400)
+        self.assertTrue(np.allclose(forc['series']['tpn'][:, 300:],
+                                    complet['series']['tpn'][:, 300:]))
+
+    def test_errors(self):
+        """ Capacity, shapes and inputs without capacity """
+        forc = self._create(100, capacite=150)
+        nouvelles = dict((nom, v[100:200]) for nom, v in self.meteo.items())
+        self.assertRaises(ValueError, hf_mordor.update, forc, nouvelles)
+        nouvelles = dict((nom, v[100:110, 0:3])
+                         for nom, v in self.meteo.items())
+        self.assertRaises(ValueError, hf_mordor.update, forc, nouvelles)
+        self.assertEqual(forc['ndates'], 100)
+        forc = self._create(100)
+        self.assertNotIn('series', forc)
+        nouvelles = dict((nom, v[100:110]) for nom, v in self.meteo.items())
+        self.assertRaises(ValueError, hf_mordor.update, forc, nouvelles)
+
+
+if __name__ == '__main__':
+    unittest.main()
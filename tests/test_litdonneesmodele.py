@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    Reading of the weather files
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import json
+import shutil
+import datetime
+import tempfile
+import unittest
+import numpy as np
+from pymordor import litdonneesmodele, utils
+
+
+def _fichiers(rep, sousrep, annees, lignes):
+    """
+    Yearly files of two cells: row r of year a holds a*1e5 + r and
+    a*1e5 + r + 0.5
+    """
+    os.makedirs(os.path.join(rep, 'Meteo', sousrep))
+    for annee in annees:
+        r = np.arange(lignes(annee))
+        np.savetxt(os.path.join(rep, 'Meteo', sousrep,
+                                'Forcage_carreau_bv_' + str(annee) + '.txt'),
+                   np.column_stack((annee * 1e5 + r, annee * 1e5 + r + 0.5)),
+                   fmt='%.1f')
+
+
+def _attendu(annee, lignes):
+    """ Values of the rows of a year """
+    lignes = np.asarray(lignes)
+    return np.column_stack((annee * 1e5 + lignes, annee * 1e5 + lignes + 0.5))
+
+
+class TestMeteo(unittest.TestCase):
+
+    def setUp(self):
+        self.rep = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rep)
+
+    def _lit(self, temps):
+        """ Values read from the text files and from the cache """
+        res = litdonneesmodele.litficmeteo(self.rep, temps, 'bv')
+        cache = os.path.join(self.rep, 'cache')
+        for k in range(2):
+            binaire = litdonneesmodele.litficmeteo(self.rep, temps, 'bv',
+                                                   cache, nthreads=2)
+            for nom in res:
+                np.testing.assert_array_equal(binaire[nom], res[nom])
+        return res
+
+    def test_daily(self):
+        """ Rows from the day of the year of date1, as in the first version """
+        for nom in ('Precip', 'Tn', 'Tx'):
+            _fichiers(self.rep, nom, (2000, 2001), lambda a: 365 + (a == 2000))
+        temps = utils.time_prep(datetime.datetime(2000, 12, 30),
+                                datetime.datetime(2001, 1, 3), 'D')
+        res = self._lit(temps)
+        attendu = np.vstack((_attendu(2000, [364, 365]),
+                             _attendu(2001, [0, 1, 2])))
+        for nom in ('rain', 'tmin', 'tmax'):
+            np.testing.assert_array_equal(res[nom], attendu)
+
+    def test_hourly(self):
+        """ 24 rows per day: rows from the hour of date1 """
+        for nom in ('Precip', 'Tair'):
+            _fichiers(self.rep, nom, (2000, 2001),
+                      lambda a: 24 * (365 + (a == 2000)))
+        temps = utils.time_prep(datetime.datetime(2000, 12, 31, 22),
+                                datetime.datetime(2001, 1, 1, 3), 'H')
+        res = self._lit(temps)
+        attendu = np.vstack((_attendu(2000, [365 * 24 + 22, 365 * 24 + 23]),
+                             _attendu(2001, [0, 1, 2, 3])))
+        for nom in ('rain', 'tmin', 'tmax'):
+            np.testing.assert_array_equal(res[nom], attendu)
+
+    def test_missing(self):
+        """ Files shorter than the period """
+        for nom in ('Precip', 'Tn', 'Tx'):
+            _fichiers(self.rep, nom, (2000,), lambda a: 10)
+        temps = utils.time_prep(datetime.datetime(2000, 1, 5),
+                                datetime.datetime(2000, 1, 20), 'D')
+        self.assertRaises(ValueError, litdonneesmodele.litficmeteo,
+                          self.rep, temps, 'bv')
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rep = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rep)
+        self.cache = os.path.join(self.rep, 'cache')
+
+    def _lit(self, debut, fin, pas='D'):
+        temps = utils.time_prep(debut, fin, pas)
+        return litdonneesmodele.litficmeteo(self.rep, temps, 'bv', self.cache)
+
+    def _index(self, sousrep):
+        """ Indexes of the binary files of a folder of the cache """
+        repertoire = os.path.join(self.cache, sousrep)
+        index = []
+        for nom in sorted(os.listdir(repertoire)):
+            if nom.endswith('.json'):
+                with open(os.path.join(repertoire, nom)) as fic:
+                    index.append(json.load(fic))
+        return index
+
+    def test_modified(self):
+        """ A modified file is converted again """
+        for nom in ('Precip', 'Tn', 'Tx'):
+            _fichiers(self.rep, nom, (2000,), lambda a: 366)
+        debut = datetime.datetime(2000, 1, 1)
+        fin = datetime.datetime(2000, 1, 5)
+        np.testing.assert_array_equal(self._lit(debut, fin)['rain'],
+                                      _attendu(2000, range(5)))
+        fichier = os.path.join(self.rep, 'Meteo', 'Precip',
+                               'Forcage_carreau_bv_2000.txt')
+        np.savetxt(fichier, np.ones((366, 2)), fmt='%.1f')
+        info = os.stat(fichier)
+        os.utime(fichier, (info.st_atime, info.st_mtime + 10))
+        np.testing.assert_array_equal(self._lit(debut, fin)['rain'],
+                                      np.ones((5, 2)))
+        self.assertEqual(len(self._index('Precip')), 1)
+
+    def test_period(self):
+        """ Dates and time step of the index """
+        _fichiers(self.rep, 'Precip', (2000,), lambda a: 24 * 366)
+        for nom in ('Tn', 'Tx'):
+            _fichiers(self.rep, nom, (2000,), lambda a: 366)
+        _fichiers(self.rep, 'Tair', (2000,), lambda a: 24 * 366)
+        jour = self._lit(datetime.datetime(2000, 1, 1),
+                         datetime.datetime(2000, 1, 3))
+        heure = self._lit(datetime.datetime(2000, 1, 1),
+                          datetime.datetime(2000, 1, 1, 2), 'H')
+        np.testing.assert_array_equal(jour['rain'], heure['rain'])
+        # one binary file per time step
+        index = self._index('Precip')
+        self.assertEqual(sorted([(i['dt'], i['date2']) for i in index]),
+                         [(3600, '2000-12-31T23:00:00'),
+                          (86400, '2024-01-18T00:00:00')])
+        for i in index:
+            self.assertEqual(i['date1'], '2000-01-01T00:00:00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    Models and pools of models with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import datetime
+import threading
+import unittest
+import numpy as np
+import stubs
+from pymordor import model
+
+
+class TestModel(stubs.StubTestCase):
+
+    def setUp(self):
+        self.arguments = (stubs.days(10), stubs.mesh(), stubs.weather(10),
+                          np.zeros(9), np.ones((2, 49)))
+
+    def test_run(self):
+        """ End of the run within the inputs """
+        with model.Model(*self.arguments) as modele:
+            self.assertEqual(modele.run(datetime.datetime(2000, 1, 5))
+                             .shape[0], 4)
+            for date2 in (datetime.datetime(2000, 1, 11),
+                          datetime.datetime(1999, 12, 31)):
+                self.assertRaises(ValueError, modele.run, date2)
+        self.assertTrue(modele.closed)
+
+    def test_concurrent(self):
+        """ One model per key, the duplicates are closed """
+        pool = model.ModelPool(4)
+        crees = []
+        debut = threading.Barrier(4) if hasattr(threading, 'Barrier') \
+            else None
+        origine = model.Model
+
+        class Lent(origine):
+            def __init__(self, *args, **kwargs):
+                if debut is not None:
+                    debut.wait()
+                origine.__init__(self, *args, **kwargs)
+                crees.append(self)
+        model.Model = Lent
+        try:
+            modeles = []
+            fils = [threading.Thread(target=lambda: modeles.append(
+                pool.get('bv', *self.arguments))) for _ in range(4)]
+            for fil in fils:
+                fil.start()
+            for fil in fils:
+                fil.join()
+        finally:
+            model.Model = origine
+        self.assertEqual(len(set([id(m) for m in modeles])), 1)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(len(crees), 4)
+        self.assertEqual(sum([not m.closed for m in crees]), 1)
+        for modele in modeles:
+            pool.release(modele)
+        pool.close()
+        self.assertTrue(modeles[0].closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
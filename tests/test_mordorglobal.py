@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    Preparation of the cells with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import unittest
+import multiprocessing
+import numpy as np
+import stubs
+from pymordor import mordorglobal
+
+NCELLS = 7
+NPAS = 50
+
+
+class TestPrepbatch(stubs.StubTestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.entrees = (rng.rand(NCELLS, 49), rng.rand(NCELLS, 3) * 1000,
+                        np.arange(1, NPAS + 1), rng.rand(NPAS, NCELLS),
+                        rng.rand(NPAS, NCELLS), rng.rand(NPAS, NCELLS) + 1.,
+                        np.hstack((NPAS, np.arange(1., 9.))))
+
+    def _prepare(self, **options):
+        """ Results and buffers of a preparation """
+        tampons = mordorglobal.creertampons(3, NPAS)
+        res = mordorglobal.prepbatch(*self.entrees, tampons=tampons,
+                                     **options)
+        res['don2'] = tampons['don2']
+        return res
+
+    def _identiques(self, res, serie):
+        self.assertEqual(sorted(res), sorted(serie))
+        for nom in serie:
+            self.assertTrue(np.array_equal(res[nom], serie[nom]), nom)
+
+    def test_nprocs(self):
+        """ Processes: same bits as the serial preparation """
+        serie = self._prepare()
+        self.assertTrue(np.any(serie['tpn'] != 0))
+        self._identiques(self._prepare(nprocs=2), serie)
+
+    def test_pool(self):
+        """ Pool of the caller, reused and left open """
+        serie = self._prepare()
+        pool = multiprocessing.Pool(2)
+        try:
+            for _ in range(2):
+                self._identiques(self._prepare(pool=pool), serie)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_executor(self):
+        """ Executor of the caller """
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:  # Python 2
+            raise unittest.SkipTest('no concurrent.futures')
+        serie = self._prepare()
+        with ProcessPoolExecutor(2) as executor:
+            self._identiques(self._prepare(pool=executor, nprocs=2), serie)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache of the preparation of the cells
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import stubs
+from pymordor import mordorglobal, prepcache
+
+
+def _valeurs(k):
+    """ Results of a cell: 100 doubles (800 bytes) """
+    return {'tpn': np.full(100, float(k))}
+
+
+class TestPrepCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rep = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rep)
+
+    def test_lru(self):
+        """ Least recently used entries evicted beyond the size """
+        cache = prepcache.PrepCache(maxbytes=2000)
+        cache.put('a', _valeurs(1))
+        cache.put('b', _valeurs(2))
+        self.assertEqual(cache.get('a')['tpn'][0], 1.)
+        cache.put('c', _valeurs(3))
+        self.assertEqual(list(cache.entrees), ['a', 'c'])
+        self.assertEqual(cache.taille, 1600)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.clear()
+        self.assertEqual((len(cache.entrees), cache.taille), (0, 0))
+
+    def test_copy(self):
+        """ The stored values do not follow the arrays of the caller """
+        cache = prepcache.PrepCache()
+        valeurs = _valeurs(1)
+        cache.put('a', valeurs)
+        valeurs['tpn'][:] = 5.
+        self.assertEqual(cache.get('a')['tpn'][0], 1.)
+
+    def test_disk(self):
+        """ Entries evicted from memory or of another cache read back """
+        repertoire = os.path.join(self.rep, 'cache')
+        cache = prepcache.PrepCache(maxbytes=1000, repertoire=repertoire)
+        cache.put('a', _valeurs(1))
+        cache.put('b', _valeurs(2))
+        self.assertEqual(list(cache.entrees), ['b'])
+        self.assertEqual(sorted(os.listdir(repertoire)), ['a.npz', 'b.npz'])
+        self.assertEqual(cache.get('a')['tpn'][0], 1.)
+        self.assertEqual(list(cache.entrees), ['a'])
+        autre = prepcache.PrepCache(repertoire=repertoire)
+        np.testing.assert_array_equal(autre.get('b')['tpn'], np.full(100, 2.))
+        self.assertIsNone(autre.get('c'))
+        self.assertEqual((autre.hits, autre.misses), (1, 1))
+
+    def test_keys(self):
+        """ One key per cell, changed by its own inputs only """
+        rng = np.random.RandomState(0)
+        entrees = [rng.rand(3, 49), rng.rand(3, 2), np.arange(1, 11),
+                   rng.rand(10, 3), rng.rand(10, 3), rng.rand(10, 3),
+                   np.arange(9.)]
+        cache = prepcache.PrepCache()
+        cles = cache.keys(*entrees)
+        self.assertEqual(len(set(cles)), 3)
+        entrees[3] = entrees[3].copy()
+        entrees[3][5, 1] += 1.
+        nouvelles = cache.keys(*entrees)
+        self.assertEqual([c == n for c, n in zip(cles, nouvelles)],
+                         [True, False, True])
+        entrees[6] = entrees[6] + 1.
+        self.assertEqual(len(set(cache.keys(*entrees)) & set(cles)), 0)
+
+
+class TestPrepbatch(stubs.StubTestCase):
+
+    def test_cache(self):
+        """ Same results with a cache, the last cell computed again """
+        rng = np.random.RandomState(3)
+        entrees = (rng.rand(4, 49), rng.rand(4, 3) * 1000,
+                   np.arange(1, 31), rng.rand(30, 4), rng.rand(30, 4),
+                   rng.rand(30, 4) + 1., np.hstack((30, np.arange(1., 9.))))
+        tampons = mordorglobal.creertampons(3, 30)
+        reference = mordorglobal.prepbatch(*entrees, tampons=tampons)
+        don2 = tampons['don2'].copy()
+        cache = prepcache.PrepCache()
+        for hits in (0, 3):
+            tampons = mordorglobal.creertampons(3, 30)
+            res = mordorglobal.prepbatch(*entrees, tampons=tampons,
+                                         cache=cache)
+            self.assertEqual(cache.hits, hits)
+            for nom in reference:
+                np.testing.assert_array_equal(res[nom], reference[nom])
+            np.testing.assert_array_equal(tampons['don2'], don2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    Lambert II <-> geographical coordinates
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import threading
+import unittest
+import numpy as np
+from pymordor import projection, utils
+
+
+def _lambert2geo(x, y):
+    """ Conversion of the first version (finite-difference iterations) """
+    taille = x.size
+    XS = np.ones(taille)*600000.0
+    YS = np.ones(taille)*8199695.768
+    N = 0.7289686274
+    C = 11745793.39
+    E = 0.08248325676
+    DELTA = 0.040792344
+    r = np.sqrt(np.power(x-XS, 2)+np.power(y-YS, 2))
+    g = np.arctan((x-XS)/(YS-y))
+    longitude = DELTA + g/N
+    lambert = (-1.0/N)*np.log(np.abs(r/C))
+    p = np.pi*42.0/180.0
+    v = 0.0
+    while 1:
+        if np.max(np.abs(v-p)) < 1.e-6:
+            break
+        f = p
+        o = lambert - 0.5*np.log((1.0+np.sin(f))/(1.0-np.sin(f))) \
+            + E/2.0*np.log((1.0+E*np.sin(f))/(1.0-E*np.sin(f)))
+        f = p + 0.0001
+        q = lambert - 0.5*np.log((1.0+np.sin(f))/(1.0-np.sin(f))) \
+            + E/2.0*np.log((1.0+(E*np.sin(f)))/(1.0-E*np.sin(f)))
+        v = p
+        p = p-0.0001*o/(q-o)
+    return {'longitude': longitude, 'latitude': p}
+
+
+def _points(n, seed=0):
+    """ Lambert II points over France """
+    rng = np.random.RandomState(seed)
+    return (rng.uniform(60000., 1200000., n),
+            rng.uniform(1620000., 2680000., n))
+
+
+class TestProjection(unittest.TestCase):
+
+    def test_baseline(self):
+        """ Same coordinates as the first version, to its tolerance """
+        x, y = _points(2000)
+        attendu = _lambert2geo(x, y)
+        res = utils.lambert2geo(x, y)
+        np.testing.assert_allclose(res['longitude'], attendu['longitude'],
+                                   rtol=0, atol=1e-14)
+        np.testing.assert_allclose(res['latitude'], attendu['latitude'],
+                                   rtol=0, atol=1e-8)
+
+    def test_roundtrip(self):
+        """ Lambert -> geographical -> Lambert, by chunks and shapes """
+        x, y = _points(3000, seed=1)
+        geo = projection.lambert2geo(x.reshape(30, 100), y.reshape(30, 100),
+                                     chunk=700)
+        self.assertEqual(geo['latitude'].shape, (30, 100))
+        xy = projection.geo2lambert(geo['longitude'], geo['latitude'])
+        np.testing.assert_allclose(xy['x'].ravel(), x, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(xy['y'].ravel(), y, rtol=0, atol=1e-6)
+        # origin: Paris meridian (2.3372 E) and parallel of 52 grads
+        geo = projection.lambert2geo(600000., 2200000.)
+        self.assertAlmostEqual(np.degrees(geo['longitude']), 2.33722917,
+                               places=7)
+        self.assertAlmostEqual(np.degrees(geo['latitude']), 46.8, places=6)
+
+    def test_geo_maillage(self):
+        """ Cached coordinates of meshes, shared by threads """
+        maillages = []
+        for k in range(projection.NCACHE + 8):
+            x, y = _points(50, seed=k)
+            maillages.append({'descripteurs': np.column_stack(
+                (x, y, np.zeros(50)))})
+        erreurs = []
+
+        def calculs(decalage):
+            for k in range(len(maillages)):
+                maillage = maillages[(k + decalage) % len(maillages)]
+                res = projection.geo_maillage(maillage)
+                attendu = projection.lambert2geo(
+                    maillage['descripteurs'][:, 0],
+                    maillage['descripteurs'][:, 1])
+                if not np.array_equal(res['latitude'], attendu['latitude']):
+                    erreurs.append(k)
+        fils = [threading.Thread(target=calculs, args=(k,))
+                for k in range(8)]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+        self.assertEqual(erreurs, [])
+        self.assertTrue(len(projection._CACHE) <= projection.NCACHE)
+        # copies: the cache is not modified by the caller
+        res = projection.geo_maillage(maillages[-1])
+        res['latitude'][:] = 0.
+        self.assertTrue(np.all(
+            projection.geo_maillage(maillages[-1])['latitude'] > 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    Requests to a server of models with the stubs of the libraries
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import stat
+import json
+import socket
+import struct
+import datetime
+import tempfile
+import threading
+import unittest
+import numpy as np
+import stubs
+from pymordor import hf_mordor, hm_mordor, server
+
+ETAT0 = np.zeros(9)
+
+
+class TestMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_roundtrip(self):
+        """ Header and arrays of any dtype and shape """
+        arrays = {'x': np.arange(12.).reshape(3, 4),
+                  'i': np.arange(5, dtype=np.int32),
+                  'f': np.asfortranarray(np.ones((2, 3))),
+                  'vide': np.zeros((0, 3))}
+        server.send(self.a, {'op': 'test', 'n': 3}, arrays)
+        header, res = server.receive(self.b)
+        self.assertEqual(header, {'op': 'test', 'n': 3})
+        self.assertEqual(sorted(res), sorted(arrays))
+        for nom in arrays:
+            self.assertEqual(res[nom].dtype, arrays[nom].dtype)
+            np.testing.assert_array_equal(res[nom], arrays[nom])
+
+    def _brut(self, entete, donnees=b''):
+        """ Raw message: header of bytes and data """
+        self.a.sendall(struct.pack('!I', len(entete)) + entete + donnees)
+
+    def test_malformed(self):
+        """ JSON, dtype, shape and object arrays """
+        for entete in (b'{bad', b'[1, 2]',
+                       b'{"arrays": [["x", "foo", [2]]]}',
+                       b'{"arrays": [["x", "<f8", [-2]]]}',
+                       b'{"arrays": [["x", "|O", [2]]]}',
+                       b'{"arrays": [["x", "<f8"]]}'):
+            self._brut(entete)
+            self.assertRaises(server.ProtocolError, server.receive, self.b)
+
+    def test_limits(self):
+        """ Header and data larger than the limits """
+        self._brut(b'{"op": "' + b'x' * 100 + b'"}')
+        self.assertRaises(server.ProtocolError, server.receive, self.b, 50)
+        entete = json.dumps({'arrays': [['x', '<f8', [1000]]]})
+        self._brut(entete.encode('utf-8'))
+        self.assertRaises(server.ProtocolError, server.receive, self.b,
+                          server.MAX_HEADER, 4000)
+
+
+class TestServer(stubs.StubTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestServer, cls).setUpClass()
+        cls.maillage = stubs.mesh()
+        cls.meteo = stubs.weather(20)
+        cls.temps = stubs.days(10)
+        cls.modeles = []
+        for k in range(2):
+            meteo = dict((nom, v[0:10]) for nom, v in cls.meteo.items())
+            forc = hf_mordor.create(cls.temps, cls.maillage, meteo, ETAT0,
+                                    np.ones(49), capacite=20)
+            hm = hm_mordor.create(cls.temps, cls.maillage, forc)
+            hm_mordor.initialization(hm, cls.temps, forc['matini'])
+            cls.modeles.append((forc, hm))
+
+    def _serveur(self, adresse, **limites):
+        """ Server of the models served by a thread """
+        serveur = server.create_server(adresse, **limites)
+        for k, (forc, hm) in enumerate(self.modeles):
+            server.add_model(serveur, 'bv' + str(k), self.temps, forc, hm)
+        fil = threading.Thread(target=serveur.serve_forever)
+        fil.daemon = True
+        fil.start()
+
+        def arret():
+            serveur.shutdown()
+            serveur.server_close()
+            fil.join()
+        self.addCleanup(arret)
+        return serveur
+
+    def _requetes(self, adresse):
+        """ Requests of a client """
+        with server.Client(adresse, timeout=10) as client:
+            self.assertEqual(client.request('list')[0]['models'],
+                             ['bv0', 'bv1'])
+            debut = client.restore('bv0')
+            etat = client.state('bv0')
+            self.assertEqual(etat['date'], debut)
+            fin = datetime.datetime(2000, 1, 5)
+            self.assertEqual(client.run('bv0', fin).shape, (4, 1))
+            self.assertGreater(client.state('bv0')['date'], debut)
+            self.assertEqual(client.restore('bv0', etat), debut)
+            self.assertEqual(client.state('bv0')['date'], debut)
+            self.assertRaises(RuntimeError, client.run, 'bv0',
+                              datetime.datetime(2000, 2, 1))
+            self.assertRaises(RuntimeError, client.request, 'foo',
+                              model='bv0')
+            self.assertRaises(RuntimeError, client.run, 'inconnu')
+            # the connection is still usable after errors
+            self.assertEqual(client.restore('bv1'), debut)
+
+    def test_unix(self):
+        """ Requests on a Unix socket, only accessible to its owner """
+        repertoire = tempfile.mkdtemp()
+        adresse = os.path.join(repertoire, 'serveur.sock')
+        self.addCleanup(os.rmdir, repertoire)
+        self.addCleanup(os.remove, adresse)
+        self._serveur(adresse)
+        self.assertEqual(stat.S_IMODE(os.stat(adresse).st_mode), 0o600)
+        self._requetes(adresse)
+
+    def test_tcp(self):
+        """ Requests on a TCP socket """
+        serveur = self._serveur(('127.0.0.1', 0))
+        self._requetes(serveur.server_address)
+
+    def test_update(self):
+        """ New time steps of the inputs, with shapes checked """
+        serveur = self._serveur(('127.0.0.1', 0))
+        forc = self.modeles[1][0]
+        with server.Client(serveur.server_address, timeout=10) as client:
+            meteo = dict((nom, v[10:11, 0:3])
+                         for nom, v in self.meteo.items())
+            self.assertRaises(RuntimeError, client.update, 'bv1', meteo)
+            meteo = dict((nom, v[10:12]) for nom, v in self.meteo.items())
+            self.assertEqual(client.update('bv1', meteo), 12)
+            np.testing.assert_array_equal(forc['series']['rain'][10:12],
+                                          self.meteo['rain'][10:12])
+
+    def test_malformed(self):
+        """ Error answered and connection closed """
+        serveur = self._serveur(('127.0.0.1', 0), maxdata=1000)
+        for message in (b'{bad', b'{"arrays": [["x", "|O", [2]]]}',
+                        b'{"op": "list", "arrays": [["x", "<f8", [200]]]}'):
+            sock = socket.create_connection(serveur.server_address, 10)
+            try:
+                sock.sendall(struct.pack('!I', len(message)) + message)
+                header, _ = server.receive(sock)
+                self.assertEqual(header['status'], 'error')
+                self.assertEqual(sock.recv(1), b'')
+            finally:
+                sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
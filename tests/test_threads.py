@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    Concurrent runs of models with a stub of the library of the models
+
+    The stub (compiled with the C compiler of the system, the tests are
+    skipped without it) counts the runs in progress: a model deleted while
+    a run is in progress is reported as a violation.
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import os
+import datetime
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from pymordor import libraries, threads, litdonneesmodele
+from pymordor.modelehydro import detruiremodele
+
+STUB = r"""
+#include <unistd.h>
+static volatile int actifs = 0;
+static volatile int maximum = 0;
+static volatile int violations = 0;
+int GetDimModele(int h, int *n, int *ns, int *nb, double *dt)
+{ *n = 1; *ns = 1; *nb = 1; *dt = 86400.0; return 0; }
+int hmRunMordor(int h, double *tm, double *q)
+{
+    int n = __sync_add_and_fetch(&actifs, 1);
+    if (n > maximum) maximum = n;
+    usleep(20000);
+    q[0] = h;
+    __sync_sub_and_fetch(&actifs, 1);
+    return 0;
+}
+int DetruireModele(int h)
+{
+    if (actifs > 0) violations++;
+    usleep(1000);
+    if (actifs > 0) violations++;
+    return 0;
+}
+char *GetErreur(void) { return "stub"; }
+int Maximum(void) { return maximum; }
+int Violations(void) { return violations; }
+"""
+
+TEMPS = {'dt': 86400, 'ndates': 3, 'date1': datetime.datetime(2000, 1, 1),
+         'date2': datetime.datetime(2000, 1, 3)}
+
+
+def _compile(repertoire):
+    """ Stub libraries (False without a C compiler) """
+    source = os.path.join(repertoire, 'stub.c')
+    with open(source, 'w') as fic:
+        fic.write(STUB)
+    vide = os.path.join(repertoire, 'vide.c')
+    with open(vide, 'w') as fic:
+        fic.write('int vide(void) { return 0; }\n')
+    try:
+        for fichier, nom in ((source, 'WrapperModeleHydro'),
+                             (vide, 'RunMordorTS')):
+            subprocess.check_call(['cc', '-shared', '-fPIC', '-o',
+                                   libraries.chemin(nom), fichier])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def _oublie():
+    """ Libraries of the models removed from the registry """
+    for nom in ('WrapperModeleHydro', 'RunMordorTS'):
+        libraries._CHARGEES.pop(nom, None)
+        for cle in [cle for cle in libraries._DECLAREES if cle[0] == nom]:
+            libraries._DECLAREES.discard(cle)
+
+
+class TestThreads(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.repertoire = tempfile.mkdtemp()
+        cls.libmordor = os.environ.get('LIBMORDOR')
+        os.environ['LIBMORDOR'] = cls.repertoire
+        if not _compile(cls.repertoire):
+            raise unittest.SkipTest('no C compiler')
+        # stub loaded instead of the library
+        _oublie()
+        cls.stub = libraries.load('WrapperModeleHydro')
+
+    @classmethod
+    def tearDownClass(cls):
+        _oublie()
+        if cls.libmordor is None:
+            os.environ.pop('LIBMORDOR', None)
+        else:
+            os.environ['LIBMORDOR'] = cls.libmordor
+        shutil.rmtree(cls.repertoire)
+
+    def test_run(self):
+        """ Results of each model, runs computed at the same time """
+        modeles = list(range(1, 9))
+        res = threads.run(modeles, TEMPS, nthreads=8)
+        self.assertEqual([int(r['qsim'][0, 0]) for r in res], modeles)
+        self.assertGreater(self.stub.Maximum(), 1)
+
+    def test_sequential(self):
+        """ Same results with one thread """
+        res = threads.run([3, 4], TEMPS, nthreads=1)
+        self.assertEqual([int(r['qsim'][0, 0]) for r in res], [3, 4])
+
+    def test_deletion(self):
+        """ No model deleted during a run """
+        fin = threading.Event()
+
+        def suppressions():
+            while not fin.is_set():
+                detruiremodele(100)
+        suppresseur = threading.Thread(target=suppressions)
+        suppresseur.start()
+        try:
+            threads.run(list(range(1, 17)), TEMPS, nthreads=8)
+        finally:
+            fin.set()
+            suppresseur.join()
+        self.assertEqual(self.stub.Violations(), 0)
+
+    def test_benchmark(self):
+        """ Runs of 20 ms: faster with threads, unless serialized """
+        modeles = list(range(1, 9))
+        res = threads.benchmark(modeles, TEMPS, None, nthreads=8,
+                                repetitions=2)
+        self.assertGreater(res['sequential'], 0.15)
+        self.assertGreater(res['speedup'], 2.0)
+        libraries.serialize(True)
+        try:
+            res = threads.benchmark(modeles, TEMPS, None, nthreads=8,
+                                    repetitions=1)
+        finally:
+            libraries.serialize(False)
+        self.assertLess(res['speedup'], 1.5)
+
+
+class TestUnites(unittest.TestCase):
+
+    def test_unite(self):
+        """ Different Fortran units for concurrent readers """
+        unites = []
+        verrou = threading.Lock()
+
+        def tirages():
+            valeurs = [litdonneesmodele._unite() for _ in range(1000)]
+            with verrou:
+                unites.extend(valeurs)
+        fils = [threading.Thread(target=tirages) for _ in range(8)]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+        self.assertEqual(len(set(unites)), len(unites))
+        self.assertTrue(min(unites) >= litdonneesmodele.UNITE_MIN)
+        self.assertTrue(max(unites) < litdonneesmodele.UNITE_MAX)
+
+
+if __name__ == '__main__':
+    unittest.main()
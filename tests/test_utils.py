@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    Dates and time series against the scalar functions of the first version
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import datetime
+import unittest
+import numpy as np
+from pymordor import utils
+
+
+def _datenum(date):
+    """ Scalar conversion of a date (first version) """
+    annee, mois, jour, heure, mn, seconde = date[0:6]
+    rep = ((np.mod(annee, 100) != 0) & (np.mod(annee, 4) == 0)) \
+        | (np.mod(annee, 400) == 0)
+    decimal_part = (seconde * (1. / (24. * 3600.))) + \
+        (mn * (1. / (24. * 60.))) + (heure * (1. / 24.))
+    integer_part = jour + np.floor((mois * 3057. - 3007.) / 100.)
+    integer_part = integer_part + ((mois < 3) - 1)
+    integer_part = integer_part + (((mois < 3) | (rep)) - 1)
+    leap_year_case = annee * 365. + (annee / 4.) - np.floor(annee / 100.) +\
+        np.floor(annee / 400.)
+    not_leap_year_case = annee * 365. + np.floor(annee / 4.) + \
+        1 - np.floor(annee / 100.) + np.floor(annee / 400.)
+    if rep:
+        not_leap_year_case = 0
+    else:
+        leap_year_case = 0
+    return integer_part + leap_year_case + not_leap_year_case + decimal_part
+
+
+def _datevec(n):
+    """ Scalar conversion of a number to a date (first version) """
+    common_year = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
+    leap_year = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]
+    second = 86400. * (n - np.floor(n))
+    hour = np.floor(second / 3600.)
+    second = second - 3600. * hour
+    minute = np.floor(second / 60.)
+    second = second - 60. * minute
+    n = np.floor(n)
+    year = np.floor(n / 365.2425)
+    temp = n - (365.0 * year + np.ceil(0.25 * year)
+                - np.ceil(0.01 * year) + np.ceil(0.0025 * year))
+    if temp <= 0:
+        year = year - 1
+        n = n - (365.0 * year + np.ceil(0.25 * year)
+                 - np.ceil(0.01 * year) + np.ceil(0.0025 * year))
+    else:
+        n = temp
+    month = int(n / 29)
+    rep = ((np.mod(year, 100) != 0) & (np.mod(year, 4) == 0))\
+        | (np.mod(year, 400) == 0)
+    month_day_mat = leap_year[month] if rep else common_year[month]
+    if n > month_day_mat:
+        month = month + 1
+    month_day_mat = leap_year[month-1] if rep else common_year[month-1]
+    return {'year': int(year), 'month': int(month),
+            'day': int(n - month_day_mat), 'hour': int(hour),
+            'minute': int(minute), 'second': second}
+
+
+def _dates(n, seed=0):
+    """ Random dates [Y,M,D,H,Mn,S] of 1899 to 2101, leap days included """
+    rng = np.random.RandomState(seed)
+    debut = np.datetime64('1899-01-01T00:00:00')
+    secondes = rng.randint(0, 203 * 365 * 86400, size=n)
+    dates = debut + secondes.astype('m8[s]')
+    dates = np.concatenate((dates, np.array(
+        ['2000-02-29T23:59:00', '1900-03-01', '2100-12-31T12:30:00',
+         '2004-01-01'], dtype='M8[s]')))
+    return dates, np.column_stack(utils._composantes(dates))
+
+
+def _cutarray(tab, firstdate, lastdate, txunit):
+    """ Extraction of a time series by a scan of the rows (first version) """
+    ndt = tab.shape[0]
+    date1 = datetime.datetime(int(tab[0, 0]), int(tab[0, 1]), int(tab[0, 2]),
+                              int(tab[0, 3]), int(tab[0, 4]))
+    date2 = datetime.datetime(int(tab[-1, 0]), int(tab[-1, 1]),
+                              int(tab[-1, 2]), int(tab[-1, 3]),
+                              int(tab[-1, 4]))
+    if date2 <= date1:
+        return None
+    delta = date2 - date1
+    if txunit == 'days':
+        nbok = delta.days + 1
+    elif txunit == 'hours':
+        nbok = int(delta.days*24 + delta.seconds/3600 + 1)
+    if nbok != ndt:
+        return None
+    if firstdate >= lastdate:
+        return None
+    i1 = 0
+    i2 = ndt
+    for i in range(0, ndt):
+        datec = datetime.datetime(int(tab[i, 0]), int(tab[i, 1]),
+                                  int(tab[i, 2]), int(tab[i, 3]),
+                                  int(tab[i, 4]))
+        if datec <= firstdate:
+            i1 = i
+        if datec <= lastdate:
+            i2 = i
+    return tab[i1:i2, 5]
+
+
+def _serie(debut, n, dt):
+    """ Table of a regular time series: Y, M, D, H, Mn and the values """
+    dates = np.datetime64(debut, 's') + np.arange(n) * np.timedelta64(dt, 's')
+    composantes = utils._composantes(dates)
+    return np.column_stack(composantes[0:5] + [np.arange(n) * 1.5])
+
+
+class TestDates(unittest.TestCase):
+
+    def test_datenum(self):
+        """ Arrays of [Y,M,D,H,Mn,S] and datetime64 dates """
+        dates, composantes = _dates(500)
+        attendu = np.array([_datenum(d) for d in composantes])
+        np.testing.assert_array_equal(utils.datenum_array(composantes),
+                                      attendu)
+        np.testing.assert_array_equal(utils.datenum_array(dates), attendu)
+        self.assertEqual(utils.datenum(list(composantes[0]))['scalar'],
+                         attendu[0])
+        self.assertEqual(utils.datenum_array(composantes.reshape(2, -1, 6))
+                         .shape, (2, attendu.size // 2))
+
+    def test_datevec(self):
+        """ Numbers of days with fractions of day """
+        _, composantes = _dates(500, seed=1)
+        nombres = np.array([_datenum(d) for d in composantes])
+        res = utils.datevec_array(nombres)
+        for k, n in enumerate(nombres):
+            attendu = _datevec(n)
+            for nom in attendu:
+                self.assertEqual(res[nom][k], attendu[nom], nom)
+            self.assertEqual(utils.datevec(n), attendu)
+
+
+class TestCutarray(unittest.TestCase):
+
+    def _compare(self, tab, txunit, bornes):
+        serie = utils.TimeSeries(tab)
+        for firstdate, lastdate in bornes:
+            attendu = _cutarray(tab, firstdate, lastdate, txunit)
+            for source in (tab, serie):
+                res = utils.cutarray(source, firstdate, lastdate, txunit)
+                if attendu is None:
+                    self.assertIsNone(res)
+                else:
+                    np.testing.assert_array_equal(res, attendu)
+
+    def _bornes(self, debut, dt, n, seed):
+        """ Random periods, some outside of the series or reversed """
+        rng = np.random.RandomState(seed)
+        bornes = []
+        for _ in range(40):
+            k1, k2 = rng.randint(-n // 4, n + n // 4, size=2)
+            bornes.append((debut + datetime.timedelta(seconds=int(k1) * dt),
+                           debut + datetime.timedelta(seconds=int(k2) * dt)))
+        # dates between two time steps
+        bornes.append((debut + datetime.timedelta(seconds=dt // 2),
+                       debut + datetime.timedelta(seconds=5 * dt + dt // 3)))
+        return bornes
+
+    def test_daily(self):
+        """ Daily series over a leap year """
+        debut = datetime.datetime(1999, 11, 1)
+        tab = _serie(debut, 500, 86400)
+        self._compare(tab, 'days', self._bornes(debut, 86400, 500, 0))
+
+    def test_hourly(self):
+        """ Hourly series over a change of year """
+        debut = datetime.datetime(2003, 12, 30, 5)
+        tab = _serie(debut, 200, 3600)
+        self._compare(tab, 'hours', self._bornes(debut, 3600, 200, 1))
+
+    def test_gaps(self):
+        """ Missing time steps or reversed series: no values """
+        debut = datetime.datetime(2001, 1, 1)
+        tab = _serie(debut, 50, 86400)
+        bornes = [(debut, debut + datetime.timedelta(days=10))]
+        self._compare(np.delete(tab, 20, axis=0), 'days', bornes)
+        self._compare(tab[::-1], 'days', bornes)
+        self._compare(tab, 'hours', bornes)
+        serie = utils.TimeSeries(np.delete(tab, [20, 30], axis=0))
+        np.testing.assert_array_equal(serie.gaps(86400), [19, 28])
+
+    def test_view(self):
+        """ Values of a TimeSeries cut without copy """
+        debut = datetime.datetime(2001, 1, 1)
+        serie = utils.TimeSeries(_serie(debut, 50, 86400))
+        valeurs = serie.cut(debut + datetime.timedelta(days=3),
+                            debut + datetime.timedelta(days=8))
+        self.assertEqual(valeurs.size, 5)
+        self.assertTrue(np.shares_memory(valeurs, serie.tab))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    Compact regression matrices against their dense equivalents
+
+    Author(s) : Fabrice Zaoui
+
+    Copyright EDF 2016-2018
+
+"""
+import unittest
+import numpy as np
+from pymordor import weights
+from pymordor.modelehydro import _regression
+
+
+def _fortran(dense):
+    """ Column-major buffer of a dense matrix """
+    return np.asarray(dense, dtype=np.float64).ravel(order='F')
+
+
+class TestWeights(unittest.TestCase):
+
+    def test_diag(self):
+        """ Square and rectangular diagonal matrices """
+        valeurs = np.arange(1., 5.)
+        for nrows, ncols in ((4, 4), (5, 4), (4, 6)):
+            dense = np.zeros((nrows, ncols))
+            dense[np.arange(4), np.arange(4)] = valeurs
+            mat = weights.diagonal(valeurs, nrows, ncols)
+            np.testing.assert_array_equal(weights.tofortran(mat),
+                                          _fortran(dense))
+            np.testing.assert_array_equal(weights.todense(mat), dense)
+        # identity with the null row of the (n+1) x n matrices
+        np.testing.assert_array_equal(weights.todense(weights.identity(4, 3)),
+                                      np.eye(4, 3))
+        self.assertRaises(ValueError, weights.diagonal, valeurs, 3, 5)
+
+    def test_csr(self):
+        """ Sparse matrices, empty rows included """
+        rng = np.random.RandomState(0)
+        for nrows, ncols in ((6, 5), (3, 7), (1, 1)):
+            dense = rng.rand(nrows, ncols)
+            dense[dense < 0.6] = 0.0
+            dense[0] = 0.0
+            mat = weights.csr(dense)
+            self.assertEqual(mat['data'].size, np.count_nonzero(dense))
+            np.testing.assert_array_equal(weights.tofortran(mat),
+                                          _fortran(dense))
+            np.testing.assert_array_equal(weights.todense(mat), dense)
+
+    def test_buffer(self):
+        """ Buffer of the caller filled again, checked size """
+        tampon = np.full(12, 7.0)
+        dense = np.arange(12.).reshape(4, 3)
+        res = weights.tofortran(weights.csr(dense), tampon)
+        self.assertIs(res, tampon)
+        np.testing.assert_array_equal(tampon, _fortran(dense))
+        self.assertRaises(ValueError, weights.tofortran, weights.csr(dense),
+                          np.zeros(11))
+        self.assertRaises(ValueError, weights.tofortran,
+                          {'format': 'coo', 'shape': (1, 1)})
+
+    def test_regression(self):
+        """ Same buffer for the library from a dense or compact matrix """
+        dense = np.eye(5, 4) * 2.0
+        dense[4, 1] = 0.5
+        for mat in (weights.csr(dense), dense):
+            np.testing.assert_array_equal(_regression(mat, 20),
+                                          _fortran(dense))
+        np.testing.assert_array_equal(
+            _regression(weights.identity(5, 4), 20), _fortran(np.eye(5, 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()